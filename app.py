@@ -16,7 +16,29 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from flask_login import LoginManager, login_required, current_user, login_user, logout_user
 from flask_dance.contrib.google import make_google_blueprint, google
-from models import db, User, Device, Reading
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from models import db, User, Device
+from ingest import (MAX_BATCH_SIZE, InvalidField, extract_batch, parse_timestamp, parse_device_id, reading_seq,
+                    reading_values)
+from ingest_buffer import IngestBuffer, IngestError, DURABILITY_FLUSH
+from auth_cache import ApiKeyCache
+from db_pool import ConnectionPool, pragmas_from_env, apply_pragmas
+from climate_mirror import ClimateMirror
+from payload_codec import BINARY_CONTENT_TYPE, PayloadError, decode_readings
+from heartbeat import HeartbeatTracker, ONLINE_WITHIN, OFFLINE_AFTER
+from latest_cache import LatestReadings
+from dedup import RecentKeyFilter, reading_key, server_stamp
+from versions import etag
+from migrations import migrate, CLIMATE_MIGRATIONS, READINGS_MIGRATIONS
+from epoch import check_reading_time, format_epoch, from_epoch, to_epoch, today_bounds
+from rate_limit import RateLimiter, rates_from_env, retry_after_header
+from request_decoding import DecompressRequestBody, MAX_DECOMPRESSED_SIZE
+from retention import RetentionJob, policies_from_env
+from archive import ARCHIVE_DIR, ColumnArchive
+from conditional import not_modified, with_validators
+from livestream import HEARTBEAT_INTERVAL, LiveFeed, event_response, event_stream
+from storage import ReadingStore, decode_since
 import uuid
 
 app = Flask(__name__)
@@ -30,6 +52,13 @@ app.config['GOOGLE_OAUTH_CLIENT_SECRET'] = os.environ.get('GOOGLE_OAUTH_CLIENT_S
 
 # Initialize extensions
 db.init_app(app)
+
+# Same tuning for the SQLAlchemy connections as for the pooled raw ones
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        apply_pragmas(dbapi_connection, app.config["SQLITE_PRAGMAS"])
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
@@ -50,6 +79,37 @@ STATIC_FOLDER = "static"
 DATABASE = "climate_data.db"
 
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+# Write-behind ingestion: 'flush' acknowledges devices after the group commit, 'enqueue' as soon as queued
+app.config["INGEST_DURABILITY"] = os.environ.get("INGEST_DURABILITY", DURABILITY_FLUSH)
+app.config["INGEST_FLUSH_ROWS"] = int(os.environ.get("INGEST_FLUSH_ROWS", 500))
+app.config["INGEST_FLUSH_INTERVAL_MS"] = int(os.environ.get("INGEST_FLUSH_INTERVAL_MS", 100))
+app.config["INGEST_MAX_QUEUE"] = int(os.environ.get("INGEST_MAX_QUEUE", 10000))
+app.config["API_KEY_CACHE_SIZE"] = int(os.environ.get("API_KEY_CACHE_SIZE", 4096))
+app.config["API_KEY_CACHE_TTL"] = int(os.environ.get("API_KEY_CACHE_TTL", 300))
+# Latest readings kept in memory per device, for up to LATEST_CACHE_DEVICES devices
+app.config["LATEST_CACHE_SIZE"] = int(os.environ.get("LATEST_CACHE_SIZE", 100))
+app.config["LATEST_CACHE_DEVICES"] = int(os.environ.get("LATEST_CACHE_DEVICES", 1000))
+app.config["LATEST_CACHE_TTL"] = int(os.environ.get("LATEST_CACHE_TTL", 300))
+# Live streams: rows queued per stream before it reads them back from the database, heartbeat in seconds
+app.config["LIVE_STREAM_QUEUE"] = int(os.environ.get("LIVE_STREAM_QUEUE", 1000))
+app.config["LIVE_STREAM_HEARTBEAT"] = int(os.environ.get("LIVE_STREAM_HEARTBEAT", HEARTBEAT_INTERVAL))
+app.config["SQLITE_POOL_SIZE"] = int(os.environ.get("SQLITE_POOL_SIZE", 8))
+app.config["SQLITE_PRAGMAS"] = pragmas_from_env()
+app.config["CLIMATE_MIRROR_INTERVAL"] = int(os.environ.get("CLIMATE_MIRROR_INTERVAL", 5))
+app.config["HEARTBEAT_FLUSH_INTERVAL"] = int(os.environ.get("HEARTBEAT_FLUSH_INTERVAL", 5))
+app.config["DEVICE_ONLINE_WITHIN"] = int(os.environ.get("DEVICE_ONLINE_WITHIN", ONLINE_WITHIN))
+app.config["DEVICE_OFFLINE_AFTER"] = int(os.environ.get("DEVICE_OFFLINE_AFTER", OFFLINE_AFTER))
+app.config["DEDUP_RECENT_KEYS"] = int(os.environ.get("DEDUP_RECENT_KEYS", 100000))
+# Requests per second and burst allowed per device, by device type
+app.config["INGEST_RATE_LIMITS"] = rates_from_env()
+# gzip/deflate request bodies of the API routes are inflated on the fly, up to this many bytes
+app.config["MAX_DECOMPRESSED_BODY"] = int(os.environ.get("MAX_DECOMPRESSED_BODY", MAX_DECOMPRESSED_SIZE))
+app.wsgi_app = DecompressRequestBody(app.wsgi_app, max_size=app.config["MAX_DECOMPRESSED_BODY"])
+# Data lifecycle (see retention.py), only enforced when RETENTION_POLICIES is set
+app.config["RETENTION_POLICIES"] = policies_from_env() if os.environ.get("RETENTION_POLICIES") else None
+app.config["RETENTION_INTERVAL"] = int(os.environ.get("RETENTION_INTERVAL", 3600))
+# Raw rows past retention are kept in this columnar archive (see archive.py); empty to disable
+app.config["ARCHIVE_DIR"] = os.environ.get("ARCHIVE_DIR", ARCHIVE_DIR)
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(DATA_FOLDER, exist_ok=True)
 os.makedirs(STATIC_FOLDER, exist_ok=True)
@@ -108,91 +168,482 @@ def logout():
 def generate_api_key():
     # Generate a secure API key
     api_key = secrets.token_hex(32)
+    old_api_key = current_user.api_key
     current_user.api_key = api_key
     db.session.commit()
+    api_key_cache.invalidate(old_api_key)
     return jsonify({"api_key": api_key})
 
 # ------------------ UTILS ------------------
+db_pool = ConnectionPool(DATABASE, size=app.config["SQLITE_POOL_SIZE"], pragmas=app.config["SQLITE_PRAGMAS"])
+
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # Pooled connection: close() returns it to the pool
+    return db_pool.connect()
+
+with app.app_context():
+    READINGS_DATABASE = db.engine.url.database
+
+readings_pool = ConnectionPool(READINGS_DATABASE, size=app.config["SQLITE_POOL_SIZE"],
+                               pragmas=app.config["SQLITE_PRAGMAS"])
+
+# Device readings are only written to Reading; the legacy climate table gets them from this job
+# New rows are pushed to the live streams of the dashboards (see livestream.py)
+live_feed = LiveFeed(queue_size=app.config["LIVE_STREAM_QUEUE"])
+
+climate_mirror = ClimateMirror(DATABASE, READINGS_DATABASE, interval=app.config["CLIMATE_MIRROR_INTERVAL"],
+                               pragmas=app.config["SQLITE_PRAGMAS"], feed=live_feed)
+
+column_archive = ColumnArchive(app.config["ARCHIVE_DIR"]) if app.config["ARCHIVE_DIR"] else None
+
+retention_job = RetentionJob(DATABASE, app.config["RETENTION_POLICIES"], readings_database=READINGS_DATABASE,
+                             archive=column_archive, interval=app.config["RETENTION_INTERVAL"],
+                             pragmas=app.config["SQLITE_PRAGMAS"])
+
+# Device readings and climate rows behind one API (see storage.py)
+latest_readings = LatestReadings(capacity=app.config["LATEST_CACHE_SIZE"],
+                                 maxsize=app.config["LATEST_CACHE_DEVICES"],
+                                 ttl=app.config["LATEST_CACHE_TTL"])
+reading_store = ReadingStore('reading', readings_pool.connect, archive=column_archive,
+                             latest_cache=latest_readings, feed=live_feed)
+climate_store = ReadingStore('city', get_db_connection, archive=column_archive, feed=live_feed)
+
+READING_COLUMNS = reading_store.layout.columns
+READING_VALUES = ('temperature', 'humidity', 'pressure', 'rainfall', 'wind_speed', 'wind_direction')
+# Numeric fields a device may send, checked before a reading is queued
+MEASUREMENTS = ('temperature', 'humidity', 'pressure', 'rainfall', 'wind_speed', 'gdd')
+
+def write_buffered_data(rows):
+    """Store a group of buffered rows: device readings in Reading, anonymous ones in climate"""
+    readings = [tuple(to_epoch(row['reading'].get(column)) if column == 'timestamp' else row['reading'].get(column)
+                      for column in READING_COLUMNS)
+                for row in rows if row.get('reading')]
+    if readings:
+        climate_mirror.setup()
+        # Retried readings already stored are skipped by the unique index
+        reading_store.insert_batch(readings)
+        climate_mirror.notify()
+    
+    climate_rows = [row['climate'] for row in rows if row.get('climate')]
+    if climate_rows:
+        climate_store.insert_batch(climate_rows)
+
+CLIMATE_VALUES = ('temperature', 'humidity', 'gdd', 'city')
+# Rows at most of a ?since= delta; its cursor continues from there
+SINCE_ROWS = 1000
+
+def local_climate_rows(rows):
+    """(local time, temperature, humidity, gdd, city) tuples of (ts, *CLIMATE_VALUES) rows"""
+    return [(format_epoch(ts, '%H:%M:%S'),) + tuple(values) for ts, *values in rows]
+
+def today_climate_rows():
+    """(local time, temperature, humidity, gdd, city) of today's climate rows"""
+    return local_climate_rows(climate_store.range_query(None, *today_bounds(), columns=CLIMATE_VALUES))
+
+def climate_rows_since(since=None):
+    """Today's climate rows stored after the ?since= watermark (all of them without one, or with epoch
+    seconds of a previous day) as today_climate_rows(), and the cursor to send as the next watermark.
+
+    ValueError if `since` is neither a cursor nor epoch seconds.
+    """
+    start, end = today_bounds()
+    row_id, after = decode_since(since)
+    if row_id is None and (after is None or after <= start):
+        # Read before the rows: a row stored meanwhile comes again in the next delta, but is never missed
+        cursor = climate_store.watermark()
+        return today_climate_rows(), cursor
+    rows, cursor = climate_store.after(None, since, SINCE_ROWS, columns=CLIMATE_VALUES)
+    # Rows come in insertion order; those stored late for another day are not on today's chart
+    rows = sorted((row for row in rows if start <= row[0] < end), key=lambda row: row[0])
+    return local_climate_rows(rows), cursor
+
+def climate_event(values):
+    """A climate row of a live stream, in the format of /data"""
+    return {"time": format_epoch(values['ts'], '%H:%M:%S'), "temperature": values['temperature'],
+            "humidity": values['humidity'], "gdd": values['gdd'], "city": values['city']}
+
+def reading_event(values):
+    """A reading of a live stream: its READING_VALUES and local time"""
+    return dict({column: values[column] for column in READING_VALUES}, timestamp=format_epoch(values['timestamp']))
+
+def epoch_arg(name, default=None):
+    """Epoch seconds of a query argument, `default` when absent; raises ValueError when it is invalid"""
+    value = request.args.get(name)
+    return default if value is None else to_epoch(int(value))
+
+def reading_dicts(rows):
+    """Readings as dictionaries of their READING_VALUES, with a local datetime timestamp"""
+    return [dict(zip(READING_VALUES, values), timestamp=from_epoch(ts)) for ts, *values in rows]
+
+ingest_buffer = IngestBuffer(
+    write_buffered_data,
+    flush_rows=app.config["INGEST_FLUSH_ROWS"],
+    flush_interval_ms=app.config["INGEST_FLUSH_INTERVAL_MS"],
+    max_queue=app.config["INGEST_MAX_QUEUE"],
+    durability=app.config["INGEST_DURABILITY"]
+)
+
+def write_heartbeats(heartbeats):
+    """Store the coalesced device heartbeats in a single transaction"""
+    with app.app_context():
+        db.session.bulk_update_mappings(Device, [
+            {'id': device_id, 'last_connection': last_seen} for device_id, last_seen in heartbeats
+        ])
+        db.session.commit()
+
+heartbeats = HeartbeatTracker(
+    write_heartbeats,
+    interval=app.config["HEARTBEAT_FLUSH_INTERVAL"],
+    online_within=app.config["DEVICE_ONLINE_WITHIN"],
+    offline_after=app.config["DEVICE_OFFLINE_AFTER"]
+)
+
+# Keys of the readings ingested recently, so device retries are rejected without a DB round trip
+recent_readings = RecentKeyFilter(app.config["DEDUP_RECENT_KEYS"])
+
+def store_rows(rows):
+    """Queue rows for the group commit and refresh the heartbeat of the devices they come from.
+
+    Returns one flag per row: False for a device reading already ingested recently.
+    """
+    keys = [reading_key(row['reading']['device_id'], row['reading']['timestamp'], row['reading'].get('seq'))
+            if row.get('reading') else None for row in rows]
+    claims = iter(recent_readings.claim([key for key in keys if key is not None]))
+    flags = [key is None or next(claims) for key in keys]
+    fresh = [row for row, new in zip(rows, flags) if new]
+    claimed = [key for key, new in zip(keys, flags) if key is not None and new]
+    if fresh:
+        try:
+            future = ingest_buffer.ingest(fresh)
+        except Exception:
+            recent_readings.release(claimed)
+            raise
+        if claimed:
+            future.add_done_callback(lambda f: f.exception() and recent_readings.release(claimed))
+    device_ids = {row['reading']['device_id'] for row in rows if row.get('reading')}
+    if device_ids:
+        heartbeats.touch(device_ids)
+    return flags
+
+# API key -> (user_id, {device_id: device_type} of the user's devices), invalidated when the key or the devices change
+api_key_cache = ApiKeyCache(maxsize=app.config["API_KEY_CACHE_SIZE"], ttl=app.config["API_KEY_CACHE_TTL"])
+
+def load_api_key_owner(api_key):
+    user = User.query.filter_by(api_key=api_key).first()
+    if not user:
+        return None
+    device_types = {device.id: device.device_type for device in Device.query.filter_by(user_id=user.id).all()}
+    return (user.id, device_types)
+
+def authenticate_api_key(api_key):
+    """Return (user_id, {device_id: device_type}) for an API key, or None if it is unknown"""
+    if not api_key:
+        return None
+    return api_key_cache.lookup(api_key, load_api_key_owner)
+
+rate_limiter = RateLimiter(app.config["INGEST_RATE_LIMITS"])
+
+def acquire_rate_limit(owner, device_ids):
+    """Spend one request from the bucket of each device, or of the client for readings without one.
+
+    Returns the ids of the throttled devices (None for the client) with the seconds they must wait.
+    """
+    throttled = {}
+    for device_id in device_ids:
+        if device_id is None:
+            retry_after = rate_limiter.acquire(('client', request.headers.get('X-API-Key') or request.remote_addr))
+        else:
+            retry_after = rate_limiter.acquire(device_id, owner[1][device_id])
+        if retry_after:
+            throttled[device_id] = retry_after
+    return throttled
+
+def too_many_requests(retry_after):
+    response = jsonify({"error": "Trop de requêtes, ralentissez l'envoi des mesures."})
+    response.headers["Retry-After"] = retry_after_header(retry_after)
+    return response, 429
+
+def server_busy(error):
+    """Backpressure response for a full ingest queue, or readings not written in time"""
+    response = jsonify({"error": "Serveur surchargé, réessayez plus tard."})
+    response.headers["Retry-After"] = retry_after_header(error.retry_after)
+    return response, 503
 
 def init_db():
+    """Create the models' tables and apply the pending migrations of both databases (see migrations.py)"""
     with app.app_context():
         db.create_all()
     
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS climate (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            time TEXT,
-            temperature REAL,
-            humidity REAL,
-            gdd REAL,
-            city TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    try:
+        migrate(conn, CLIMATE_MIGRATIONS)
+    finally:
+        conn.close()
+    
+    conn = sqlite3.connect(READINGS_DATABASE)
+    try:
+        migrate(conn, READINGS_MIGRATIONS)
+    finally:
+        conn.close()
+    climate_mirror.setup()
+    climate_mirror.start()
+    if app.config["RETENTION_POLICIES"]:
+        retention_job.start()
+
+# Schema migrations run once per process, at import, so that WSGI servers and the scripts importing app get them
+init_db()
 
 # ------------------ API COLLECTE ------------------
+def receive_binary_data():
+    """Store the readings of a compact binary payload (see payload_codec)"""
+    try:
+        api_key, device_id, readings = decode_readings(request.get_data())
+    except PayloadError as e:
+        return jsonify({"error": f"Charge utile invalide : {e}"}), 400
+    if len(readings) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Lot trop volumineux (maximum {MAX_BATCH_SIZE} mesures)."}), 413
+    try:
+        for epoch, _, _ in readings:
+            check_reading_time(epoch)
+    except ValueError:
+        return jsonify({"error": "Horodatage invalide."}), 400
+    
+    owner = authenticate_api_key(api_key or request.headers.get('X-API-Key'))
+    known_device = bool(owner) and device_id in owner[1]
+    throttled = acquire_rate_limit(owner, [device_id if known_device else None])
+    if throttled:
+        return too_many_requests(max(throttled.values()))
+    if known_device:
+        rows = [{'reading': {
+            'timestamp': datetime.fromtimestamp(epoch),
+            'temperature': temperature,
+            'humidity': humidity,
+            'device_id': device_id
+        }} for epoch, temperature, humidity in readings]
+    else:
+        rows = []
+        for epoch, temperature, humidity in readings:
+            rows.append({'climate': (epoch, temperature, humidity, 0, 'N/A')})
+    try:
+        flags = store_rows(rows)
+    except IngestError as e:
+        return server_busy(e)
+    stored = sum(flags)
+    return jsonify({"status": "success", "stored": stored, "duplicates": len(rows) - stored}), 200
+
 @app.route('/api/data', methods=['POST'])
 def receive_data():
+    if request.mimetype == BINARY_CONTENT_TYPE:
+        return receive_binary_data()
+    
     data = request.get_json()
     now = datetime.now()
-    date = now.strftime("%Y-%m-%d")
-    time = now.strftime("%H:%M:%S")
+    try:
+        # The device's own timestamp identifies the reading when it retries a request
+        timestamp = parse_timestamp(data.get('timestamp'), now)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Horodatage invalide."}), 400
+    try:
+        values = dict(zip(MEASUREMENTS, reading_values(data, MEASUREMENTS)))
+        seq = reading_seq(data.get('seq'))
+    except InvalidField as e:
+        return jsonify({"error": f"Valeur invalide pour {e.field}."}), 400
+    if not data.get('timestamp') and seq is None:
+        # Nothing tells this reading from a retry: the server stamps it (see server_stamp)
+        epoch, seq = server_stamp()
+        timestamp = datetime.fromtimestamp(epoch)
     
     # Check API key if provided
-    api_key = request.headers.get('X-API-Key')
-    if api_key:
-        user = User.query.filter_by(api_key=api_key).first()
-        if user:
-            # Save data to device readings if user exists
-            device_id = data.get('device_id')
-            if device_id:
-                device = Device.query.filter_by(id=device_id, user_id=user.id).first()
-                if device:
-                    reading = Reading(
-                        timestamp=now,
-                        temperature=data.get('temperature'),
-                        humidity=data.get('humidity'),
-                        pressure=data.get('pressure'),
-                        rainfall=data.get('rainfall'),
-                        wind_speed=data.get('wind_speed'),
-                        wind_direction=data.get('wind_direction'),
-                        device_id=device.id
-                    )
-                    db.session.add(reading)
-                    db.session.commit()
+    reading = None
+    owner = authenticate_api_key(request.headers.get('X-API-Key'))
+    if owner:
+        # Save data to device readings if the device belongs to the user
+        device_id = parse_device_id(data.get('device_id'))
+        if device_id in owner[1]:
+            reading = {
+                'timestamp': timestamp,
+                'temperature': values['temperature'],
+                'humidity': values['humidity'],
+                'pressure': values['pressure'],
+                'rainfall': values['rainfall'],
+                'wind_speed': values['wind_speed'],
+                'wind_direction': data.get('wind_direction'),
+                'device_id': device_id,
+                'seq': seq
+            }
     
-    # Also save to climate table for backward compatibility
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO climate (date, time, temperature, humidity, gdd, city)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (
-        date, time, data.get('temperature'), data.get('humidity'), data.get('gdd', 0), data.get('city', 'N/A')
-    ))
-    conn.commit()
-    conn.close()
+    # Readings from unknown devices only go to the legacy climate table;
+    # device readings reach it through the climate mirror
+    throttled = acquire_rate_limit(owner, [reading['device_id'] if reading else None])
+    if throttled:
+        return too_many_requests(max(throttled.values()))
+    if reading:
+        row = {'reading': reading}
+    else:
+        gdd = values['gdd'] if 'gdd' in data else 0
+        row = {'climate': (to_epoch(now), values['temperature'], values['humidity'], gdd, data.get('city', 'N/A'))}
+    try:
+        stored, = store_rows([row])
+    except IngestError as e:
+        return server_busy(e)
+    if not stored:
+        return jsonify({"status": "success", "duplicate": True}), 200
     return jsonify({"status": "success"}), 200
 
+@app.route('/api/data/batch', methods=['POST'])
+def receive_data_batch():
+    if request.mimetype == BINARY_CONTENT_TYPE:
+        return receive_binary_data()
+    
+    data = request.get_json(silent=True)
+    items = extract_batch(data)
+    if not items:
+        return jsonify({"error": "Aucune mesure fournie."}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Lot trop volumineux (maximum {MAX_BATCH_SIZE} mesures)."}), 413
+    
+    # Resolve the API key and the user's devices once for the whole batch
+    owner = authenticate_api_key(request.headers.get('X-API-Key'))
+    device_ids = owner[1] if owner else {}
+    
+    # The batch counts as one request for every device it carries readings from
+    batch_devices = {parse_device_id(item.get('device_id')) for item in items if isinstance(item, dict)}
+    throttled = acquire_rate_limit(owner, {device_id if device_id in device_ids else None
+                                           for device_id in batch_devices})
+    
+    now = datetime.now()
+    accepted_status = "stored" if ingest_buffer.durability == DURABILITY_FLUSH else "queued"
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({"index": index, "status": "error", "error": "La mesure doit être un objet."})
+            continue
+        try:
+            timestamp = parse_timestamp(item.get('timestamp'), now)
+        except (TypeError, ValueError):
+            results.append({"index": index, "status": "error", "error": "Horodatage invalide."})
+            continue
+        try:
+            values = dict(zip(MEASUREMENTS, reading_values(item, MEASUREMENTS)))
+            seq = reading_seq(item.get('seq'))
+        except InvalidField as e:
+            results.append({"index": index, "status": "error", "error": f"Valeur invalide pour {e.field}."})
+            continue
+        if not item.get('timestamp') and seq is None:
+            epoch, seq = server_stamp()
+            timestamp = datetime.fromtimestamp(epoch)
+        
+        reading = None
+        device_id = parse_device_id(item.get('device_id'))
+        if (device_id if device_id in device_ids else None) in throttled:
+            results.append({"index": index, "status": "rate_limited", "error": "Trop de requêtes."})
+            continue
+        if device_id in device_ids:
+            reading = {
+                'timestamp': timestamp,
+                'temperature': values['temperature'],
+                'humidity': values['humidity'],
+                'pressure': values['pressure'],
+                'rainfall': values['rainfall'],
+                'wind_speed': values['wind_speed'],
+                'wind_direction': item.get('wind_direction'),
+                'device_id': device_id,
+                'seq': seq
+            }
+            rows.append({'reading': reading})
+        else:
+            gdd = values['gdd'] if 'gdd' in item else 0
+            rows.append({'climate': (
+                to_epoch(timestamp), values['temperature'], values['humidity'], gdd, item.get('city', 'N/A')
+            )})
+        results.append({"index": index, "status": accepted_status, "device": reading is not None})
+    
+    if throttled and not rows:
+        return too_many_requests(max(throttled.values()))
+    
+    # The whole batch goes into the same group commit
+    duplicates = 0
+    if rows:
+        try:
+            flags = store_rows(rows)
+        except IngestError as e:
+            return server_busy(e)
+        accepted = [result for result in results if result["status"] not in ("error", "rate_limited")]
+        for result, new in zip(accepted, flags):
+            if not new:
+                result["status"] = "duplicate"
+                duplicates += 1
+    return jsonify({
+        "status": "success",
+        "stored": len(rows) - duplicates,
+        "duplicates": duplicates,
+        "rejected": len(results) - len(rows),
+        "results": results
+    }), 200
+
+@app.route('/api/ingest-stats')
+@login_required
+def ingest_stats():
+    return jsonify({
+        "ingest_buffer": ingest_buffer.stats(),
+        "api_key_cache": api_key_cache.stats(),
+        "latest_readings": latest_readings.stats(),
+        "live_feed": live_feed.stats(),
+        "db_pool": db_pool.stats(),
+        "climate_mirror": climate_mirror.stats(),
+        "heartbeats": heartbeats.stats(),
+        "recent_readings": recent_readings.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "retention": retention_job.stats()
+    })
+
+@app.route('/api/stream/city', defaults={'city': None})
+@app.route('/api/stream/city/<city>')
+def stream_climate(city):
+    """Climate rows of a city (of every city by default) as they are stored, as Server-Sent Events"""
+    return event_response(event_stream(climate_store, live_feed, city, climate_event,
+                                       request.headers.get('Last-Event-ID') or request.args.get('since'),
+                                       app.config["LIVE_STREAM_HEARTBEAT"]))
+
+@app.route('/api/stream/device/<int:device_id>')
+@login_required
+def stream_device_data(device_id):
+    """Readings of a device as they are stored, as Server-Sent Events resumed after Last-Event-ID"""
+    device = Device.query.filter_by(id=device_id, user_id=current_user.id).first_or_404()
+    return event_response(event_stream(reading_store, live_feed, device.id, reading_event,
+                                       request.headers.get('Last-Event-ID') or request.args.get('since'),
+                                       app.config["LIVE_STREAM_HEARTBEAT"]))
+
 @app.route('/api/today', methods=['GET'])
 def get_today_data():
-    today = datetime.now().strftime("%Y-%m-%d")
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT time, temperature, humidity, city, gdd FROM climate WHERE date = ?", (today,))
-    rows = cursor.fetchall()
-    conn.close()
-    return jsonify([
-        {"time": row[0], "temperature": row[1], "humidity": row[2], "city": row[3], "gdd": row[4]} for row in rows
+    """Today's climate rows; with ?since= only those stored since, as /data"""
+    try:
+        rows, cursor = climate_rows_since(request.args.get('since'))
+    except ValueError:
+        return jsonify({"error": "Curseur invalide."}), 400
+    response = jsonify([
+        {"time": row[0], "temperature": row[1], "humidity": row[2], "city": row[4], "gdd": row[3]} for row in rows
     ])
+    response.headers['X-Cursor'] = cursor
+    return response
+
+@app.route('/api/series', methods=['GET'])
+def get_city_series():
+    """Statistics of a city per ?resolution= seconds (1 hour by default), from the rollups when possible"""
+    city = request.args.get('city')
+    if not city:
+        return jsonify({"error": "Paramètre city manquant."}), 400
+    try:
+        resolution = int(request.args.get('resolution', 3600))
+        end = epoch_arg('end', to_epoch(datetime.now()))
+        start = epoch_arg('start', end - 30 * 86400)
+    except (TypeError, ValueError):
+        return jsonify({"error": "resolution, start et end doivent être des entiers."}), 400
+    if resolution <= 0:
+        return jsonify({"error": "La résolution doit être un nombre de secondes positif."}), 400
+    points = climate_store.aggregate(city, start, end, resolution)
+    return jsonify({"city": city, "resolution": resolution, "series": points})
 
 # ------------------ DASHBOARD ------------------
 @app.route('/')
@@ -205,27 +656,32 @@ def index():
 
 @app.route('/data')
 def get_data():
-    today = datetime.now().strftime('%Y-%m-%d')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT time, temperature, humidity, gdd, city FROM climate WHERE date = ?", (today,))
-    rows = cursor.fetchall()
-    conn.close()
+    """Today's climate rows, or with ?since=<X-Cursor of the previous response> only those stored since.
+
+    The X-Cursor header of the response is the watermark to send next.
+    """
+    # Today's rows only change with a climate write or with the day
+    tag = etag('data', datetime.now().strftime('%Y-%m-%d'), climate_store.version(), request.args.get('since'))
+    unchanged = not_modified(tag)
+    if unchanged:
+        return unchanged
+    try:
+        rows, cursor = climate_rows_since(request.args.get('since'))
+    except ValueError:
+        return jsonify({"error": "Curseur invalide."}), 400
     result = [
         {"time": row[0], "temperature": row[1], "humidity": row[2], "gdd": row[3], "city": row[4]}
         for row in rows
     ]
-    return jsonify(result)
+    response = with_validators(jsonify(result), tag)
+    response.headers['X-Cursor'] = cursor
+    return response
 
 @app.route('/export-csv')
 @login_required
 def export_csv():
     today = datetime.now().strftime('%Y-%m-%d')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT time, temperature, humidity, gdd, city FROM climate WHERE date = ?", (today,))
-    rows = cursor.fetchall()
-    conn.close()
+    rows = today_climate_rows()
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(['Time', 'Temperature (°C)', 'Humidity (%)', 'GDD', 'City'])
@@ -241,6 +697,7 @@ def export_csv():
 @login_required
 def iot_dashboard():
     devices = Device.query.filter_by(user_id=current_user.id).all()
+    device_statuses = {device.id: heartbeats.status(device.id, device.last_connection) for device in devices}
     # List of supported microcontrollers
     microcontrollers = [
         {"name": "ESP32", "description": "Microcontrôleur dual-core avec WiFi et Bluetooth", "image": "esp32.jpg"},
@@ -249,7 +706,8 @@ def iot_dashboard():
         {"name": "Raspberry Pi Pico W", "description": "Microcontrôleur à bas coût avec WiFi", "image": "pico_w.jpg"},
         {"name": "Arduino Uno + Shield WiFi", "description": "Arduino classique avec shield WiFi", "image": "arduino_uno.jpg"}
     ]
-    return render_template('iot.html', devices=devices, microcontrollers=microcontrollers)
+    return render_template('iot.html', devices=devices, microcontrollers=microcontrollers,
+                           device_statuses=device_statuses)
 
 @app.route('/iot/add', methods=['POST'])
 @login_required
@@ -271,6 +729,8 @@ def add_device():
     )
     db.session.add(device)
     db.session.commit()
+    # The cached device list of this user's API key is now stale
+    api_key_cache.invalidate(current_user.api_key)
     
     flash("Appareil ajouté avec succès!", "success")
     return redirect(url_for('iot_dashboard'))
@@ -279,7 +739,7 @@ def add_device():
 @login_required
 def device_detail(device_id):
     device = Device.query.filter_by(id=device_id, user_id=current_user.id).first_or_404()
-    readings = Reading.query.filter_by(device_id=device.id).order_by(Reading.timestamp.desc()).limit(100).all()
+    readings = reading_dicts(reading_store.latest(device.id, 100, columns=READING_VALUES))
     return render_template('device.html', device=device, readings=readings)
 
 # ------------------ AI INSIGHTS ------------------
@@ -290,7 +750,7 @@ def insights():
     devices = Device.query.filter_by(user_id=current_user.id).all()
     has_data = False
     for device in devices:
-        if Reading.query.filter_by(device_id=device.id).count() > 0:
+        if reading_store.latest(device.id, 1):
             has_data = True
             break
     
@@ -309,24 +769,13 @@ def analyze_data():
     if not device:
         return jsonify({"error": "Appareil non trouvé"}), 404
     
-    readings = Reading.query.filter_by(device_id=device.id).order_by(Reading.timestamp).all()
+    # Readings past retention come from the columnar archive
+    readings = reading_store.range_query(device.id, columns=READING_VALUES)
     if not readings:
         return jsonify({"error": "Pas de données disponibles"}), 404
     
     # Convert readings to pandas DataFrame
-    data = []
-    for reading in readings:
-        data.append({
-            'timestamp': reading.timestamp,
-            'temperature': reading.temperature,
-            'humidity': reading.humidity,
-            'pressure': reading.pressure,
-            'rainfall': reading.rainfall,
-            'wind_speed': reading.wind_speed,
-            'wind_direction': reading.wind_direction
-        })
-    
-    df = pd.DataFrame(data)
+    df = pd.DataFrame(reading_dicts(readings))
     
     # Perform different analyses based on type
     results = {}
@@ -400,23 +849,15 @@ def upload():
             df = pd.read_csv(file_path, delimiter=";", encoding="utf-8")
         else:
             df = pd.read_json(file_path)
-        # Optionnel : insérer dans la base
-        for _, row in df.iterrows():
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO climate (date, time, temperature, humidity, gdd, city)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                row.get('Date') or row.get('date'),
-                row.get('Heure') or row.get('time'),
-                row.get('Température (°C)') or row.get('temperature'),
-                row.get('Humidité (%)') or row.get('humidity'),
-                row.get('GDD') or row.get('gdd', 0),
-                row.get('city', 'N/A')
-            ))
-            conn.commit()
-            conn.close()
+        # Optionnel : insérer dans la base (une seule connexion et une seule transaction)
+        rows = [(
+            to_epoch(f"{row.get('Date') or row.get('date')} {row.get('Heure') or row.get('time') or '00:00:00'}"),
+            row.get('Température (°C)') or row.get('temperature'),
+            row.get('Humidité (%)') or row.get('humidity'),
+            row.get('GDD') or row.get('gdd', 0),
+            row.get('city', 'N/A')
+        ) for _, row in df.iterrows()]
+        climate_store.insert_batch(rows)
         return jsonify({"success": "Fichier chargé avec succès."})
     except Exception as e:
         return jsonify({"error": f"Erreur lors de la lecture du fichier : {str(e)}"}), 500
@@ -666,6 +1107,5 @@ def forgot_password():
     return render_template('forgot_password.html')
 # ------------------ LANCEMENT ------------------
 if __name__ == "__main__":
-    init_db()
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, port=port)
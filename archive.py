@@ -0,0 +1,231 @@
+"""
+Columnar archive of the cold readings and climate rows.
+
+Rows leaving SQLite through the retention job (retention.py) are written to
+one block per series and UTC month, ARCHIVE_DIR/<kind>/<key>/<YYYYMM>.npz,
+holding one NumPy array per column:
+
+- timestamps are delta-encoded (the first value is absolute), so a regular
+  sampling period becomes a run of identical small integers;
+- float columns store each value's bits XORed with the previous value's, as
+  in Gorilla, so a slowly changing series is mostly zero bits;
+- text columns are kept as fixed-width string arrays;
+
+and the whole block is deflated by np.savez_compressed. `read()` returns the
+decoded columns of a time range, and `history()` merges them with the rows
+still in SQLite, so exports and analyses see one series.
+
+Series kinds:
+    device   readings of climate_data.db (simple_app.py), by device id
+    reading  readings of weather_dashboard.db (app.py), by device id
+    city     climate rows, by city
+"""
+import os
+import shutil
+import threading
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+from partitions import month_bounds, month_key
+
+ARCHIVE_DIR = "archive"
+FORMAT_VERSION = 1
+
+# Columns archived for each kind of series, timestamps (epoch seconds) first
+COLUMNS = {
+    'device': ('ts', 'temperature', 'humidity', 'seq'),
+    'reading': ('ts', 'temperature', 'humidity', 'pressure', 'rainfall', 'wind_speed', 'wind_direction', 'seq'),
+    'city': ('ts', 'temperature', 'humidity', 'gdd'),
+}
+TEXT_COLUMNS = {'wind_direction'}
+
+
+def encode_timestamps(ts):
+    return np.diff(ts.astype(np.int64), prepend=np.int64(0))
+
+
+def decode_timestamps(deltas):
+    return np.cumsum(deltas, dtype=np.int64)
+
+
+def encode_floats(values):
+    """XOR of each float64's bits with the previous one's"""
+    bits = np.ascontiguousarray(values, dtype=np.float64).view(np.uint64)
+    return bits ^ np.concatenate(([np.uint64(0)], bits[:-1]))
+
+
+def decode_floats(xored):
+    return np.bitwise_xor.accumulate(xored).view(np.float64)
+
+
+def to_arrays(kind, rows):
+    """Column arrays of rows given as tuples in COLUMNS[kind] order; NULLs become NaN (or '' for text)"""
+    columns = {}
+    for i, name in enumerate(COLUMNS[kind]):
+        values = [row[i] for row in rows]
+        if name == 'ts':
+            columns[name] = np.array(values, dtype=np.int64)
+        elif name in TEXT_COLUMNS:
+            columns[name] = np.array(['' if value is None else str(value) for value in values])
+        else:
+            columns[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return columns
+
+
+class ColumnArchive:
+    """Month blocks of column arrays under `root`"""
+
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _series_dir(self, kind, key):
+        return os.path.join(self.root, kind, quote(str(key), safe=''))
+
+    def _block_path(self, kind, key, month):
+        return os.path.join(self._series_dir(kind, key), f"{month}.npz")
+
+    def series(self, kind):
+        """Keys of the archived series of a kind"""
+        path = os.path.join(self.root, kind)
+        return sorted(unquote(name) for name in os.listdir(path)) if os.path.isdir(path) else []
+
+    def months(self, kind, key):
+        path = self._series_dir(kind, key)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name[:-4] for name in os.listdir(path) if name.endswith('.npz'))
+
+    def delete(self, kind, key):
+        """Remove every block of a series"""
+        with self._lock:
+            shutil.rmtree(self._series_dir(kind, key), ignore_errors=True)
+
+    def read_block(self, kind, key, month):
+        with np.load(self._block_path(kind, key, month)) as block:
+            columns = {}
+            for name in COLUMNS[kind]:
+                if name == 'ts':
+                    columns[name] = decode_timestamps(block[name])
+                elif name in TEXT_COLUMNS:
+                    columns[name] = block[name]
+                else:
+                    columns[name] = decode_floats(block[name])
+            return columns
+
+    def write(self, kind, key, columns):
+        """Add rows (a dict of column arrays) to the month blocks of a series; return the rows written.
+
+        Rows already archived with the same timestamp (and seq) are replaced, so
+        archiving the same rows twice, e.g. after a crash, is harmless.
+        """
+        ts = columns['ts']
+        if not len(ts):
+            return 0
+        months = np.array([month_key(value) for value in ts])
+        os.makedirs(self._series_dir(kind, key), exist_ok=True)
+        with self._lock:
+            for month in np.unique(months):
+                selected = months == month
+                block = {name: np.asarray(columns[name])[selected] for name in COLUMNS[kind]}
+                if os.path.exists(self._block_path(kind, key, month)):
+                    existing = self.read_block(kind, key, month)
+                    block = {name: np.concatenate((existing[name], block[name])) for name in COLUMNS[kind]}
+                self._write_block(kind, key, month, block)
+        return len(ts)
+
+    def _write_block(self, kind, key, month, block):
+        # Sort by time, keeping the last written of the rows sharing a timestamp and seq
+        seq = block.get('seq', np.zeros(len(block['ts'])))
+        order = np.lexsort((np.arange(len(block['ts'])), np.nan_to_num(seq, nan=-1), block['ts']))
+        block = {name: values[order] for name, values in block.items()}
+        seq = np.nan_to_num(block.get('seq', np.zeros(len(block['ts']))), nan=-1)
+        last = np.ones(len(block['ts']), dtype=bool)
+        last[:-1] = (block['ts'][1:] != block['ts'][:-1]) | (seq[1:] != seq[:-1])
+        block = {name: values[last] for name, values in block.items()}
+
+        encoded = {'format': np.array([FORMAT_VERSION])}
+        for name, values in block.items():
+            if name == 'ts':
+                encoded[name] = encode_timestamps(values)
+            elif name in TEXT_COLUMNS:
+                encoded[name] = values.astype(str)
+            else:
+                encoded[name] = encode_floats(values)
+        path = self._block_path(kind, key, month)
+        temporary = path + '.tmp.npz'
+        np.savez_compressed(temporary, **encoded)
+        os.replace(temporary, path)
+
+    def read(self, kind, key, start=None, end=None):
+        """Column arrays of a series over [start, end), sorted by time"""
+        blocks = []
+        for month in self.months(kind, key):
+            low, high = month_bounds(month)
+            if (start is not None and high <= start) or (end is not None and low >= end):
+                continue
+            block = self.read_block(kind, key, month)
+            selected = np.ones(len(block['ts']), dtype=bool)
+            if start is not None:
+                selected &= block['ts'] >= start
+            if end is not None:
+                selected &= block['ts'] < end
+            blocks.append({name: values[selected] for name, values in block.items()})
+        if not blocks:
+            return {name: np.array([], dtype=np.int64 if name == 'ts' else np.float64) for name in COLUMNS[kind]}
+        return {name: np.concatenate([block[name] for block in blocks]) for name in COLUMNS[kind]}
+
+    def history(self, kind, key, rows, start=None, end=None, columns=None):
+        """Merge archived rows of [start, end) with `rows` still in SQLite.
+
+        Rows are tuples of ts then `columns` (by default the other COLUMNS[kind]).
+        Returns tuples in the same order, oldest first; a row both archived and still
+        in SQLite (archived but not yet deleted) is only returned once.
+        """
+        columns = ('ts',) + tuple(columns or COLUMNS[kind][1:])
+        archived = self.read(kind, key, start, end)
+        live = {row[0] for row in rows}
+        keep = ~np.isin(archived['ts'], np.fromiter(live, dtype=np.int64, count=len(live)))
+        merged = list(zip(*[self._values(name, archived[name][keep]) for name in columns]))
+        merged.extend(tuple(row) for row in rows)
+        merged.sort(key=lambda row: row[0])
+        return merged
+
+    def page(self, kind, key, before=None, limit=100, columns=None, after=None):
+        """Up to `limit` rows (ts, seq or -1, *columns) of a series, newest first.
+
+        Only rows ordered before the `before` (ts, seq) position and not older than
+        `after` are returned; month blocks are read newest first until the page is full.
+        """
+        columns = tuple(columns or COLUMNS[kind][1:])
+        found = []
+        for month in reversed(self.months(kind, key)):
+            low, high = month_bounds(month)
+            if before is not None and low > before[0]:
+                continue
+            if len(found) >= limit or (after is not None and high <= after):
+                break
+            block = self.read_block(kind, key, month)
+            seq = np.nan_to_num(block['seq'], nan=-1).astype(np.int64)
+            selected = np.ones(len(block['ts']), dtype=bool)
+            if before is not None:
+                selected &= (block['ts'] < before[0]) | ((block['ts'] == before[0]) & (seq < before[1]))
+            if after is not None:
+                selected &= block['ts'] >= after
+            order = np.lexsort((seq, block['ts']))[::-1]
+            order = order[selected[order]][:limit - len(found)]
+            found.extend(zip(block['ts'][order].tolist(), seq[order].tolist(),
+                             *[self._values(name, block[name][order]) for name in columns]))
+        return found
+
+    @staticmethod
+    def _values(name, values):
+        """Python values of a decoded column, NaN and '' back to None"""
+        if name == 'ts':
+            return values.tolist()
+        if name in TEXT_COLUMNS:
+            return [value or None for value in values.tolist()]
+        if name == 'seq':
+            return [None if value != value else int(value) for value in values.tolist()]
+        return [None if value != value else value for value in values.tolist()]
@@ -0,0 +1,77 @@
+"""
+In-memory cache of device API key lookups used on the ingestion path
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class ApiKeyCache:
+    """LRU cache mapping an API key to its owner, with entries expiring after `ttl` seconds.
+
+    Unknown keys are never cached, so a flood of invalid keys cannot evict valid ones.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def get(self, api_key):
+        """Return the cached value for a key, or None on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(api_key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[api_key]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(api_key)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, api_key, value):
+        with self._lock:
+            self._entries[api_key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(api_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def lookup(self, api_key, loader):
+        """Return the value for a key, calling `loader(api_key)` and caching its result on a miss"""
+        value = self.get(api_key)
+        if value is None:
+            value = loader(api_key)
+            if value is not None:
+                self.put(api_key, value)
+        return value
+
+    def invalidate(self, api_key):
+        if not api_key:
+            return
+        with self._lock:
+            if self._entries.pop(api_key, None) is not None:
+                self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'invalidations': self._invalidations,
+                'hit_rate': self._hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,147 @@
+"""
+Asynchronous mirroring of device readings into the legacy climate table.
+
+Device readings are written once, to the `reading` table of the application
+database. This job copies them into the `climate` table of climate_data.db
+afterwards, so that the dashboard, the CSV export and the analysis scripts
+keep working without a second write on the ingestion path.
+"""
+import atexit
+import logging
+import sqlite3
+import threading
+
+from db_pool import apply_pragmas, pragmas_from_env
+from rollups import catch_up
+from versions import bump
+
+logger = logging.getLogger(__name__)
+
+# Legacy climate rows carry a GDD value; device readings do not, so it is derived
+# from the temperature with the usual 10°C base.
+GDD_BASE_TEMPERATURE = 10
+
+
+class ClimateMirror:
+    """Copies new `reading` rows into `climate`, tracking progress with a watermark"""
+
+    def __init__(self, database, source_database, interval=5, batch_size=5000, pragmas=None, feed=None):
+        self.database = database
+        self.source_database = source_database
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pragmas = pragmas if pragmas is not None else pragmas_from_env()
+        # LiveFeed whose city streams are told about the mirrored rows
+        self.feed = feed
+        self._conn = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'runs': 0, 'rows_mirrored': 0, 'errors': 0}
+
+    def start(self):
+        """Start the background thread (no-op if it is already running)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='climate-mirror', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def notify(self):
+        """Ask for a mirroring pass without waiting for the next interval"""
+        self.start()
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, interval=self.interval)
+
+    def run_once(self):
+        """Mirror everything written since the last pass and return the number of rows copied"""
+        conn = self.setup()
+        total = 0
+        while True:
+            last_id = conn.execute("SELECT last_reading_id FROM climate_mirror_state WHERE id = 1").fetchone()[0]
+            upper_id = conn.execute('''
+                SELECT MAX(id) FROM (
+                    SELECT id FROM source.reading WHERE id > ? ORDER BY id LIMIT ?
+                )
+            ''', (last_id, self.batch_size)).fetchone()[0]
+            if upper_id is None:
+                break
+            # Rows and watermark move together, so a crash never mirrors a reading twice
+            with conn:
+                cursor = conn.execute('''
+                    INSERT INTO climate_samples (ts, temperature, humidity, gdd, city)
+                    SELECT r.timestamp, r.temperature, r.humidity, MAX(0, r.temperature - ?),
+                           COALESCE(d.location, 'N/A')
+                    FROM source.reading r
+                    JOIN source.device d ON d.id = r.device_id
+                    WHERE r.id > ? AND r.id <= ?
+                    ORDER BY r.id
+                ''', (GDD_BASE_TEMPERATURE, last_id, upper_id))
+                conn.execute("UPDATE climate_mirror_state SET last_reading_id = ? WHERE id = 1", (upper_id,))
+                catch_up(conn)
+                cities = [city for (city,) in conn.execute('''
+                    SELECT DISTINCT COALESCE(d.location, 'N/A')
+                    FROM source.reading r
+                    JOIN source.device d ON d.id = r.device_id
+                    WHERE r.id > ? AND r.id <= ?
+                ''', (last_id, upper_id))]
+                bump(conn, 'city', cities)
+            if self.feed is not None:
+                self.feed.notify('city', cities)
+            total += cursor.rowcount
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['rows_mirrored'] += total
+        return total
+
+    def setup(self):
+        """Open the mirror connection and record the starting watermark.
+
+        Must run before the first reading is written through the single write path,
+        otherwise that reading would be taken as already mirrored.
+        """
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.database, check_same_thread=False)
+                apply_pragmas(conn, self.pragmas)
+                conn.execute("ATTACH DATABASE ? AS source", (self.source_database,))
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS climate_mirror_state (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        last_reading_id INTEGER NOT NULL
+                    )
+                ''')
+                # Readings stored before mirroring existed were already written to climate directly
+                conn.execute('''
+                    INSERT OR IGNORE INTO climate_mirror_state (id, last_reading_id)
+                    SELECT 1, COALESCE(MAX(id), 0) FROM source.reading
+                ''')
+                conn.commit()
+                self._conn = conn
+            return self._conn
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            # A last pass is made after stop() so nothing already written is left behind
+            stopping = self._stopping.is_set()
+            try:
+                self.run_once()
+            except sqlite3.Error:
+                logger.exception("Mirroring readings into the climate table failed")
+                with self._lock:
+                    self._stats['errors'] += 1
+            if stopping:
+                return
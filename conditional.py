@@ -0,0 +1,27 @@
+"""
+Conditional GET for the polling endpoints: ETag and Last-Modified derived from
+the change counters of versions.py, and 304 answers computed before any query
+of the series.
+"""
+from datetime import datetime, timezone
+
+from flask import Response, request
+
+
+def not_modified(tag, updated_at=None):
+    """A 304 response if the client already has this version of the resource, None otherwise"""
+    if request.if_none_match:
+        fresh = tag in request.if_none_match
+    else:
+        fresh = (updated_at is not None and request.if_modified_since is not None
+                 and request.if_modified_since >= datetime.fromtimestamp(updated_at, timezone.utc))
+    return with_validators(Response(status=304), tag, updated_at) if fresh else None
+
+
+def with_validators(response, tag, updated_at=None):
+    """Add the ETag (and Last-Modified) of a version to a response clients must revalidate"""
+    response.set_etag(tag)
+    if updated_at is not None:
+        response.last_modified = datetime.fromtimestamp(updated_at, timezone.utc)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
@@ -0,0 +1,122 @@
+"""
+Pool of long-lived, tuned SQLite connections.
+
+get_db_connection() used to open a new sqlite3 connection for every request.
+The pool keeps connections open between requests, configures them once
+(WAL journal, synchronous, cache and mmap sizes, busy timeout) and lets
+sqlite3 keep their compiled statements cached.
+"""
+import os
+import queue
+import sqlite3
+import threading
+
+
+def pragmas_from_env():
+    """Connection pragmas, overridable through SQLITE_* environment variables"""
+    return {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        # Negative values are expressed in KiB
+        'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -20000)),
+        'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+        'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'MEMORY'),
+    }
+
+
+def apply_pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to its pool instead of closing it"""
+
+    def close(self):
+        pool = getattr(self, 'pool', None)
+        if pool is None:
+            super().close()
+        else:
+            pool.release(self)
+
+    def close_for_real(self):
+        super().close()
+
+
+class ConnectionPool:
+    """Bounded LIFO pool of connections to one database file.
+
+    Up to `size` idle connections are kept; connections checked out beyond that
+    are opened on demand and closed when released.
+    """
+
+    def __init__(self, database, size=8, pragmas=None, cached_statements=256, row_factory=sqlite3.Row):
+        self.database = database
+        self.size = size
+        self.pragmas = pragmas if pragmas is not None else pragmas_from_env()
+        self.cached_statements = cached_statements
+        self.row_factory = row_factory
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._stats = {'opened': 0, 'closed': 0, 'checkouts': 0, 'reused': 0, 'in_use': 0}
+
+    def connect(self):
+        """Check out a connection; calling close() on it returns it to the pool"""
+        try:
+            conn = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = self._open()
+            reused = False
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            if reused:
+                self._stats['reused'] += 1
+        conn.checked_out = True
+        return conn
+
+    def release(self, conn):
+        if not conn.checked_out:
+            return
+        conn.checked_out = False
+        with self._lock:
+            self._stats['in_use'] -= 1
+        # Never hand out a connection with a transaction left open by its previous user
+        if conn.in_transaction:
+            conn.rollback()
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            self._discard(conn)
+
+    def close_all(self):
+        """Close every idle connection (connections in use are closed when released)"""
+        self.size = 0
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=self._idle.qsize(), size=self.size, database=self.database)
+
+    def _open(self):
+        conn = sqlite3.connect(self.database, factory=PooledConnection, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        apply_pragmas(conn, self.pragmas)
+        conn.row_factory = self.row_factory
+        conn.pool = self
+        conn.checked_out = False
+        with self._lock:
+            self._stats['opened'] += 1
+        return conn
+
+    def _discard(self, conn):
+        conn.close_for_real()
+        with self._lock:
+            self._stats['closed'] += 1
@@ -0,0 +1,85 @@
+"""
+Duplicate suppression for device readings.
+
+Devices retry after a timeout without knowing whether the first attempt was
+stored. A reading is identified by (device_id, timestamp[, seq]): a unique
+index rejects duplicates in the database, and a bounded in-memory filter of
+recently ingested keys rejects most of them before they cost a round trip.
+
+Only a timestamp or a seq sent by the device identifies a retry: a reading sent
+with neither is stamped by the server (see server_stamp) and never merged with
+another one.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_stamp_lock = threading.Lock()
+_last_stamp = 0
+
+
+def reading_key(device_id, timestamp, seq=None):
+    return (device_id, str(timestamp), seq)
+
+
+def server_stamp():
+    """(epoch seconds, seq) of a reading sent without a timestamp nor a seq.
+
+    Its arrival microsecond becomes its seq, strictly increasing within the process,
+    so that two readings received in the same second are both stored.
+    """
+    global _last_stamp
+    with _stamp_lock:
+        _last_stamp = max(time.time_ns() // 1000, _last_stamp + 1)
+        stamp = _last_stamp
+    return stamp // 1000000, stamp % 1000000
+
+
+def ensure_unique_readings(conn, table='readings', with_seq=True):
+    """Add the seq column and the unique index to a readings table, dropping existing duplicates first"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if with_seq and 'seq' not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN seq INTEGER")
+
+    index = f"ux_{table}_device_timestamp"
+    key = "device_id, timestamp, IFNULL(seq, -1)" if with_seq else "device_id, timestamp"
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index,)).fetchone()
+    if not exists:
+        # Keep the first copy of every reading stored more than once
+        conn.execute(f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {key})")
+        conn.execute(f"CREATE UNIQUE INDEX {index} ON {table} ({key})")
+
+
+class RecentKeyFilter:
+    """Bounded set of the most recently ingested reading keys, oldest evicted first"""
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._duplicates = 0
+
+    def claim(self, keys):
+        """Record keys as ingested; return for each one whether it was new"""
+        flags = []
+        with self._lock:
+            for key in keys:
+                if key in self._keys:
+                    self._duplicates += 1
+                    flags.append(False)
+                    continue
+                self._keys[key] = None
+                flags.append(True)
+            while len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+        return flags
+
+    def release(self, keys):
+        """Forget keys whose readings could not be stored, so that a retry is accepted"""
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._keys), 'capacity': self.capacity, 'duplicates': self._duplicates}
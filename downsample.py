@@ -0,0 +1,45 @@
+"""
+Server-side downsampling of the series sent to the charts.
+
+Largest-Triangle-Three-Buckets (Steinarsson, 2013) keeps the first and last
+points, splits the others into equal buckets and keeps, in each bucket, the
+point forming the largest triangle with the point kept in the previous bucket
+and the average of the next bucket. Peaks and troughs survive, so a chart of a
+few hundred points looks like the chart of all of them.
+"""
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """Indexes of the `threshold` points of (x, y) kept by LTTB, in order; x must be sorted"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # threshold - 2 buckets between the first and the last point
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_start, next_stop = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        next_x, next_y = x[next_start:next_stop].mean(), y[next_start:next_stop].mean()
+        # Twice the area of the triangles (previous point, candidate, next bucket average)
+        areas = np.abs((x[previous] - next_x) * (y[start:stop] - y[previous])
+                       - (x[previous] - x[start:stop]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+def downsample(ts, values, max_points):
+    """(timestamps, values) of at most `max_points` points of a series, NULL values left out"""
+    ts = np.asarray(ts, dtype=np.int64)
+    values = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    present = ~np.isnan(values)
+    ts, values = ts[present], values[present]
+    kept = lttb(ts, values, max_points)
+    return ts[kept].tolist(), values[kept].tolist()
@@ -0,0 +1,88 @@
+"""
+Integer epoch timestamps.
+
+Readings and climate rows store their time as integer seconds since the epoch
+(UTC) in a `ts` column, so that time windows are plain integer range scans on
+an index. The helpers below convert to and from the naive local datetimes and
+'YYYY-MM-DD HH:MM:SS' strings used everywhere else in the code.
+"""
+import math
+import time
+from datetime import date, datetime, timedelta
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Plausible time of a device reading: up to a year back (late uploads, backfills)
+# and a day ahead (clock skew), so that a wrong device clock cannot create partitions
+READING_MAX_AGE = 366 * 86400
+READING_MAX_AHEAD = 86400
+# Epoch seconds of 0001-01-01 and 9999-12-31 23:59:59 UTC, the range of a datetime
+EPOCH_MIN = -62135596800
+EPOCH_MAX = 253402300799
+
+# SQL expressions rendering an epoch column the way the former TEXT columns read
+LOCAL_DATETIME_SQL = "datetime({0}, 'unixepoch', 'localtime')"
+LOCAL_DATE_SQL = "date({0}, 'unixepoch', 'localtime')"
+LOCAL_TIME_SQL = "time({0}, 'unixepoch', 'localtime')"
+# ...and parsing local date/time text into epoch seconds, NULL when it cannot be parsed
+TEXT_TO_EPOCH_SQL = "CAST(strftime('%s', {0}, 'utc') AS INTEGER)"
+
+
+def text_to_epoch(expression):
+    """SQL converting a legacy local date/time text (or an epoch already) to epoch seconds"""
+    return (f"CASE WHEN typeof({expression}) = 'integer' THEN {expression} "
+            f"ELSE {TEXT_TO_EPOCH_SQL.format(expression)} END")
+
+
+def to_epoch(value):
+    """Epoch seconds of an int, a naive local datetime or date, or a timestamp string.
+
+    Raises TypeError or ValueError (also for NaN, infinite or out of range values).
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise TypeError("Not a timestamp")
+    try:
+        if isinstance(value, (int, float)):
+            if not math.isfinite(value):
+                raise ValueError("Not a finite timestamp")
+            if not EPOCH_MIN <= value <= EPOCH_MAX:
+                raise ValueError("Timestamp out of range")
+            return int(value)
+        if isinstance(value, datetime):
+            return int(value.timestamp())
+        if isinstance(value, date):
+            return int(datetime(value.year, value.month, value.day).timestamp())
+        return int(datetime.fromisoformat(str(value).strip()).timestamp())
+    except (OverflowError, OSError):
+        raise ValueError("Timestamp out of range")
+
+
+def check_reading_time(ts, now=None):
+    """Return the epoch seconds of a reading, or raise ValueError if they are outside the plausible window"""
+    now = time.time() if now is None else now
+    if not now - READING_MAX_AGE <= ts <= now + READING_MAX_AHEAD:
+        raise ValueError("Reading timestamp out of range")
+    return ts
+
+
+def from_epoch(ts):
+    """Naive local datetime of epoch seconds"""
+    return None if ts is None else datetime.fromtimestamp(ts)
+
+
+def format_epoch(ts, fmt=TIMESTAMP_FORMAT):
+    return None if ts is None else datetime.fromtimestamp(ts).strftime(fmt)
+
+
+def day_bounds(day):
+    """[start, end) epoch seconds of a local calendar day given as a date or 'YYYY-MM-DD'"""
+    if not isinstance(day, date):
+        day = date.fromisoformat(day)
+    start = datetime(day.year, day.month, day.day)
+    return to_epoch(start), to_epoch(start + timedelta(days=1))
+
+
+def today_bounds():
+    return day_bounds(date.today())
@@ -46,6 +46,9 @@ const char* apiKey = "your_api_key_here";
 #define DHTTYPE DHT22  // DHT 22 (or DHT11)
 DHT dht(DHTPIN, DHTTYPE);
 
+// Payload format: 0 = JSON, 1 = compact binary (8 bytes per reading, no JSON parsing on the server)
+#define USE_BINARY_PAYLOAD 0
+
 // Timing
 const unsigned long INTERVAL = 300000;  // 5 minutes in milliseconds
 unsigned long previousMillis = 0;
@@ -104,7 +107,11 @@ void loop() {
       Serial.println("%");
 
       // Send data to the API
+#if USE_BINARY_PAYLOAD
+      sendSensorDataBinary(temperature, humidity);
+#else
       sendSensorData(temperature, humidity);
+#endif
     } else {
       Serial.println("WiFi not connected");
     }
@@ -149,3 +156,50 @@ void sendSensorData(float temperature, float humidity) {
   // Free resources
   http.end();
 }
+
+/*
+ * Compact binary payload (Content-Type: application/vnd.weather-readings), little-endian:
+ *   "WD" | version (1 byte) | API key length (1 byte) | device id (4 bytes, 0 if unused)
+ *   API key bytes
+ *   epoch seconds UTC (4 bytes) | temperature x100 (int16) | humidity x100 (uint16)
+ */
+void sendSensorDataBinary(float temperature, float humidity) {
+  HTTPClient http;
+  http.begin(apiUrl);
+  http.addHeader("Content-Type", "application/vnd.weather-readings");
+
+  uint8_t keyLength = strlen(apiKey);
+  uint8_t payload[8 + 255 + 8];
+  size_t length = 0;
+
+  payload[length++] = 'W';
+  payload[length++] = 'D';
+  payload[length++] = 1;
+  payload[length++] = keyLength;
+  uint32_t deviceId = 0;
+  memcpy(payload + length, &deviceId, 4);
+  length += 4;
+  memcpy(payload + length, apiKey, keyLength);
+  length += keyLength;
+
+  uint32_t epoch = (uint32_t) time(nullptr);
+  int16_t scaledTemperature = (int16_t) lroundf(temperature * 100);
+  uint16_t scaledHumidity = (uint16_t) lroundf(humidity * 100);
+  memcpy(payload + length, &epoch, 4);
+  length += 4;
+  memcpy(payload + length, &scaledTemperature, 2);
+  length += 2;
+  memcpy(payload + length, &scaledHumidity, 2);
+  length += 2;
+
+  int httpResponseCode = http.POST(payload, length);
+
+  if (httpResponseCode == 200) {
+    Serial.println("Data sent successfully");
+  } else {
+    Serial.print("Error sending data. HTTP response code: ");
+    Serial.println(httpResponseCode);
+  }
+
+  http.end();
+}
@@ -3,7 +3,9 @@ Example script for IoT devices (Raspberry Pi, ESP8266, Arduino) to send weather
 to the Weather Dashboard API.
 
 This script simulates temperature and humidity readings and sends them to the API
-at regular intervals.
+at regular intervals. Readings that cannot be sent while the server is unreachable
+are spooled to a local file and uploaded later in gzip-compressed batches, with an
+exponential backoff between attempts.
 
 Usage:
 1. Set the API_KEY variable to your device's API key
@@ -15,7 +17,11 @@ Requirements:
 """
 
 import requests
+import gzip
+import json
+import os
 import random
+import struct
 import time
 from datetime import datetime
 
@@ -23,6 +29,21 @@ from datetime import datetime
 API_KEY = "your_api_key_here"
 API_URL = "http://localhost:5000/api/data"
 INTERVAL = 300  # Send data every 5 minutes (300 seconds)
+PAYLOAD_FORMAT = "json"  # "json" or "binary" (8 bytes per reading instead of ~100)
+
+# Offline spool: readings not yet accepted by the server, one JSON object per line
+SPOOL_FILE = "readings_spool.jsonl"
+SPOOL_OFFSET_FILE = SPOOL_FILE + ".offset"  # Bytes of the spool already uploaded
+UPLOAD_BATCH_SIZE = 500  # Readings per batch request (the server accepts up to 1000)
+COMPRESS_UPLOADS = True  # gzip batch bodies; turned off automatically if the server refuses them
+BACKOFF_BASE = 5  # Seconds before the first retry, doubled after each failed attempt
+BACKOFF_MAX = 600
+REQUEST_TIMEOUT = 10
+
+BINARY_CONTENT_TYPE = "application/vnd.weather-readings"
+
+# One session for the life of the script, so the TCP connection is reused between requests
+session = requests.Session()
 
 def simulate_sensor_readings():
     """
@@ -34,33 +55,136 @@ def simulate_sensor_readings():
     
     return temperature, humidity
 
-def send_data_to_api(temperature, humidity):
+def encode_binary_payload(temperature, humidity):
     """
-    Send the sensor data to the Weather Dashboard API
+    Pack a reading in the server's compact binary format:
+    header (magic, version, key length, device id), API key, then
+    epoch seconds, temperature and humidity in hundredths
+    """
+    key = API_KEY.encode('ascii')
+    header = struct.pack('<2sBBI', b'WD', 1, len(key), 0)
+    record = struct.pack('<IhH', int(time.time()), round(temperature * 100), round(humidity * 100))
+    return header + key + record
+
+def retry_after(response):
+    """Seconds the server asked us to wait (Retry-After header), if any"""
+    try:
+        return int(response.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0
+
+def send_data_to_api(reading):
+    """
+    Send one reading to the Weather Dashboard API.
+    Returns (sent, seconds to wait before retrying).
     """
-    # Prepare the data payload
-    data = {
-        "api_key": API_KEY,
-        "temperature": temperature,
-        "humidity": humidity,
-        "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    }
-    
     try:
         # Send the data via POST request
-        response = requests.post(API_URL, json=data)
+        if PAYLOAD_FORMAT == "binary":
+            response = session.post(API_URL, data=encode_binary_payload(reading["temperature"], reading["humidity"]),
+                                    headers={"Content-Type": BINARY_CONTENT_TYPE}, timeout=REQUEST_TIMEOUT)
+        else:
+            response = session.post(API_URL, json=dict(reading, api_key=API_KEY), timeout=REQUEST_TIMEOUT)
         
         # Check if request was successful
         if response.status_code == 200:
-            print(f"✅ Data sent successfully: Temp={temperature}°C, Humidity={humidity}%")
-            return True
+            print(f"✅ Data sent successfully: Temp={reading['temperature']}°C, Humidity={reading['humidity']}%")
+            return True, 0
         else:
             print(f"❌ Failed to send data: {response.status_code} - {response.text}")
-            return False
+            return False, retry_after(response)
     
     except Exception as e:
         print(f"❌ Error sending data: {str(e)}")
-        return False
+        return False, 0
+
+def spool_reading(reading):
+    """Append a reading to the offline spool"""
+    with open(SPOOL_FILE, "a") as f:
+        f.write(json.dumps(reading) + "\n")
+
+def load_spool_offset():
+    try:
+        with open(SPOOL_OFFSET_FILE) as f:
+            return int(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def save_spool_offset(offset):
+    if offset >= os.path.getsize(SPOOL_FILE):
+        # Everything was uploaded: start again from an empty spool
+        os.remove(SPOOL_FILE)
+        if os.path.exists(SPOOL_OFFSET_FILE):
+            os.remove(SPOOL_OFFSET_FILE)
+        return
+    with open(SPOOL_OFFSET_FILE, "w") as f:
+        f.write(str(offset))
+
+def spool_pending():
+    return os.path.exists(SPOOL_FILE) and os.path.getsize(SPOOL_FILE) > load_spool_offset()
+
+def read_spool_batch(offset):
+    """Return up to UPLOAD_BATCH_SIZE spooled readings from `offset`, and the offset after them"""
+    readings = []
+    with open(SPOOL_FILE, "rb") as f:
+        f.seek(offset)
+        while len(readings) < UPLOAD_BATCH_SIZE:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break  # End of file, or a line cut short by a power loss
+            offset += len(line)
+            try:
+                readings.append(json.loads(line))
+            except ValueError:
+                pass
+    return readings, offset
+
+def upload_spool():
+    """
+    Upload the spooled readings in batches.
+    Returns (all uploaded, seconds to wait before retrying).
+    """
+    global COMPRESS_UPLOADS
+    batch_url = API_URL.rstrip("/") + "/batch"
+    offset = load_spool_offset()
+    while True:
+        readings, next_offset = read_spool_batch(offset)
+        if not readings:
+            # Only a line cut short by a power loss can be left: drop it with the rest of the spool
+            save_spool_offset(os.path.getsize(SPOOL_FILE))
+            return True, 0
+        
+        body = json.dumps({"api_key": API_KEY, "readings": readings}).encode()
+        headers = {"Content-Type": "application/json"}
+        if COMPRESS_UPLOADS:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        try:
+            response = session.post(batch_url, data=body, headers=headers, timeout=REQUEST_TIMEOUT)
+        except Exception as e:
+            print(f"❌ Error uploading spooled data: {str(e)}")
+            return False, 0
+        
+        if response.status_code in (400, 415) and COMPRESS_UPLOADS:
+            # Servers that do not decode gzip bodies answer 415, or 400 for an unreadable body
+            print("ℹ️ Server does not accept compressed uploads, sending them uncompressed")
+            COMPRESS_UPLOADS = False
+            continue
+        if response.status_code == 400:
+            # Retrying a malformed batch would block the spool forever
+            print(f"⚠️ Dropping {len(readings)} spooled readings rejected by the server: {response.text}")
+        elif response.status_code != 200:
+            print(f"❌ Failed to upload spooled data: {response.status_code} - {response.text}")
+            return False, retry_after(response)
+        else:
+            print(f"✅ Uploaded {len(readings)} spooled readings")
+        offset = next_offset
+        save_spool_offset(offset)
+
+def backoff_delay(attempt, server_delay=0):
+    """Exponential backoff with full jitter, so that a fleet coming back online does not retry in step"""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    return max(delay, server_delay)
 
 def main():
     """
@@ -70,18 +194,52 @@ def main():
     print("------------------------------------------")
     print(f"📡 API URL: {API_URL}")
     print(f"⏱️ Interval: {INTERVAL} seconds")
+    print(f"📦 Payload format: {PAYLOAD_FORMAT}")
     print("Starting data collection loop...\n")
     
+    attempt = 0
+    next_upload = 0
+    next_reading = time.monotonic()
+    seq = 0
     while True:
-        # Get sensor readings
-        temperature, humidity = simulate_sensor_readings()
+        if time.monotonic() >= next_reading:
+            next_reading += INTERVAL
+            # Get sensor readings
+            temperature, humidity = simulate_sensor_readings()
+            reading = {
+                "temperature": temperature,
+                "humidity": humidity,
+                "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "seq": seq  # Lets the server recognise a reading sent twice
+            }
+            seq += 1
+            
+            if spool_pending():
+                # Keep the readings in order behind those still waiting in the spool
+                spool_reading(reading)
+            else:
+                # Send data to the API
+                sent, server_delay = send_data_to_api(reading)
+                if not sent:
+                    spool_reading(reading)
+                    next_upload = time.monotonic() + backoff_delay(attempt, server_delay)
+                    attempt += 1
         
-        # Send data to the API
-        send_data_to_api(temperature, humidity)
+        if spool_pending() and time.monotonic() >= next_upload:
+            uploaded, server_delay = upload_spool()
+            if uploaded:
+                attempt = 0
+            else:
+                next_upload = time.monotonic() + backoff_delay(attempt, server_delay)
+                attempt += 1
         
-        # Wait before next reading
-        print(f"⏳ Waiting {INTERVAL} seconds until next reading...\n")
-        time.sleep(INTERVAL)
+        # Wait before next reading, or the next upload attempt if it comes first
+        wake_at = next_reading
+        if spool_pending():
+            wake_at = min(wake_at, next_upload)
+        delay = max(0, wake_at - time.monotonic())
+        print(f"⏳ Waiting {delay:.0f} seconds...\n")
+        time.sleep(delay)
 
 if __name__ == "__main__":
     main()
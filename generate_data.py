@@ -1,14 +1,16 @@
 """
 Script de génération de données météorologiques simulées pour tester le tableau de bord
 """
-import sqlite3
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import random
 import os
-from models import db, User, Device, Reading
-from app import app
+from models import db, User, Device
+from app import app, reading_store
+from epoch import to_epoch
+from migrations import CLIMATE_MIGRATIONS
+from storage import ReadingStore, connector
 
 # Paramètres de simulation
 CITIES = ["Paris", "Lyon", "Marseille", "Bordeaux", "Lille", "Strasbourg"]
@@ -122,47 +124,12 @@ def generate_weather_data():
 
 def save_to_db(data):
     """Sauvegarde les données dans la base de données SQLite"""
-    # Sauvegarde dans la table 'climate' pour la compatibilité
-    conn = sqlite3.connect('climate_data.db')
-    cursor = conn.cursor()
-    
-    # Créer la table si elle n'existe pas
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS climate (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            time TEXT,
-            temperature REAL,
-            humidity REAL,
-            gdd REAL,
-            city TEXT,
-            pressure REAL,
-            rainfall REAL,
-            wind_speed REAL,
-            wind_direction TEXT
-        )
-    ''')
-    
-    # Insertion des données
-    for item in data:
-        cursor.execute('''
-            INSERT INTO climate (date, time, temperature, humidity, gdd, city, pressure, rainfall, wind_speed, wind_direction)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            item['date'], 
-            item['time'], 
-            item['temperature'], 
-            item['humidity'], 
-            item['gdd'], 
-            item['city'],
-            item.get('pressure', None),
-            item.get('rainfall', None),
-            item.get('wind_speed', None),
-            item.get('wind_direction', None)
-        ))
-    
-    conn.commit()
-    conn.close()
+    # Sauvegarde des relevés par ville de climate_data.db
+    climate_store = ReadingStore('city', connector('climate_data.db', migrations=CLIMATE_MIGRATIONS))
+    climate_store.insert_batch([
+        (to_epoch(item['timestamp']), item['temperature'], item['humidity'], item['gdd'], item['city'])
+        for item in data
+    ])
     print(f"Données sauvegardées dans la table 'climate' ({len(data)} entrées)")
 
 def save_to_flask_db(data):
@@ -194,30 +161,22 @@ def save_to_flask_db(data):
                 db.session.commit()
             city_devices[city] = device
         
-        # Insertion des données de lecture
-        readings_count = 0
-        for item in data:
-            city = item['city']
-            if city in city_devices:
-                reading = Reading(
-                    timestamp=item['timestamp'],
-                    temperature=item['temperature'],
-                    humidity=item['humidity'],
-                    pressure=item.get('pressure'),
-                    rainfall=item.get('rainfall'),
-                    wind_speed=item.get('wind_speed'),
-                    wind_direction=item.get('wind_direction'),
-                    device_id=city_devices[city].id
-                )
-                db.session.add(reading)
-                readings_count += 1
-                
-                # Commit par lots pour éviter une surcharge mémoire
-                if readings_count % 100 == 0:
-                    db.session.commit()
-        
-        # Commit final
-        db.session.commit()
+        # Insertion des données de lecture, en une seule transaction
+        readings = [
+            (
+                to_epoch(item['timestamp']),
+                item['temperature'],
+                item['humidity'],
+                item.get('pressure'),
+                item.get('rainfall'),
+                item.get('wind_speed'),
+                item.get('wind_direction'),
+                city_devices[item['city']].id,
+                None
+            )
+            for item in data if item['city'] in city_devices
+        ]
+        readings_count = reading_store.insert_batch(readings)
         print(f"Données sauvegardées dans la base Flask ({readings_count} lectures)")
 
 if __name__ == "__main__":
@@ -7,6 +7,9 @@ import random
 import numpy as np
 from datetime import datetime, timedelta
 import uuid
+from epoch import to_epoch
+from migrations import CLIMATE_MIGRATIONS, READINGS_MIGRATIONS
+from storage import ReadingStore, connector
 
 # Constantes pour la génération de données
 CITIES = ["Paris", "Lyon", "Marseille", "Bordeaux", "Lille", "Strasbourg"]
@@ -201,94 +204,51 @@ def save_to_flask_db(data):
         print(f"Appareil créé pour {city} avec ID: {device_id}")
     
     conn.commit()
+    conn.close()
     
-    # Insérer les lectures
+    # Insérer les lectures par lots
+    reading_store = ReadingStore('reading', connector(FLASK_DB, migrations=READINGS_MIGRATIONS))
     total_readings = len(data)
     print(f"Insertion de {total_readings} lectures...")
     
-    batch_size = 100
-    for i, item in enumerate(data):
-        city = item['city']
-        device_id = device_ids[city]
-        
-        cursor.execute('''
-        INSERT INTO reading (timestamp, temperature, humidity, pressure, rainfall, wind_speed, wind_direction, device_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            item['timestamp'].isoformat(),
-            item['temperature'],
-            item['humidity'],
-            item['pressure'],
-            item['rainfall'],
-            item['wind_speed'],
-            item['wind_direction'],
-            device_id
-        ))
-        
-        # Commit par lots
-        if (i + 1) % batch_size == 0:
-            conn.commit()
-            progress = (i + 1) / total_readings * 100
-            print(f"  - Progression: {progress:.1f}% ({i + 1}/{total_readings})")
+    batch_size = 1000
+    for i in range(0, total_readings, batch_size):
+        reading_store.insert_batch([
+            (
+                to_epoch(item['timestamp']),
+                item['temperature'],
+                item['humidity'],
+                item['pressure'],
+                item['rainfall'],
+                item['wind_speed'],
+                item['wind_direction'],
+                device_ids[item['city']],
+                None
+            )
+            for item in data[i:i + batch_size]
+        ])
+        done = min(i + batch_size, total_readings)
+        print(f"  - Progression: {done / total_readings * 100:.1f}% ({done}/{total_readings})")
     
-    # Commit final
-    conn.commit()
-    conn.close()
     print(f"Toutes les données ont été sauvegardées ({total_readings} lectures)")
 
 def save_to_climate_db(data):
     """Sauvegarde les données dans la base climate_data.db"""
-    conn = sqlite3.connect(CLIMATE_DB)
-    cursor = conn.cursor()
+    climate_store = ReadingStore('city', connector(CLIMATE_DB, migrations=CLIMATE_MIGRATIONS))
     
-    # Créer la table si elle n'existe pas
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS climate (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            time TEXT,
-            temperature REAL,
-            humidity REAL,
-            gdd REAL,
-            city TEXT,
-            pressure REAL,
-            rainfall REAL,
-            wind_speed REAL,
-            wind_direction TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Insertion des données
+    # Insertion des données par lots
     total_readings = len(data)
     print(f"Insertion de {total_readings} lectures dans climate_data.db...")
     
-    batch_size = 100
-    for i, item in enumerate(data):
-        cursor.execute('''
-            INSERT INTO climate (date, time, temperature, humidity, gdd, city, pressure, rainfall, wind_speed, wind_direction)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            item['date'], 
-            item['time'], 
-            item['temperature'], 
-            item['humidity'], 
-            item['gdd'], 
-            item['city'],
-            item['pressure'],
-            item['rainfall'],
-            item['wind_speed'],
-            item['wind_direction']
-        ))
-        
-        # Commit par lots
-        if (i + 1) % batch_size == 0:
-            conn.commit()
-            progress = (i + 1) / total_readings * 100
-            print(f"  - Progression: {progress:.1f}% ({i + 1}/{total_readings})")
+    batch_size = 1000
+    for i in range(0, total_readings, batch_size):
+        climate_store.insert_batch([
+            (to_epoch(item['timestamp']), item['temperature'], item['humidity'], item['gdd'], item['city'])
+            for item in data[i:i + batch_size]
+        ])
+        done = min(i + batch_size, total_readings)
+        print(f"  - Progression: {done / total_readings * 100:.1f}% ({done}/{total_readings})")
     
-    conn.commit()
-    conn.close()
     print(f"Données sauvegardées dans la table 'climate' ({total_readings} entrées)")
 
 if __name__ == "__main__":
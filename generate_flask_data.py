@@ -8,7 +8,8 @@ import numpy as np
 from datetime import datetime, timedelta
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from app import app, db, User, Device, Reading
+from app import app, db, User, Device, reading_store
+from epoch import to_epoch
 
 # Constantes pour la génération de données
 CITIES = ["Paris", "Lyon", "Marseille", "Bordeaux", "Lille", "Strasbourg"]
@@ -121,7 +122,8 @@ def save_to_flask_db(data):
     with app.app_context():
         # Supprimer les données existantes pour éviter les doublons
         print("Suppression des anciennes données...")
-        Reading.query.delete()
+        for device in Device.query.all():
+            reading_store.delete(device.id)
         Device.query.delete()
         
         # Création d'un utilisateur test s'il n'existe pas
@@ -158,29 +160,25 @@ def save_to_flask_db(data):
         total_readings = len(data)
         print(f"Insertion de {total_readings} lectures...")
         
-        batch_size = 100
-        for i, item in enumerate(data):
-            city = item['city']
-            reading = Reading(
-                timestamp=item['timestamp'],
-                temperature=item['temperature'],
-                humidity=item['humidity'],
-                pressure=item['pressure'],
-                rainfall=item['rainfall'],
-                wind_speed=item['wind_speed'],
-                wind_direction=item['wind_direction'],
-                device_id=city_devices[city].id
-            )
-            db.session.add(reading)
-            
-            # Commit par lots pour éviter une surcharge mémoire
-            if (i + 1) % batch_size == 0:
-                db.session.commit()
-                progress = (i + 1) / total_readings * 100
-                print(f"  - Progression: {progress:.1f}% ({i + 1}/{total_readings})")
+        batch_size = 1000
+        for i in range(0, total_readings, batch_size):
+            reading_store.insert_batch([
+                (
+                    to_epoch(item['timestamp']),
+                    item['temperature'],
+                    item['humidity'],
+                    item['pressure'],
+                    item['rainfall'],
+                    item['wind_speed'],
+                    item['wind_direction'],
+                    city_devices[item['city']].id,
+                    None
+                )
+                for item in data[i:i + batch_size]
+            ])
+            done = min(i + batch_size, total_readings)
+            print(f"  - Progression: {done / total_readings * 100:.1f}% ({done}/{total_readings})")
         
-        # Commit final
-        db.session.commit()
         print(f"Toutes les données ont été sauvegardées ({total_readings} lectures)")
 
 if __name__ == "__main__":
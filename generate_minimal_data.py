@@ -1,10 +1,12 @@
 """
 Script simplifié pour générer des données météorologiques uniquement dans climate_data.db
 """
-import sqlite3
 import random
 import numpy as np
 from datetime import datetime, timedelta
+from epoch import to_epoch
+from migrations import CLIMATE_MIGRATIONS
+from storage import ReadingStore, connector
 
 # Constantes pour la génération de données
 CITIES = ["Paris", "Lyon", "Marseille", "Bordeaux", "Lille", "Strasbourg"]
@@ -120,59 +122,20 @@ def generate_weather_data():
 
 def save_to_db(data):
     """Sauvegarde les données dans la base de données SQLite"""
-    conn = sqlite3.connect('climate_data.db')
-    cursor = conn.cursor()
+    climate_store = ReadingStore('city', connector('climate_data.db', migrations=CLIMATE_MIGRATIONS))
     
-    # Créer la table si elle n'existe pas
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS climate (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            time TEXT,
-            temperature REAL,
-            humidity REAL,
-            gdd REAL,
-            city TEXT,
-            pressure REAL,
-            rainfall REAL,
-            wind_speed REAL,
-            wind_direction TEXT
-        )
-    ''')
-    
-    # Nettoyage des données existantes (optionnel)
-    # cursor.execute("DELETE FROM climate")
-    # conn.commit()
-    
-    # Insertion des données
-    batch_size = 100
+    # Insertion des données par lots
+    batch_size = 1000
     total_readings = len(data)
     
-    for i, item in enumerate(data):
-        cursor.execute('''
-            INSERT INTO climate (date, time, temperature, humidity, gdd, city, pressure, rainfall, wind_speed, wind_direction)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            item['date'], 
-            item['time'], 
-            item['temperature'], 
-            item['humidity'], 
-            item['gdd'], 
-            item['city'],
-            item.get('pressure', None),
-            item.get('rainfall', None),
-            item.get('wind_speed', None),
-            item.get('wind_direction', None)
-        ))
-        
-        # Commit par lots
-        if (i + 1) % batch_size == 0:
-            conn.commit()
-            progress = (i + 1) / total_readings * 100
-            print(f"  - Progression: {progress:.1f}% ({i + 1}/{total_readings})")
+    for i in range(0, total_readings, batch_size):
+        climate_store.insert_batch([
+            (to_epoch(f"{item['date']} {item['time']}"), item['temperature'], item['humidity'], item['gdd'], item['city'])
+            for item in data[i:i + batch_size]
+        ])
+        done = min(i + batch_size, total_readings)
+        print(f"  - Progression: {done / total_readings * 100:.1f}% ({done}/{total_readings})")
     
-    conn.commit()
-    conn.close()
     print(f"Données sauvegardées dans la table 'climate' ({len(data)} entrées)")
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+"""
+Device liveness tracking.
+
+Every ingested reading refreshes an in-memory "last seen" map; a background
+thread writes the devices that changed to their last_connection column in one
+bulk UPDATE every few seconds, instead of one row update per reading.
+"""
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+STATUS_ONLINE = 'online'
+STATUS_STALE = 'stale'
+STATUS_OFFLINE = 'offline'
+
+# Devices report every 5 minutes by default: one missed report is tolerated
+ONLINE_WITHIN = 600
+OFFLINE_AFTER = 3600
+
+
+def parse_last_connection(value):
+    """Read a last_connection column value (datetime or ISO text) as a datetime"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def device_status(last_seen, now=None, online_within=ONLINE_WITHIN, offline_after=OFFLINE_AFTER):
+    """Classify a device as online, stale or offline from the time it was last heard from"""
+    if last_seen is None:
+        return STATUS_OFFLINE
+    age = ((now or datetime.now()) - last_seen).total_seconds()
+    if age <= online_within:
+        return STATUS_ONLINE
+    if age <= offline_after:
+        return STATUS_STALE
+    return STATUS_OFFLINE
+
+
+class HeartbeatTracker:
+    """Coalesces device heartbeats and hands them to `writer` every `interval` seconds.
+
+    `writer` receives a list of (device_id, last_seen) pairs to store in one transaction.
+    """
+
+    def __init__(self, writer, interval=5, online_within=ONLINE_WITHIN, offline_after=OFFLINE_AFTER):
+        self.writer = writer
+        self.interval = interval
+        self.online_within = online_within
+        self.offline_after = offline_after
+        self._seen = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stats = {'heartbeats': 0, 'flushes': 0, 'rows_updated': 0, 'errors': 0}
+
+    def touch(self, device_ids, when=None):
+        """Record that the given devices have just been heard from"""
+        when = when or datetime.now()
+        with self._lock:
+            for device_id in device_ids:
+                self._seen[device_id] = when
+                self._dirty[device_id] = when
+                self._stats['heartbeats'] += 1
+            if self._thread is None:
+                self._start()
+
+    def last_seen(self, device_id, stored=None):
+        """Most recent of the in-memory heartbeat and the stored last_connection value"""
+        stored = parse_last_connection(stored)
+        with self._lock:
+            seen = self._seen.get(device_id)
+        if seen is None or (stored is not None and stored > seen):
+            return stored
+        return seen
+
+    def status(self, device_id, stored=None, now=None):
+        return device_status(self.last_seen(device_id, stored), now, self.online_within, self.offline_after)
+
+    def flush(self):
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+        if not dirty:
+            return 0
+        try:
+            self.writer(list(dirty.items()))
+        except Exception:
+            logger.exception("Storing %d device heartbeats failed", len(dirty))
+            with self._lock:
+                self._stats['errors'] += 1
+                # Keep them for the next attempt unless a newer heartbeat arrived meanwhile
+                for device_id, when in dirty.items():
+                    self._dirty.setdefault(device_id, when)
+            return 0
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._stats['rows_updated'] += len(dirty)
+        return len(dirty)
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, tracked_devices=len(self._seen), pending=len(self._dirty),
+                        interval=self.interval)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='heartbeat-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.flush()
@@ -0,0 +1,141 @@
+"""
+Helpers shared by the device ingestion routes (/api/data, /api/data/batch)
+"""
+import math
+from datetime import datetime
+
+from epoch import TIMESTAMP_FORMAT, check_reading_time, to_epoch
+from partitions import reading_partitions
+
+# Largest number of readings accepted in a single batch request
+MAX_BATCH_SIZE = 1000
+
+# SQLite refuses statements with more than 999 bound parameters on older builds
+SQLITE_MAX_VARIABLES = 999
+
+
+def extract_batch(data):
+    """Return the list of readings carried by a batch body, or None if there is none.
+
+    Both a bare JSON array and an object of the form {"readings": [...]} are accepted.
+    """
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict) and isinstance(data.get('readings'), list):
+        return data['readings']
+    return None
+
+
+class InvalidField(ValueError):
+    """Raised for a field of a reading that does not hold a usable value"""
+
+    def __init__(self, field):
+        super().__init__(f"Invalid value for {field}")
+        self.field = field
+
+
+def reading_values(item, fields):
+    """The measurements `fields` of a reading as finite floats (None when absent).
+
+    Numbers sent as strings are accepted; raises InvalidField for anything else.
+    """
+    values = []
+    for field in fields:
+        value = item.get(field)
+        if value is not None:
+            try:
+                if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+                    raise ValueError(value)
+                value = float(value)
+                if not math.isfinite(value):
+                    raise ValueError(value)
+            except (OverflowError, ValueError):
+                raise InvalidField(field)
+        values.append(value)
+    return values
+
+
+def reading_seq(value):
+    """A device sequence number as an int (None when absent); raises InvalidField otherwise"""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError(value)
+        value = int(value)
+    except ValueError:
+        raise InvalidField('seq')
+    # SQLite integers are 64-bit
+    if not -2 ** 63 <= value < 2 ** 63:
+        raise InvalidField('seq')
+    return value
+
+
+def missing_fields(item, required_fields):
+    """List the required fields absent from a reading"""
+    return [field for field in required_fields if item.get(field) is None]
+
+
+def parse_timestamp(value, default=None):
+    """Parse a device timestamp, falling back to `default` (or now) when absent.
+
+    Raises ValueError outside the plausible window of a reading (see check_reading_time).
+    """
+    if not value:
+        return default or datetime.now()
+    timestamp = datetime.strptime(value, TIMESTAMP_FORMAT)
+    check_reading_time(to_epoch(timestamp))
+    return timestamp
+
+
+def lookup_devices_by_key(cursor, api_keys):
+    """Map each known API key to its (device_id, user_id, device_name, device_type) using as few queries as possible"""
+    api_keys = list(api_keys)
+    devices = {}
+    for start in range(0, len(api_keys), SQLITE_MAX_VARIABLES):
+        chunk = api_keys[start:start + SQLITE_MAX_VARIABLES]
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f"SELECT api_key, id, user_id, name, device_type FROM devices WHERE api_key IN ({placeholders})",
+                       chunk)
+        for api_key, device_id, user_id, name, device_type in cursor.fetchall():
+            devices[api_key] = (device_id, user_id, name, device_type)
+    return devices
+
+
+def insert_readings(cursor, rows):
+    """Insert (device_id, temperature, humidity, epoch seconds, seq) rows, one statement per monthly partition.
+
+    Rows already stored (same device, timestamp and seq) are silently skipped.
+    Returns the (after, ids) of ReadingPartitions.insert.
+    """
+    return reading_partitions.insert(cursor.connection, rows)
+
+
+def insert_climate(cursor, rows):
+    """Insert (epoch seconds, temperature, humidity, gdd, city) rows in one statement.
+
+    Returns (after, ids) as insert_readings: AUTOINCREMENT hands out consecutive
+    ids under the write lock, the last one being last_insert_rowid().
+    """
+    cursor.executemany('''
+        INSERT INTO climate_samples (ts, temperature, humidity, gdd, city)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    last = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+    return last - len(rows), list(range(last - len(rows) + 1, last + 1))
+
+
+def parse_device_id(value):
+    """Return a device id sent by a device as an int, or None if it is not one"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def update_last_connection(cursor, heartbeats):
+    """Store (device_id, last_seen) pairs in devices.last_connection in one statement"""
+    cursor.executemany(
+        "UPDATE devices SET last_connection = ? WHERE id = ?",
+        [(last_seen.strftime(TIMESTAMP_FORMAT), device_id) for device_id, last_seen in heartbeats]
+    )
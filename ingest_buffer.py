@@ -0,0 +1,179 @@
+"""
+Write-behind buffer for device readings.
+
+Ingestion routes hand their rows to an IngestBuffer instead of committing them
+themselves; a background thread groups everything queued in the meantime and
+passes it to a writer callable that stores it in a single transaction. When
+that transaction fails, the requests of the group are written one by one, so
+that only the request holding the bad row fails.
+"""
+import atexit
+import logging
+import math
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Acknowledge a device only once its readings are committed
+DURABILITY_FLUSH = 'flush'
+# Acknowledge a device as soon as its readings are queued
+DURABILITY_ENQUEUE = 'enqueue'
+DURABILITY_MODES = (DURABILITY_FLUSH, DURABILITY_ENQUEUE)
+
+
+class IngestError(Exception):
+    """Rows that could not be accepted for now; `retry_after` suggests, in seconds, when to send them again"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class IngestQueueFull(IngestError):
+    """Raised when the buffer already holds as many rows as it is allowed to.
+
+    `retry_after` estimates, in seconds, how long the queued rows take to drain.
+    """
+
+
+class IngestWriteFailed(IngestError):
+    """Raised to the requests whose rows could not be written, or not within the acknowledgement timeout"""
+
+
+class IngestBuffer:
+    """Bounded queue of rows flushed every `flush_rows` rows or `flush_interval_ms` milliseconds"""
+
+    def __init__(self, writer, flush_rows=500, flush_interval_ms=200, max_queue=10000,
+                 durability=DURABILITY_FLUSH, ack_timeout=30):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.writer = writer
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_queue = max_queue
+        self.durability = durability
+        self.ack_timeout = ack_timeout
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._pending_rows = 0
+        self._closed = False
+        self._thread = None
+        self._stats = {'flushes': 0, 'rows_written': 0, 'rows_rejected': 0, 'errors': 0}
+
+    def submit(self, rows):
+        """Queue rows for the next group commit and return a Future resolved once they are written"""
+        future = Future()
+        rows = list(rows)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Ingest buffer is closed")
+            if self._pending_rows + len(rows) > self.max_queue:
+                self._stats['rows_rejected'] += len(rows)
+                flushes = math.ceil(self._pending_rows / self.flush_rows)
+                raise IngestQueueFull(f"{self._pending_rows} rows already waiting to be written",
+                                      retry_after=max(1, flushes * self.flush_interval))
+            self._pending.append((rows, future))
+            self._pending_rows += len(rows)
+            if self._thread is None:
+                self._start()
+            self._cond.notify()
+        return future
+
+    def ingest(self, rows):
+        """Queue rows and wait for them to be committed when running in 'flush' durability mode"""
+        future = self.submit(rows)
+        if self.durability == DURABILITY_FLUSH:
+            try:
+                future.result(timeout=self.ack_timeout)
+            except TimeoutError:
+                raise IngestWriteFailed(f"Rows not written within {self.ack_timeout}s")
+        return future
+
+    @property
+    def pending_rows(self):
+        with self._cond:
+            return self._pending_rows
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending_rows=self._pending_rows, max_queue=self.max_queue,
+                        durability=self.durability)
+
+    def flush(self):
+        """Write everything currently queued from the calling thread"""
+        with self._cond:
+            batch = self._take_pending()
+        self._write(batch)
+
+    def close(self):
+        """Stop accepting rows and write whatever is still queued"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        # Rows queued before the worker ever started are written here
+        self.flush()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='ingest-buffer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _take_pending(self):
+        batch = self._pending
+        self._pending = []
+        self._pending_rows = 0
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                # Give other requests a chance to join this group commit
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and self._pending_rows < self.flush_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_pending()
+                closed = self._closed
+            self._write(batch)
+            if closed:
+                return
+
+    def _write(self, batch):
+        if not batch:
+            return
+        rows = [row for batch_rows, _ in batch for row in batch_rows]
+        try:
+            self.writer(rows)
+        except Exception as e:
+            if len(batch) == 1:
+                logger.exception("Writing %d rows failed", len(rows))
+                with self._cond:
+                    self._stats['errors'] += 1
+                error = IngestWriteFailed(f"Rows could not be written: {e}")
+                error.__cause__ = e
+                batch[0][1].set_exception(error)
+                return
+            logger.warning("Group commit of %d rows failed (%s), writing its %d requests one by one",
+                           len(rows), e, len(batch))
+        else:
+            with self._cond:
+                self._stats['flushes'] += 1
+                self._stats['rows_written'] += len(rows)
+            for batch_rows, future in batch:
+                future.set_result(len(batch_rows))
+            return
+        # Write each request on its own, so that a bad row only fails its own request
+        for item in batch:
+            self._write([item])
@@ -0,0 +1,263 @@
+"""
+Standalone asyncio ingestion server for devices keeping a persistent socket open.
+
+Devices send one reading per line, over TCP or in UDP datagrams:
+
+    <api_key> <epoch seconds or -> temperature=<float>,humidity=<float>[,seq=<int>]
+
+TCP clients get one "OK" or "ERR <reason>" line back per reading; UDP is fire and forget.
+The lines of one read (or one datagram) count as a single request of each device
+for the rate limits, like a batch request of the HTTP API.
+Values must be finite numbers, and epochs within a year back and a day ahead of now.
+Readings are authenticated against the `devices` table and stored in `readings`
+through the same write-behind buffer as the Flask routes.
+
+Usage:
+    python ingest_server.py --tcp-port 8765 --udp-port 8765
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from auth_cache import ApiKeyCache
+from db_pool import ConnectionPool
+from dedup import RecentKeyFilter, reading_key, server_stamp
+from heartbeat import HeartbeatTracker
+from epoch import check_reading_time
+from ingest import InvalidField, lookup_devices_by_key, reading_seq, reading_values, update_last_connection
+from ingest_buffer import IngestBuffer, IngestQueueFull, DURABILITY_FLUSH, DURABILITY_MODES
+from migrations import migrate
+from rate_limit import RateLimiter, rates_from_env, retry_after_header
+from storage import ReadingStore
+
+logger = logging.getLogger('ingest_server')
+
+DATABASE = "climate_data.db"
+MAX_LINE_LENGTH = 512
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class LineError(ValueError):
+    """Raised for a line that does not follow the protocol"""
+
+
+def parse_line(line):
+    """Split a protocol line into (api_key, epoch, temperature, humidity, seq)"""
+    parts = line.split()
+    if len(parts) != 3:
+        raise LineError("expected '<api_key> <epoch> <fields>'")
+    api_key, epoch, fields = parts
+    try:
+        epoch = None if epoch == '-' else check_reading_time(int(epoch))
+    except ValueError:
+        raise LineError("invalid epoch")
+
+    values = {}
+    for field in fields.split(','):
+        name, sep, value = field.partition('=')
+        if not sep:
+            raise LineError(f"malformed field {field}")
+        values[name] = value
+    for name in ('temperature', 'humidity'):
+        if name not in values:
+            raise LineError(f"missing field {name}")
+    try:
+        # Finite numbers only: nan or inf would end up in the JSON of the API
+        temperature, humidity = reading_values(values, ('temperature', 'humidity'))
+        seq = reading_seq(values.get('seq'))
+    except InvalidField as e:
+        raise LineError(f"invalid value for {e.field}")
+    if epoch is None:
+        epoch, seq = server_stamp() if seq is None else (int(time.time()), seq)
+    return api_key, epoch, temperature, humidity, seq
+
+
+class IngestServer:
+    """Parses protocol lines and hands valid readings to an IngestBuffer in batches"""
+
+    def __init__(self, database=DATABASE, flush_rows=500, flush_interval_ms=100, max_queue=10000,
+                 durability=DURABILITY_FLUSH):
+        self.pool = ConnectionPool(database)
+        self.reading_store = ReadingStore('device', self.pool.connect)
+        conn = self.pool.connect()
+        try:
+            migrate(conn)
+        finally:
+            conn.close()
+        self.recent_readings = RecentKeyFilter()
+        self.rate_limiter = RateLimiter(rates_from_env())
+        self.api_key_cache = ApiKeyCache()
+        self.buffer = IngestBuffer(self._write_readings, flush_rows=flush_rows,
+                                   flush_interval_ms=flush_interval_ms, max_queue=max_queue,
+                                   durability=durability)
+        self.heartbeats = HeartbeatTracker(self._write_heartbeats)
+        self._udp_tasks = set()
+
+    def _write_readings(self, rows):
+        self.reading_store.insert_batch(rows)
+
+    def _write_heartbeats(self, heartbeats):
+        conn = self.pool.connect()
+        try:
+            update_last_connection(conn.cursor(), heartbeats)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _load_device(self, api_key):
+        conn = self.pool.connect()
+        try:
+            return lookup_devices_by_key(conn.cursor(), [api_key]).get(api_key)
+        finally:
+            conn.close()
+
+    async def authenticate(self, api_key):
+        device = self.api_key_cache.get(api_key)
+        if device is None:
+            # Cache misses hit SQLite, which must not block the event loop
+            loop = asyncio.get_running_loop()
+            device = await loop.run_in_executor(None, self._load_device, api_key)
+            if device is not None:
+                self.api_key_cache.put(api_key, device)
+        return device
+
+    async def handle_lines(self, lines):
+        """Store the readings of a group of lines and return one reply per line"""
+        replies = []
+        rows = []
+        stored = []
+        # Like an HTTP batch, a group of lines (one read or datagram) counts as one request
+        # of every device it carries readings from: {device_id: retry_after or 0}
+        charged = {}
+        for line in lines:
+            try:
+                api_key, epoch, temperature, humidity, seq = parse_line(line)
+            except LineError as e:
+                replies.append(f"ERR {e}")
+                continue
+            device = await self.authenticate(api_key)
+            if device is None:
+                replies.append("ERR invalid api key")
+                continue
+            if device[0] not in charged:
+                charged[device[0]] = self.rate_limiter.acquire(device[0], device[3])
+            retry_after = charged[device[0]]
+            if retry_after:
+                replies.append(f"ERR rate limited, retry after {retry_after_header(retry_after)}s")
+                continue
+            row = (device[0], temperature, humidity, epoch, seq)
+            if not self.recent_readings.claim([reading_key(row[0], row[3], seq)])[0]:
+                # Already stored: acknowledge it so the device stops retrying
+                replies.append("OK duplicate")
+                continue
+            rows.append(row)
+            stored.append(len(replies))
+            replies.append("OK")
+
+        if rows:
+            error = None
+            try:
+                future = self.buffer.submit(rows)
+                if self.buffer.durability == DURABILITY_FLUSH:
+                    await asyncio.wrap_future(future)
+            except IngestQueueFull as e:
+                error = f"ERR busy, retry after {retry_after_header(e.retry_after)}s"
+            except Exception:
+                logger.exception("Storing %d readings failed", len(rows))
+                error = "ERR storage"
+            if error:
+                self.recent_readings.release([reading_key(row[0], row[3], row[4]) for row in rows])
+                for index in stored:
+                    replies[index] = error
+            else:
+                self.heartbeats.touch({row[0] for row in rows})
+        return replies
+
+    async def handle_tcp(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        logger.debug("TCP connection from %s", peer)
+        pending = b''
+        try:
+            while True:
+                chunk = await reader.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                # Every complete line already received joins the same batch
+                *lines, pending = (pending + chunk).split(b'\n')
+                if len(pending) > MAX_LINE_LENGTH:
+                    writer.write(b"ERR line too long\n")
+                    break
+                lines = [line.decode('utf-8', 'replace').strip() for line in lines]
+                lines = [line for line in lines if line]
+                if lines:
+                    replies = await self.handle_lines(lines)
+                    writer.write(''.join(reply + '\n' for reply in replies).encode())
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            logger.debug("TCP connection from %s closed", peer)
+
+    def handle_datagram(self, data):
+        lines = [line.strip() for line in data.decode('utf-8', 'replace').splitlines()]
+        lines = [line for line in lines if line]
+        if lines:
+            task = asyncio.ensure_future(self.handle_lines(lines))
+            self._udp_tasks.add(task)
+            task.add_done_callback(self._udp_tasks.discard)
+
+    async def serve(self, host, tcp_port=None, udp_port=None):
+        loop = asyncio.get_running_loop()
+        servers = []
+        if tcp_port:
+            servers.append(await asyncio.start_server(self.handle_tcp, host, tcp_port))
+            logger.info("Listening for TCP readings on %s:%d", host, tcp_port)
+        if udp_port:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self), local_addr=(host, udp_port))
+            servers.append(transport)
+            logger.info("Listening for UDP readings on %s:%d", host, udp_port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            for server in servers:
+                server.close()
+            self.buffer.close()
+            self.heartbeats.stop()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Line-protocol ingestion server (TCP and UDP)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--tcp-port', type=int, default=8765, help="0 to disable TCP")
+    parser.add_argument('--udp-port', type=int, default=8765, help="0 to disable UDP")
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--durability', choices=DURABILITY_MODES,
+                        default=os.environ.get('INGEST_DURABILITY', DURABILITY_FLUSH))
+    parser.add_argument('--flush-rows', type=int, default=500)
+    parser.add_argument('--flush-interval-ms', type=int, default=100)
+    parser.add_argument('--max-queue', type=int, default=10000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    server = IngestServer(args.database, flush_rows=args.flush_rows, flush_interval_ms=args.flush_interval_ms,
+                          max_queue=args.max_queue, durability=args.durability)
+    try:
+        asyncio.run(server.serve(args.host, args.tcp_port, args.udp_port))
+    except KeyboardInterrupt:
+        logger.info("Stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,17 @@
 import sqlite3
-from datetime import datetime
+
+from migrations import migrate
 
 def create_tables():
+    # Tables, colonnes et index sont définis dans migrations.py
     conn = sqlite3.connect('climate_data.db')
-    cursor = conn.cursor()
-
-    # Table des données climatiques
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS climate (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            time TEXT,
-            temperature REAL,
-            humidity REAL,
-            gdd REAL,
-            city TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-
-    # Table des stations météo
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS stations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE,
-            city TEXT,
-            latitude REAL,
-            longitude REAL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-
-    conn.commit()
-    conn.close()
+    try:
+        applied = migrate(conn)
+    finally:
+        conn.close()
+    return applied
 
 if __name__ == "__main__":
-    create_tables()
+    applied = create_tables()
+    print(f"Migrations appliquées : {applied or 'aucune'}")
     print("Base de données initialisée avec succès!")
@@ -0,0 +1,175 @@
+"""
+In-memory ring buffer of the latest readings of each device, serving the device pages
+and their periodic refreshes without querying SQLite
+"""
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class LatestReadings:
+    """The `capacity` most recent rows of up to `maxsize` devices, least recently read evicted first.
+
+    A device's buffer is warmed from the database on its first read, then kept up to date
+    by add() as this process stores readings. Buffers expire `ttl` seconds after their
+    warm-up, so that rows written by another process (e.g. ingest_server.py) show up and
+    idle devices release their memory; a reader knowing the device's version (see
+    versions.py) gets them at once, as a buffer of another version is warmed again.
+
+    Rows are stored as (ts, tag, row) items: rows with the same timestamp and tag (seq)
+    are the same reading and only kept once, like the unique index of the tables.
+
+    A warm-up only holds up the readers of the same device. The query runs without the
+    cache lock; rows added meanwhile are set aside and merged when the buffer is swapped in.
+    """
+
+    def __init__(self, capacity=100, maxsize=1000, ttl=300):
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> [expiry, timestamps (oldest first), items in the same order, version]
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+        # key -> [lock, users]: one warm-up at a time per device, other devices are not held up
+        self._key_locks = {}
+        # key -> [items, version] added while the device's buffer is being warmed
+        self._warming = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _get(self, key, limit, version=None):
+        now = time.monotonic()
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer[0] <= now or (version is not None and buffer[3] != version):
+                if buffer is not None:
+                    del self._buffers[key]
+                    self._evictions += 1
+                return None
+            self._buffers.move_to_end(key)
+            items = buffer[2][-limit:] if limit else []
+            return [row for _, _, row in reversed(items)]
+
+    def latest(self, key, limit, loader, version=None):
+        """The `limit` newest rows of a device, newest first.
+
+        On a miss, `loader(capacity)` returns the newest (ts, tag, row) items of the
+        device from the database, of `version` if given. Returns None when `limit`
+        exceeds the capacity.
+        """
+        if limit > self.capacity:
+            return None
+        rows = self._get(key, limit, version)
+        if rows is not None:
+            with self._lock:
+                self._hits += 1
+            return rows
+        with self._key_lock(key):
+            rows = self._get(key, limit, version)
+            if rows is None:
+                with self._lock:
+                    self._warming[key] = [[], version]
+                try:
+                    items = loader(self.capacity)
+                except BaseException:
+                    with self._lock:
+                        self._warming.pop(key, None)
+                    raise
+                stored = self._store(key, items, version)
+                rows = self._get(key, limit)
+                if not stored:
+                    # Invalidated during the warm-up: answer from what was read, without keeping it
+                    items = sorted(items, key=lambda item: item[0])
+                    rows = [row for _, _, row in reversed(items[-limit:])] if limit else []
+        with self._lock:
+            self._misses += 1
+        return rows
+
+    @contextmanager
+    def _key_lock(self, key):
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def _store(self, key, items, version=None):
+        """Swap in the warmed buffer of a device, with the rows added during its warm-up; False if invalidated"""
+        now = time.monotonic()
+        with self._lock:
+            pending = self._warming.pop(key, None)
+            if pending is None:
+                return False
+            added, added_version = pending
+            if added_version is not None:
+                version = added_version
+            # Rows both read by the loader and added meanwhile are only kept once
+            unique = {(item[0], item[1]): item for item in list(items) + added}
+            items = sorted(unique.values(), key=lambda item: item[0])[-self.capacity:]
+            self._buffers[key] = [now + self.ttl, [item[0] for item in items], items, version]
+            self._buffers.move_to_end(key)
+            for stale in [k for k, buffer in self._buffers.items() if buffer[0] <= now]:
+                del self._buffers[stale]
+                self._evictions += 1
+            while len(self._buffers) > self.maxsize:
+                self._buffers.popitem(last=False)
+                self._evictions += 1
+        return True
+
+    def add(self, key, items, version=None):
+        """Add the (ts, tag, row) items just stored for a device, if its buffer is warm.
+
+        `version` is the device's version once they are stored.
+        """
+        with self._lock:
+            pending = self._warming.get(key)
+            if pending is not None:
+                pending[0].extend(items)
+                pending[1] = version
+                return
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                return
+            _, timestamps, stored, _ = buffer
+            buffer[3] = version
+            for ts, tag, row in items:
+                low, high = bisect_left(timestamps, ts), bisect_right(timestamps, ts)
+                if any(stored[i][1] == tag for i in range(low, high)):
+                    continue
+                timestamps.insert(high, ts)
+                stored.insert(high, (ts, tag, row))
+            # Older rows beyond the capacity can no longer be among the latest
+            del timestamps[:-self.capacity], stored[:-self.capacity]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._buffers.pop(key, None)
+            self._warming.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self._warming.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'devices': len(self._buffers),
+                'maxsize': self.maxsize,
+                'capacity': self.capacity,
+                'ttl': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': self._hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,214 @@
+"""
+Live streams (Server-Sent Events) of the readings and climate rows.
+
+ReadingStore hands the rows it has just committed to a LiveFeed, which fans
+them out to the streams open on the same series in this process: a new reading
+reaches the browsers without a query. Events are identified by the id of their
+row, which grows in insertion order (see watermarks.py): a stream resumes after
+its Last-Event-ID with ReadingStore.after, and catches up the same way on rows
+it was not handed. Each published batch says which ids it covers, so a stream
+notices the rows committed before it without being published: written by
+another process (ingest_server.py, the generators) or by the climate mirror, or
+published later by a concurrent writer. Rows of another process written while
+nothing is published are found by checking the version of the series (see
+versions.py) at each heartbeat.
+"""
+import json
+import threading
+from collections import deque
+
+from flask import Response
+
+from storage import decode_since, encode_watermark
+
+# Seconds between two heartbeats of an idle stream, below the usual proxy timeouts
+HEARTBEAT_INTERVAL = 15
+# Milliseconds the browser waits before reconnecting a closed stream
+RECONNECT_DELAY_MS = 3000
+# Rows read per query when a stream catches up
+CATCH_UP_ROWS = 500
+
+
+class Subscription:
+    """Batches of rows published on a topic and not yet sent by one stream"""
+
+    def __init__(self, feed, topic, size):
+        self.feed = feed
+        self.topic = topic
+        self.size = size
+        # (after, last, events): the events among the ids (after, last] of a committed batch
+        self._batches = deque()
+        self._queued = 0
+        # Rows were missed (queue overflow, or written without being published)
+        self._stale = False
+        self._cond = threading.Condition()
+
+    def put(self, after, last, events):
+        with self._cond:
+            if not events and self._batches and self._batches[-1][1] >= after:
+                # Nothing to send: only widen the ids known to be covered
+                previous = self._batches[-1]
+                self._batches[-1] = (previous[0], max(previous[1], last), previous[2])
+                return
+            if self._queued + len(events) + 1 > self.size:
+                # Too far behind: read what was missed from the database instead
+                self._batches.clear()
+                self._queued = 0
+                self._stale = True
+            else:
+                self._batches.append((after, last, events))
+                self._queued += len(events) + 1
+            if events or self._stale:
+                self._cond.notify()
+
+    def mark_stale(self):
+        with self._cond:
+            self._stale = True
+            self._cond.notify()
+
+    def get(self, timeout):
+        """(batches, stale) since the previous call, waiting up to `timeout` seconds for events"""
+        with self._cond:
+            self._cond.wait_for(lambda: any(batch[2] for batch in self._batches) or self._stale, timeout)
+            batches, stale = list(self._batches), self._stale
+            self._batches.clear()
+            self._queued = 0
+            self._stale = False
+            return batches, stale
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+
+class LiveFeed:
+    """In-process publish/subscribe of newly stored rows.
+
+    Topics are (kind, key) for one series and (kind, None) for every series of a
+    kind. Each subscription queues up to `queue_size` rows and batches; a stream
+    falling further behind is marked stale rather than slowing down the writers.
+    """
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._topics = {}
+        self._lock = threading.Lock()
+        self._published = 0
+        self._notified = 0
+
+    def subscribe(self, kind, key=None):
+        subscription = Subscription(self, (kind, key), self.queue_size)
+        with self._lock:
+            self._topics.setdefault(subscription.topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._topics.get(subscription.topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._topics[subscription.topic]
+
+    def _subscribers(self, kind, key):
+        return list(self._topics.get((kind, key), ())) + list(self._topics.get((kind, None), ()))
+
+    def publish(self, kind, events, after, last):
+        """Send the (key, {column: value}) rows just committed, the ids (after, last], to the streams.
+
+        Every stream of the kind gets the range of ids, those of other series too, so
+        that it can tell this batch from one it missed.
+        """
+        by_key = {}
+        for key, values in events:
+            by_key.setdefault(key, []).append(values)
+        with self._lock:
+            subscribers = [(subscription, topic[1]) for topic, subscriptions in self._topics.items()
+                           if topic[0] == kind for subscription in subscriptions]
+            self._published += len(events)
+        for subscription, key in subscribers:
+            subscription.put(after, last, [values for _, values in events] if key is None else by_key.get(key, []))
+
+    def notify(self, kind, keys):
+        """Make the streams of these series read the rows they were not handed from the database"""
+        with self._lock:
+            subscribers = [subscription for key in set(keys) for subscription in self._subscribers(kind, key)]
+            self._notified += 1
+        for subscription in subscribers:
+            subscription.mark_stale()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'topics': len(self._topics),
+                'streams': sum(len(subscribers) for subscribers in self._topics.values()),
+                'queue_size': self.queue_size,
+                'rows_published': self._published,
+                'notifications': self._notified
+            }
+
+
+def _event(row_id, data):
+    return f"id: {encode_watermark(row_id)}\ndata: {json.dumps(data)}\n\n"
+
+
+def event_stream(store, feed, key, formatter, last_event_id=None, heartbeat=HEARTBEAT_INTERVAL):
+    """Lines of an event stream of the rows stored in a series from now on (`key` None: every series).
+
+    Each event carries `formatter({column: value})` as JSON and the watermark of its
+    row as id. With `last_event_id`, or a ?since= watermark (see decode_since), the
+    rows stored after it are sent first.
+    """
+    layout = store.layout
+    columns = ('id',) + tuple(column for column in layout.columns if column != layout.ts)
+
+    # Subscribe first, so that no row falls between the catch-up query and the feed
+    subscription = feed.subscribe(layout.kind, key)
+    try:
+        version = store.version(key)[0]
+        try:
+            decode_since(last_event_id)
+            since = last_event_id or None
+        except ValueError:
+            since = None
+        stale = since is not None
+        if since is None:
+            since = store.watermark()
+        yield f"retry: {RECONNECT_DELAY_MS}\n\n"
+        while True:
+            while stale:
+                rows, since = store.after(key, since, CATCH_UP_ROWS, columns)
+                for row in rows:
+                    values = dict(zip((layout.ts,) + columns, row))
+                    yield _event(values['id'], formatter(values))
+                stale = len(rows) == CATCH_UP_ROWS
+            # Every row of the series up to this id has been sent
+            seen = decode_since(since)[0]
+            batches, stale = subscription.get(heartbeat)
+            sent = False
+            for after, last, events in [] if stale else batches:
+                if after > seen:
+                    # Rows committed before this batch were not handed to this stream
+                    stale = True
+                    break
+                for values in events:
+                    # Rows already sent by a catch-up
+                    if values['id'] > seen:
+                        sent = True
+                        yield _event(values['id'], formatter(values))
+                seen = max(seen, last)
+            since = encode_watermark(seen)
+            if stale or sent:
+                continue
+            # Nothing handed to this stream: was the series written by another process?
+            current = store.version(key)[0]
+            stale, version = current != version, current
+            if not stale:
+                yield ": heartbeat\n\n"
+    finally:
+        subscription.close()
+
+
+def event_response(events):
+    """Streaming text/event-stream response of event_stream() lines"""
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
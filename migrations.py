@@ -0,0 +1,357 @@
+"""
+Versioned schema migrations for the SQLite databases.
+
+Each database has an ordered list of (version, name, steps) migrations; a step
+is either an SQL statement or a callable taking the connection. Applied
+versions are recorded in `schema_migrations`, so `migrate()` only runs the new
+ones and is cheap enough to call at every startup.
+
+Usage:
+    python migrations.py                     # migrate climate_data.db
+    python migrations.py --explain           # and print the plan of the core queries
+"""
+import argparse
+import sqlite3
+from datetime import datetime
+
+from dedup import ensure_unique_readings
+from epoch import LOCAL_DATE_SQL, LOCAL_DATETIME_SQL, LOCAL_TIME_SQL, TEXT_TO_EPOCH_SQL, text_to_epoch
+from partitions import reading_partitions
+import rollups
+import versions
+import watermarks
+
+DATABASE = "climate_data.db"
+
+
+def add_column(table, column, definition):
+    """Migration step adding a column unless an older script already did"""
+    def step(conn):
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+CLIMATE_TEXT = "NEW.date || ' ' || COALESCE(NEW.time, '00:00:00')"
+
+
+# climate_data.db: legacy climate table plus the devices of simple_app.py
+CLIMATE_MIGRATIONS = [
+    (1, "base tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS climate (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT,
+            time TEXT,
+            temperature REAL,
+            humidity REAL,
+            gdd REAL,
+            city TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE,
+            city TEXT,
+            latitude REAL,
+            longitude REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS devices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            location TEXT,
+            api_key TEXT NOT NULL,
+            user_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS readings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER,
+            temperature REAL,
+            humidity REAL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (device_id) REFERENCES devices (id)
+        )
+        ''',
+    ]),
+    # Formerly update_db.py
+    (2, "device type and last connection", [
+        add_column('devices', 'device_type', "TEXT DEFAULT 'ESP8266'"),
+        add_column('devices', 'last_connection', 'TEXT'),
+    ]),
+    (3, "unique readings", [
+        lambda conn: ensure_unique_readings(conn, 'readings'),
+    ]),
+    # The unique index of readings, led by (device_id, timestamp), already serves
+    # "WHERE device_id = ? ORDER BY timestamp DESC"
+    (4, "hot path indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_climate_date_time ON climate (date, time)",
+        "CREATE INDEX IF NOT EXISTS idx_climate_city_date_time ON climate (city, date, time)",
+        "CREATE INDEX IF NOT EXISTS idx_devices_api_key ON devices (api_key)",
+        "CREATE INDEX IF NOT EXISTS idx_devices_user_id ON devices (user_id)",
+        "ANALYZE",
+    ]),
+    # Time is stored as integer epoch seconds (UTC) in climate_samples and reading_samples;
+    # climate and readings become views with the former TEXT columns for older readers and writers
+    (5, "epoch timestamps", [
+        '''
+        CREATE TABLE climate_samples (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            temperature REAL,
+            humidity REAL,
+            gdd REAL,
+            city TEXT
+        )
+        ''',
+        f'''
+        INSERT INTO climate_samples (id, ts, temperature, humidity, gdd, city)
+        SELECT id, ts, temperature, humidity, gdd, city FROM (
+            SELECT *, {TEXT_TO_EPOCH_SQL.format("date || ' ' || COALESCE(time, '00:00:00')")} AS ts FROM climate
+        ) WHERE ts IS NOT NULL
+        ''',
+        "DROP TABLE climate",
+        f'''
+        CREATE VIEW climate AS
+        SELECT id, {LOCAL_DATE_SQL.format('ts')} AS date, {LOCAL_TIME_SQL.format('ts')} AS time,
+               temperature, humidity, gdd, city
+        FROM climate_samples
+        ''',
+        f'''
+        CREATE TRIGGER climate_insert INSTEAD OF INSERT ON climate BEGIN
+            INSERT INTO climate_samples (id, ts, temperature, humidity, gdd, city)
+            VALUES (NEW.id, COALESCE({text_to_epoch(CLIMATE_TEXT)}, CAST(strftime('%s', 'now') AS INTEGER)),
+                    NEW.temperature, NEW.humidity, NEW.gdd, NEW.city);
+        END
+        ''',
+        '''
+        CREATE TRIGGER climate_delete INSTEAD OF DELETE ON climate BEGIN
+            DELETE FROM climate_samples WHERE id = OLD.id;
+        END
+        ''',
+        "CREATE INDEX idx_climate_samples_ts ON climate_samples (ts)",
+        "CREATE INDEX idx_climate_samples_city_ts ON climate_samples (city, ts)",
+        '''
+        CREATE TABLE reading_samples (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER,
+            temperature REAL,
+            humidity REAL,
+            ts INTEGER NOT NULL,
+            seq INTEGER,
+            FOREIGN KEY (device_id) REFERENCES devices (id)
+        )
+        ''',
+        "CREATE UNIQUE INDEX ux_reading_samples_device_ts ON reading_samples (device_id, ts, IFNULL(seq, -1))",
+        f'''
+        INSERT OR IGNORE INTO reading_samples (id, device_id, temperature, humidity, ts, seq)
+        SELECT id, device_id, temperature, humidity, ts, seq FROM (
+            SELECT *, {text_to_epoch('timestamp')} AS ts FROM readings
+        ) WHERE ts IS NOT NULL
+        ''',
+        "DROP TABLE readings",
+        f'''
+        CREATE VIEW readings AS
+        SELECT id, device_id, temperature, humidity, {LOCAL_DATETIME_SQL.format('ts')} AS timestamp, seq
+        FROM reading_samples
+        ''',
+        f'''
+        CREATE TRIGGER readings_insert INSTEAD OF INSERT ON readings BEGIN
+            INSERT INTO reading_samples (id, device_id, temperature, humidity, ts, seq)
+            VALUES (NEW.id, NEW.device_id, NEW.temperature, NEW.humidity,
+                    COALESCE({text_to_epoch('NEW.timestamp')}, CAST(strftime('%s', 'now') AS INTEGER)), NEW.seq);
+        END
+        ''',
+        '''
+        CREATE TRIGGER readings_delete INSTEAD OF DELETE ON readings BEGIN
+            DELETE FROM reading_samples WHERE id = OLD.id;
+        END
+        ''',
+        "ANALYZE",
+    ]),
+    # Device readings move to monthly reading_samples_YYYYMM tables (see partitions.py)
+    (6, "monthly reading partitions", [
+        reading_partitions.migrate_legacy,
+        "ANALYZE",
+    ]),
+    # Minute/hour/day statistics per device and per city, kept up to date by rollups.catch_up()
+    (7, "rollups", [
+        rollups.create_tables,
+        rollups.catch_up,
+    ]),
+    # Change counter per device and per city, behind the ETags of the polling endpoints
+    (8, "series versions", [
+        versions.create_table,
+        lambda conn: versions.seed(conn, 'device', "SELECT id AS key FROM devices"),
+        lambda conn: versions.seed(conn, 'city', "SELECT DISTINCT city AS key FROM climate_samples"),
+    ]),
+    # Reading ids in insertion order across the partitions, for the ?since= watermarks
+    (9, "reading ids", [
+        watermarks.create_table,
+        lambda conn: watermarks.seed(conn, 'device', ['reading_samples'] + reading_partitions.list(conn)),
+        reading_partitions.rebuild_view,
+    ]),
+    # Partitions numbered their rows from 1 each, migrated ones included
+    (10, "unique reading ids", [
+        lambda conn: watermarks.raise_to(conn, 'device', reading_partitions.renumber(conn)),
+    ]),
+]
+
+# weather_dashboard.db: tables of models.py, created by db.create_all()
+READINGS_MIGRATIONS = [
+    (1, "unique readings", [
+        lambda conn: ensure_unique_readings(conn, 'reading'),
+    ]),
+    (2, "hot path indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_device_user_id ON device (user_id)",
+        "ANALYZE",
+    ]),
+    # reading.timestamp holds epoch seconds from now on (see models.EpochDateTime)
+    (3, "epoch timestamps", [
+        "DROP INDEX IF EXISTS ux_reading_device_timestamp",
+        f"DELETE FROM reading WHERE typeof(timestamp) = 'text' AND {TEXT_TO_EPOCH_SQL.format('timestamp')} IS NULL",
+        f"UPDATE reading SET timestamp = {TEXT_TO_EPOCH_SQL.format('timestamp')} WHERE typeof(timestamp) = 'text'",
+        # Readings stored with sub-second timestamps may now collide
+        lambda conn: ensure_unique_readings(conn, 'reading'),
+    ]),
+    (4, "series versions", [
+        versions.create_table,
+        lambda conn: versions.seed(conn, 'reading', "SELECT id AS key FROM device"),
+    ]),
+    # Reading ids in insertion order, for the ?since= watermarks (see watermarks.py)
+    (5, "reading ids", [
+        watermarks.create_table,
+        lambda conn: watermarks.seed(conn, 'reading', ['reading']),
+    ]),
+]
+
+# Queries of the dashboards and of the ingestion path, with placeholder parameters
+CORE_QUERIES = {
+    'climate_today': (
+        "SELECT ts, temperature, humidity, gdd, city FROM climate_samples WHERE ts >= ? AND ts < ?",
+        (1704067200, 1704153600)),
+    'climate_station_day': (
+        "SELECT ts, temperature, humidity, gdd, city FROM climate_samples "
+        "WHERE city = ? AND ts >= ? AND ts < ? ORDER BY ts ASC",
+        ('Paris', 1704067200, 1704153600)),
+    'climate_station_month': (
+        "SELECT ts, temperature, humidity, gdd, city FROM climate_samples "
+        "WHERE city = ? AND ts >= ? AND ts < ? ORDER BY ts ASC",
+        ('Paris', 1704067200, 1706745600)),
+    # Run against each partition overlapping the range, see partitions.ReadingPartitions.select
+    'device_latest_readings': (
+        "SELECT ts, temperature, humidity FROM reading_samples WHERE device_id = ? ORDER BY ts DESC LIMIT 100",
+        (1,)),
+    'device_readings_since': (
+        "SELECT ts, temperature, humidity FROM reading_samples WHERE device_id = ? AND ts >= ? ORDER BY ts DESC",
+        (1, 1704067200)),
+    'device_series': (
+        "SELECT bucket, temperature_count, temperature_sum FROM device_rollups "
+        "WHERE device_id = ? AND granularity = ? AND bucket >= ? AND bucket < ?",
+        (1, 3600, 1704067200, 1706745600)),
+    'device_by_api_key': (
+        "SELECT api_key, id, user_id, name, device_type FROM devices WHERE api_key IN (?)", ('key',)),
+    'user_devices': (
+        "SELECT id, name, location, api_key, created_at, device_type, last_connection FROM devices WHERE user_id = ?",
+        (1,)),
+}
+
+READINGS_CORE_QUERIES = {
+    'device_latest_readings': (
+        "SELECT timestamp, temperature, humidity FROM reading WHERE device_id = ? ORDER BY timestamp DESC LIMIT 100",
+        (1,)),
+    'device_readings_since': (
+        "SELECT timestamp, temperature, humidity FROM reading WHERE device_id = ? AND timestamp >= ?",
+        (1, 1704067200)),
+    'user_devices': ("SELECT id, name, device_type, last_connection FROM device WHERE user_id = ?", (1,)),
+}
+
+
+def applied_versions(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+    return {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+
+
+def migrate(conn, migrations=CLIMATE_MIGRATIONS):
+    """Apply the migrations not recorded yet, each in its own transaction; return their versions"""
+    done = applied_versions(conn)
+    conn.commit()
+    applied = []
+    for version, name, steps in sorted(migrations, key=lambda migration: migration[0]):
+        if version in done:
+            continue
+        try:
+            # Explicit transaction, so that DDL statements are rolled back with the rest on failure
+            conn.execute("BEGIN")
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                         (version, name, datetime.now().isoformat(sep=' ', timespec='seconds')))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+def explain(conn, queries=CORE_QUERIES):
+    """Return the EXPLAIN QUERY PLAN details of each query, e.g. to spot full table scans"""
+    plans = {}
+    for name, (sql, params) in queries.items():
+        try:
+            plans[name] = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.OperationalError as e:
+            plans[name] = [f"error: {e}"]
+    return plans
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--readings', action='store_true',
+                        help="the database is app.py's weather_dashboard.db rather than climate_data.db")
+    parser.add_argument('--explain', action='store_true', help="print the query plan of the core queries")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        applied = migrate(conn, READINGS_MIGRATIONS if args.readings else CLIMATE_MIGRATIONS)
+        print(f"Applied migrations: {applied or 'none'}")
+        if args.explain:
+            for name, plan in explain(conn, READINGS_CORE_QUERIES if args.readings else CORE_QUERIES).items():
+                print(f"{name}:")
+                for detail in plan:
+                    print(f"    {detail}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,25 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy.types import Integer, TypeDecorator
+from epoch import from_epoch, to_epoch
 
 db = SQLAlchemy()
 
+class EpochDateTime(TypeDecorator):
+    """Naive local datetime stored as integer epoch seconds, so time ranges compare integers"""
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return to_epoch(value)
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, str):
+            # Row written before the epoch migration
+            return datetime.fromisoformat(value)
+        return from_epoch(value)
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(100), unique=True, nullable=False)
@@ -23,7 +40,7 @@ class Device(db.Model):
 
 class Reading(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, nullable=False)
+    timestamp = db.Column(EpochDateTime, nullable=False)
     temperature = db.Column(db.Float, nullable=True)
     humidity = db.Column(db.Float, nullable=True)
     pressure = db.Column(db.Float, nullable=True)
@@ -31,3 +48,5 @@ class Reading(db.Model):
     wind_speed = db.Column(db.Float, nullable=True)
     wind_direction = db.Column(db.String(20), nullable=True)
     device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
+    # Optional per-device sequence number; (device_id, timestamp, seq) identifies a reading
+    seq = db.Column(db.Integer, nullable=True)
@@ -0,0 +1,248 @@
+"""
+Monthly partitions of the device readings of climate_data.db.
+
+Readings live in one table per calendar month (UTC) of their timestamp,
+reading_samples_YYYYMM, each with its own unique (device_id, ts, seq) index.
+The router below sends every write to the partition of its timestamp, only
+reads the partitions overlapping a time range, and drops whole partitions
+when old data expires instead of running a large DELETE.
+
+The unpartitioned reading_samples table remains as the target of the
+`readings` compatibility view, so it is read together with the partitions.
+Ids come from the 'device' counter of watermarks.py: they are unique across
+all these tables and grow in the order readings are stored.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from epoch import LOCAL_DATETIME_SQL, check_reading_time, text_to_epoch
+import watermarks
+
+LEGACY_TABLE = 'reading_samples'
+PARTITION_PREFIX = 'reading_samples_'
+
+PARTITION_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        device_id INTEGER,
+        temperature REAL,
+        humidity REAL,
+        ts INTEGER NOT NULL,
+        seq INTEGER,
+        FOREIGN KEY (device_id) REFERENCES devices (id)
+    )
+'''
+PARTITION_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS ux_{name}_device_ts ON {name} (device_id, ts, IFNULL(seq, -1))"
+
+
+def month_key(ts):
+    """'YYYYMM' of the UTC month of epoch seconds"""
+    month = datetime.fromtimestamp(ts, timezone.utc)
+    return f"{month.year:04d}{month.month:02d}"
+
+
+def month_bounds(key):
+    """[start, end) epoch seconds of a 'YYYYMM' UTC month"""
+    year, month = int(key[:4]), int(key[4:])
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def partition_name(ts):
+    return PARTITION_PREFIX + month_key(ts)
+
+
+def partition_bounds(name):
+    """[start, end) epoch seconds covered by a partition"""
+    return month_bounds(name[len(PARTITION_PREFIX):])
+
+
+def is_partition(name):
+    suffix = name[len(PARTITION_PREFIX):]
+    return name.startswith(PARTITION_PREFIX) and len(suffix) == 6 and suffix.isdigit()
+
+
+@contextmanager
+def savepoint(conn, name='partitions'):
+    """Apply the statements of the block together or not at all, inside the caller's transaction if any"""
+    conn.execute(f"SAVEPOINT {name}")
+    try:
+        yield
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {name}")
+        conn.execute(f"RELEASE {name}")
+        raise
+    conn.execute(f"RELEASE {name}")
+
+
+class ReadingPartitions:
+    """Routes reads and writes of device readings to their monthly tables"""
+
+    def __init__(self):
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def list(self, conn):
+        """Names of the existing partitions, oldest first"""
+        rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+                            (PARTITION_PREFIX + '%',)).fetchall()
+        return sorted(row[0] for row in rows if is_partition(row[0]))
+
+    def ensure(self, conn, name):
+        """Create a partition if needed, and the `readings` view over all of them"""
+        with self._lock:
+            if name in self._known:
+                return
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+        if not exists:
+            with savepoint(conn):
+                conn.execute(PARTITION_SCHEMA.format(name=name))
+                conn.execute(PARTITION_INDEX.format(name=name))
+                self.rebuild_view(conn)
+        with self._lock:
+            self._known.add(name)
+
+    def rebuild_view(self, conn):
+        """(Re)create the `readings` compatibility view and its triggers over the current partitions.
+
+        The old view stays in place if the new one cannot be created.
+        """
+        with savepoint(conn, 'readings_view'):
+            self._create_view(conn)
+
+    def _create_view(self, conn):
+        tables = [LEGACY_TABLE] + self.list(conn)
+        conn.execute("DROP VIEW IF EXISTS readings")
+        conn.execute("CREATE VIEW readings AS " + " UNION ALL ".join(
+            f"SELECT id, device_id, temperature, humidity, {LOCAL_DATETIME_SQL.format('ts')} AS timestamp, seq "
+            f"FROM {table}" for table in tables))
+        # Older writers go to the unpartitioned table, with an id of the shared counter
+        conn.execute(f'''
+            CREATE TRIGGER readings_insert INSTEAD OF INSERT ON readings BEGIN
+                UPDATE row_ids SET last_id = last_id + 1 WHERE kind = 'device';
+                INSERT INTO {LEGACY_TABLE} (id, device_id, temperature, humidity, ts, seq)
+                VALUES ((SELECT last_id FROM row_ids WHERE kind = 'device'), NEW.device_id, NEW.temperature, NEW.humidity,
+                        COALESCE({text_to_epoch('NEW.timestamp')}, CAST(strftime('%s', 'now') AS INTEGER)), NEW.seq);
+            END
+        ''')
+        deletes = "".join(
+            f"DELETE FROM {table} WHERE id = OLD.id AND device_id IS OLD.device_id AND ts = {text_to_epoch('OLD.timestamp')};"
+            for table in tables)
+        conn.execute(f"CREATE TRIGGER readings_delete INSTEAD OF DELETE ON readings BEGIN {deletes} END")
+
+    def tables_for_range(self, conn, start=None, end=None):
+        """Tables that may hold readings in [start, end), newest partition first, unpartitioned table last"""
+        tables = []
+        for name in reversed(self.list(conn)):
+            low, high = partition_bounds(name)
+            if (start is None or high > start) and (end is None or low < end):
+                tables.append(name)
+        tables.append(LEGACY_TABLE)
+        return tables
+
+    def insert(self, conn, rows):
+        """Insert (device_id, temperature, humidity, ts, seq) rows, one statement per partition.
+
+        Duplicates (same device, ts and seq) always fall in the same partition and are skipped.
+        Returns (after, ids): every id greater than `after` is one of this insert, and
+        ids[i] is the id of rows[i], None if it was skipped.
+        Raises ValueError for a row outside the plausible time window (see check_reading_time).
+        """
+        by_partition = {}
+        for i, row in enumerate(rows):
+            by_partition.setdefault(partition_name(check_reading_time(row[3])), []).append(i)
+        first = watermarks.allocate(conn, 'device', len(rows))
+        ids = [None] * len(rows)
+        for name, indexes in by_partition.items():
+            self.ensure(conn, name)
+            sql = f"INSERT OR IGNORE INTO {name} (id, device_id, temperature, humidity, ts, seq) VALUES (?, ?, ?, ?, ?, ?)"
+            partition_rows = [(first + i,) + tuple(rows[i]) for i in indexes]
+            try:
+                conn.executemany(sql, partition_rows)
+            except sqlite3.OperationalError as e:
+                if 'no such table' not in str(e):
+                    raise
+                # Created in a transaction that was rolled back, or dropped by another process
+                self.forget([name])
+                self.ensure(conn, name)
+                conn.executemany(sql, partition_rows)
+            kept = watermarks.inserted(conn, name, first + indexes[0], first + indexes[-1])
+            for i in indexes:
+                if first + i in kept:
+                    ids[i] = first + i
+        return first - 1, ids
+
+    def drop_before(self, conn, ts):
+        """Drop the partitions holding only readings older than `ts`; return their names"""
+        dropped = [name for name in self.list(conn) if partition_bounds(name)[1] <= ts]
+        for name in dropped:
+            conn.execute(f"DROP TABLE {name}")
+        if dropped:
+            self.rebuild_view(conn)
+            with self._lock:
+                self._known.difference_update(dropped)
+        return dropped
+
+    def migrate_legacy(self, conn):
+        """Move the rows of the unpartitioned table into their monthly partitions"""
+        months = conn.execute(f"SELECT DISTINCT strftime('%Y%m', ts, 'unixepoch') FROM {LEGACY_TABLE}").fetchall()
+        try:
+            for (month,) in months:
+                name = PARTITION_PREFIX + month
+                self.ensure(conn, name)
+                low, high = partition_bounds(name)
+                # Ids are kept: they stay unique across the tables
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO {name} (id, device_id, temperature, humidity, ts, seq)
+                    SELECT id, device_id, temperature, humidity, ts, seq FROM {LEGACY_TABLE}
+                    WHERE ts >= ? AND ts < ? ORDER BY id
+                ''', (low, high))
+                conn.execute(f"DELETE FROM {LEGACY_TABLE} WHERE ts >= ? AND ts < ?", (low, high))
+            self.rebuild_view(conn)
+        except Exception:
+            # The caller rolls back, so the partitions created above may not exist
+            self.forget()
+            raise
+
+    def renumber(self, conn):
+        """Make reading ids unique across the tables again; return the greatest one.
+
+        Partitions used to number their rows from 1 each. If an id is found in two
+        tables, they are visited oldest partition first, unpartitioned table last, and
+        the rows of a table whose ids overlap those of the tables before it are shifted
+        past them, its rollup watermark (see rollups.py) with them.
+        """
+        tables = self.list(conn) + [LEGACY_TABLE]
+        ids = " UNION ALL ".join(f"SELECT id FROM {table}" for table in tables)
+        last, repeated = conn.execute(
+            f"SELECT IFNULL(MAX(id), 0), COUNT(*) - COUNT(DISTINCT id) FROM ({ids})").fetchone()
+        if not repeated:
+            return last
+        last = 0
+        for table in tables:
+            low, high = conn.execute(f"SELECT MIN(id), MAX(id) FROM {table}").fetchone()
+            if low is None:
+                continue
+            if low <= last:
+                # Through negative ids, so that no shifted row collides with one not shifted yet
+                conn.execute(f"UPDATE {table} SET id = -id")
+                conn.execute(f"UPDATE {table} SET id = ? - id", (last,))
+                conn.execute("UPDATE rollup_state SET last_id = last_id + ? WHERE source = ?", (last, table))
+                high += last
+            last = max(last, high)
+        return last
+
+    def forget(self, names=None):
+        """Clear the cache of existing partitions (or of some of them), e.g. after a rollback"""
+        with self._lock:
+            if names is None:
+                self._known.clear()
+            else:
+                self._known.difference_update(names)
+
+
+# Shared by every connection of the process
+reading_partitions = ReadingPartitions()
@@ -0,0 +1,70 @@
+"""
+Compact binary payload accepted by the ingestion routes next to JSON.
+
+Layout (little-endian), sent with Content-Type application/vnd.weather-readings:
+
+    header   2s magic b"WD" | B version | B api key length | I device id (0 if unused)
+    api key  <api key length> ASCII bytes (may be empty when sent in the X-API-Key header)
+    readings one or more records of
+             I epoch seconds (UTC) | h temperature in 1/100 °C | H humidity in 1/100 %
+
+A reading costs 8 bytes instead of ~100 for its JSON equivalent. Missing values
+are sent as TEMPERATURE_MISSING / HUMIDITY_MISSING.
+"""
+import struct
+
+BINARY_CONTENT_TYPE = 'application/vnd.weather-readings'
+
+MAGIC = b'WD'
+VERSION = 1
+HEADER = struct.Struct('<2sBBI')
+RECORD = struct.Struct('<IhH')
+
+TEMPERATURE_MISSING = -0x8000
+HUMIDITY_MISSING = 0xFFFF
+SCALE = 100
+
+
+class PayloadError(ValueError):
+    """Raised for a binary payload that does not follow the layout above"""
+
+
+def encode_readings(readings, api_key='', device_id=0):
+    """Pack (epoch, temperature, humidity) tuples; None values are sent as missing"""
+    key = api_key.encode('ascii')
+    parts = [HEADER.pack(MAGIC, VERSION, len(key), device_id), key]
+    for epoch, temperature, humidity in readings:
+        parts.append(RECORD.pack(
+            int(epoch),
+            TEMPERATURE_MISSING if temperature is None else round(temperature * SCALE),
+            HUMIDITY_MISSING if humidity is None else round(humidity * SCALE)
+        ))
+    return b''.join(parts)
+
+
+def decode_readings(body):
+    """Unpack a payload into (api_key, device_id, readings).
+
+    Readings are (epoch, temperature, humidity) tuples decoded straight from the
+    record structs, without building an intermediate dict per field.
+    """
+    if len(body) < HEADER.size:
+        raise PayloadError("Payload shorter than its header")
+    magic, version, key_length, device_id = HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise PayloadError("Unknown payload format")
+    offset = HEADER.size + key_length
+    records = memoryview(body)[offset:]
+    if len(body) < offset or not records or len(records) % RECORD.size:
+        raise PayloadError("Truncated payload")
+    try:
+        api_key = bytes(body[HEADER.size:offset]).decode('ascii')
+    except UnicodeDecodeError:
+        raise PayloadError("API key must be ASCII")
+    readings = [
+        (epoch,
+         None if temperature == TEMPERATURE_MISSING else temperature / SCALE,
+         None if humidity == HUMIDITY_MISSING else humidity / SCALE)
+        for epoch, temperature, humidity in RECORD.iter_unpack(records)
+    ]
+    return api_key, device_id, readings
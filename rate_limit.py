@@ -0,0 +1,84 @@
+"""
+Per-device rate limiting of the ingestion routes.
+
+Every device gets a token bucket refilled at the rate configured for its
+device type; a request spends one token, and a device that runs out is told
+how long to wait instead of competing with the rest of the fleet for the
+SQLite write lock.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_RATE = (1.0, 10)
+
+
+def rates_from_env(value=None):
+    """Parse INGEST_RATE_LIMITS, e.g. "default=1:10,ESP8266=0.2:5", into {device_type: (rate, burst)}.
+
+    Rates are in requests per second, bursts in requests; 'default' applies to unlisted types.
+    """
+    if value is None:
+        value = os.environ.get('INGEST_RATE_LIMITS', '')
+    rates = {'default': DEFAULT_RATE}
+    for entry in value.split(','):
+        if not entry.strip():
+            continue
+        device_type, _, limit = entry.partition('=')
+        rate, _, burst = limit.partition(':')
+        rates[device_type.strip()] = (float(rate), int(burst) if burst else max(1, math.ceil(float(rate))))
+    return rates
+
+
+def retry_after_header(seconds):
+    """Value of a Retry-After header: whole seconds, at least 1"""
+    return str(max(1, math.ceil(seconds)))
+
+
+class RateLimiter:
+    """Token buckets keyed by device, the least recently used ones dropped past `maxsize`.
+
+    A dropped bucket comes back full, which only ever errs in the device's favour.
+    """
+
+    def __init__(self, rates=None, maxsize=100000):
+        self.rates = rates or {'default': DEFAULT_RATE}
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._allowed = 0
+        self._limited = 0
+
+    def limit_for(self, device_type=None):
+        return self.rates.get(device_type) or self.rates.get('default', DEFAULT_RATE)
+
+    def acquire(self, key, device_type=None):
+        """Spend one token of the bucket of `key` (a device); return 0 if allowed, else the seconds to wait"""
+        rate, burst = self.limit_for(device_type)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+                self._allowed += 1
+            else:
+                wait = (1 - tokens) / rate if rate > 0 else 60
+                self._limited += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                'buckets': len(self._buckets),
+                'allowed': self._allowed,
+                'limited': self._limited,
+                'rates': {device_type: {'rate': rate, 'burst': burst}
+                          for device_type, (rate, burst) in self.rates.items()}
+            }
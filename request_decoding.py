@@ -0,0 +1,84 @@
+"""
+Transparent decompression of gzip/deflate request bodies on the ingestion routes.
+
+Gateways upload batches with Content-Encoding: gzip to save bandwidth. The
+middleware swaps the WSGI input for a stream that inflates the body as the
+JSON parser reads it, and stops with 413 once the inflated size passes a cap,
+so a few kilobytes of compressed zeros cannot exhaust the server's memory.
+"""
+import io
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.wsgi import get_input_stream
+
+MAX_DECOMPRESSED_SIZE = 10 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# zlib window bits for each supported Content-Encoding ("deflate" is the zlib format)
+ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class DecompressingStream(io.RawIOBase):
+    """Readable stream inflating `stream` chunk by chunk, up to `max_size` bytes"""
+
+    def __init__(self, stream, wbits, max_size=MAX_DECOMPRESSED_SIZE):
+        self._stream = stream
+        self._decompressor = zlib.decompressobj(wbits)
+        self._max_size = max_size
+        self._size = 0
+        self._pending = b''
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            if self._done:
+                return 0
+            data = self._decompressor.unconsumed_tail or self._stream.read(CHUNK_SIZE)
+            if not data:
+                raise BadRequest("Truncated compressed body")
+            try:
+                self._pending = self._decompressor.decompress(data, CHUNK_SIZE)
+            except zlib.error:
+                raise BadRequest("Invalid compressed body")
+            self._done = self._decompressor.eof
+            self._size += len(self._pending)
+            if self._size > self._max_size:
+                raise RequestEntityTooLarge(f"Decompressed body larger than {self._max_size} bytes")
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+
+class DecompressRequestBody:
+    """WSGI middleware decoding compressed request bodies for paths starting with one of `paths`"""
+
+    def __init__(self, app, max_size=MAX_DECOMPRESSED_SIZE, paths=('/api/',)):
+        self.app = app
+        self.max_size = max_size
+        self.paths = tuple(paths)
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding in ('', 'identity') or not environ.get('PATH_INFO', '').startswith(self.paths):
+            return self.app(environ, start_response)
+        if encoding not in ENCODINGS:
+            return UnsupportedMediaType(f"Unsupported Content-Encoding: {encoding}")(environ, start_response)
+
+        # The compressed body is still bounded by its Content-Length
+        compressed = get_input_stream(environ)
+        environ['wsgi.input'] = io.BufferedReader(
+            DecompressingStream(compressed, ENCODINGS[encoding], self.max_size), CHUNK_SIZE)
+        # The inflated length is unknown until the body has been read
+        environ['wsgi.input_terminated'] = True
+        environ.pop('CONTENT_LENGTH', None)
+        del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
@@ -0,0 +1,385 @@
+"""
+Retention of the readings, climate rows and rollups.
+
+A policy gives, per device type, how many days each level of detail is kept:
+raw readings, then the minute, hour and day rollups of rollups.py (None keeps
+a level forever). The job first folds pending rows into the rollups, so data
+is always downsampled before it is deleted, then deletes; both go in small
+chunks, one short transaction each, so devices are never kept waiting on the
+write lock.
+Whole monthly partitions past every raw retention are dropped at once, and
+freed pages are handed back to the file system with incremental vacuum.
+
+Incremental vacuum needs `auto_vacuum = INCREMENTAL`, which an existing
+database only gets through a full VACUUM, run once with
+`python retention.py --enable-incremental-vacuum` while the apps are stopped.
+
+With an archive (archive.py), raw rows are written to it before they are
+deleted, partitions included.
+
+Readings arriving after their raw retention are still added to the minute,
+hour and day rollups holding them (see rollups.py), which keep counting the
+expired readings.
+
+Usage:
+    python retention.py                      # one pass over climate_data.db
+"""
+import argparse
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from db_pool import apply_pragmas, pragmas_from_env
+from archive import COLUMNS, ColumnArchive, to_arrays
+from partitions import partition_bounds, reading_partitions
+from rollups import DAY, HOUR, MINUTE, catch_up, catch_up_source, sources as rollup_sources
+from versions import bump_all
+
+logger = logging.getLogger(__name__)
+
+DATABASE = "climate_data.db"
+
+LEVELS = {'raw': None, 'minute': MINUTE, 'hour': HOUR, 'day': DAY}
+# Days kept at each level; 'climate' is the policy of the climate rows (per city)
+DEFAULT_POLICY = {'raw': 30, 'minute': 90, 'hour': 730, 'day': None}
+
+DAY_SECONDS = 86400
+CHUNK_SIZE = 2000
+VACUUM_PAGES = 1000
+# Rows read at once when archiving
+ARCHIVE_PAGE = 50000
+
+
+def policies_from_env(value=None):
+    """Parse RETENTION_POLICIES, e.g. "default=raw:30,hour:730;ESP8266=raw:7;climate=raw:365".
+
+    Values are in days, 0 or 'forever' keeps a level forever; levels not given
+    come from the 'default' policy, itself based on DEFAULT_POLICY.
+    """
+    if value is None:
+        value = os.environ.get('RETENTION_POLICIES', '')
+    entries = {}
+    for entry in value.split(';'):
+        if not entry.strip():
+            continue
+        name, _, levels = entry.partition('=')
+        policy = entries.setdefault(name.strip(), {})
+        for level in levels.split(','):
+            if not level.strip():
+                continue
+            level_name, _, days = level.partition(':')
+            level_name = level_name.strip()
+            if level_name not in LEVELS:
+                raise ValueError(f"Unknown retention level: {level_name}")
+            days = days.strip().lower()
+            policy[level_name] = None if days in ('', '0', 'forever') else float(days)
+    default = dict(DEFAULT_POLICY, **entries.pop('default', {}))
+    policies = {'default': default}
+    for name, policy in entries.items():
+        policies[name] = dict(default, **policy)
+    return policies
+
+
+class RetentionJob:
+    """Enforces the retention policies on a timer, in a background thread"""
+
+    def __init__(self, database, policies=None, readings_database=None, archive=None, interval=3600,
+                 chunk_size=CHUNK_SIZE, pause=0.05, pragmas=None):
+        self.database = database
+        self.policies = policies or {'default': dict(DEFAULT_POLICY)}
+        # app.py keeps device readings in the `reading` table of another database
+        self.readings_database = readings_database
+        # ColumnArchive receiving the raw rows before they are deleted, if any
+        self.archive = archive
+        self.interval = interval
+        self.chunk_size = chunk_size
+        # Sleep between chunks, leaving the write lock to the ingestion path
+        self.pause = pause
+        self.pragmas = pragmas if pragmas is not None else pragmas_from_env()
+        self._conn = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'runs': 0, 'rows_archived': 0, 'rows_deleted': 0, 'rollups_deleted': 0,
+                       'partitions_dropped': 0, 'pages_vacuumed': 0, 'errors': 0}
+
+    def start(self):
+        """Start the background thread (no-op if it is already running or the interval is 0)"""
+        with self._lock:
+            if self._thread is not None or not self.interval:
+                return
+            self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, interval=self.interval)
+
+    def policy(self, name):
+        return self.policies.get(name) or self.policies['default']
+
+    def cutoff(self, name, level, now):
+        """Epoch seconds before which `level` data of policy `name` is deleted, None to keep it"""
+        days = self.policy(name)[level]
+        return None if days is None else int(now - days * DAY_SECONDS)
+
+    def run_once(self, now=None):
+        """Downsample, delete what is past retention and reclaim the space; return the stats of the pass"""
+        now = now if now is not None else time.time()
+        conn = self.setup()
+        done = {'rows_archived': 0, 'rows_deleted': 0, 'rollups_deleted': 0, 'partitions_dropped': 0,
+                'pages_vacuumed': 0}
+
+        self._catch_up(conn)
+        self._create_cutoffs(conn, now)
+
+        # Partitions holding nothing any device type still keeps as raw readings go as a whole
+        keep_from = self._oldest_raw_cutoff(now)
+        # Stopped during the catch-up: the rest of the backlog would be folded under the lock
+        if keep_from is not None and not self._stopping.is_set():
+            archived = {}
+            if self.archive:
+                for table in reading_partitions.list(conn):
+                    if partition_bounds(table)[1] <= keep_from:
+                        count, last_id = self._archive_rows(conn, 'device', table, "r.device_id", "1")
+                        done['rows_archived'] += count
+                        archived[table] = last_id or 0
+            done['partitions_dropped'] = len(self._drop_partitions(conn, done, keep_from, archived))
+
+        newest_cutoff = conn.execute("SELECT MAX(cutoff) FROM temp.retention_cutoffs WHERE level = 'raw'").fetchone()[0]
+        if newest_cutoff is not None:
+            for table in reading_partitions.tables_for_range(conn, None, newest_cutoff):
+                self._expire(conn, done, 'device', table, "r.device_id", "LEFT JOIN devices d ON d.id = r.device_id",
+                             f"r.ts < {self._cutoff_sql('raw', 'd.device_type')}")
+        if self.readings_database:
+            self._expire(conn, done, 'reading', 'source.reading', "r.device_id",
+                         "LEFT JOIN source.device d ON d.id = r.device_id",
+                         f"r.timestamp < {self._cutoff_sql('raw', 'd.device_type')}")
+
+        climate_cutoff = self.cutoff('climate', 'raw', now)
+        if climate_cutoff is not None:
+            self._expire(conn, done, 'city', 'climate_samples', "r.city", "", f"r.ts < {climate_cutoff}")
+
+        for level, granularity in LEVELS.items():
+            if granularity is None:
+                continue
+            done['rollups_deleted'] += self._delete_chunks(conn, f'''
+                DELETE FROM device_rollups WHERE (device_id, granularity, bucket) IN (
+                    SELECT r.device_id, r.granularity, r.bucket
+                    FROM device_rollups r LEFT JOIN devices d ON d.id = r.device_id
+                    WHERE r.granularity = {granularity} AND r.bucket < {self._cutoff_sql(level, 'd.device_type')}
+                    LIMIT ?
+                )
+            ''')
+            city_cutoff = self.cutoff('climate', level, now)
+            if city_cutoff is not None:
+                done['rollups_deleted'] += self._delete_chunks(conn, f'''
+                    DELETE FROM city_rollups WHERE (city, granularity, bucket) IN (
+                        SELECT city, granularity, bucket FROM city_rollups
+                        WHERE granularity = {granularity} AND bucket < {city_cutoff}
+                        LIMIT ?
+                    )
+                ''')
+
+        done['pages_vacuumed'] = self._incremental_vacuum(conn)
+        with self._lock:
+            self._stats['runs'] += 1
+            for name, count in done.items():
+                self._stats[name] += count
+        return done
+
+    def setup(self):
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.database, check_same_thread=False)
+                apply_pragmas(conn, self.pragmas)
+                if self.readings_database:
+                    conn.execute("ATTACH DATABASE ? AS source", (self.readings_database,))
+                self._conn = conn
+            return self._conn
+
+    def _create_cutoffs(self, conn, now):
+        """temp.retention_cutoffs: the cutoff of each level for each device type with a policy"""
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS retention_cutoffs (device_type TEXT, level TEXT, cutoff INTEGER)")
+        conn.execute("DELETE FROM temp.retention_cutoffs")
+        conn.executemany("INSERT INTO temp.retention_cutoffs VALUES (?, ?, ?)", [
+            (name, level, self.cutoff(name, level, now))
+            for name in self.policies if name != 'climate' for level in LEVELS
+        ])
+        conn.commit()
+
+    def _cutoff_sql(self, level, device_type):
+        """SQL cutoff of a device type for `level`, the default policy's for unlisted types; NULL keeps forever"""
+        return (f"(SELECT cutoff FROM temp.retention_cutoffs c WHERE c.level = '{level}' AND c.device_type = "
+                f"COALESCE((SELECT device_type FROM temp.retention_cutoffs WHERE device_type = {device_type} LIMIT 1), "
+                f"'default'))")
+
+    def _oldest_raw_cutoff(self, now):
+        cutoffs = [self.cutoff(name, 'raw', now) for name in self.policies if name != 'climate']
+        return None if None in cutoffs else min(cutoffs)
+
+    def _expire(self, conn, done, kind, table, key, join, condition):
+        """Delete the raw rows of `table` matching `condition`, archiving them first if there is an archive"""
+        if self.archive:
+            archived, upper_id = self._archive_rows(conn, kind, table, key, condition, join)
+            done['rows_archived'] += archived
+            if upper_id is None:
+                return
+            # Rows written since they were archived stay for the next pass
+            condition = f"{condition} AND r.id <= {upper_id}"
+        deleted = self._delete_chunks(conn, f'''
+            DELETE FROM {table} WHERE id IN (
+                SELECT r.id FROM {table} r {join} WHERE {condition} LIMIT ?
+            )
+        ''')
+        if deleted:
+            with conn:
+                bump_all(conn, kind, table.split('.')[0] if '.' in table else 'main')
+        done['rows_deleted'] += deleted
+
+    def _catch_up(self, conn):
+        """Fold the rows missing from the rollups, a chunk of one source per transaction, pausing in between.
+
+        After an outage the backlog may be large: folded at once, it would hold the
+        write lock and block the ingestion for as long.
+        """
+        for kind, source in rollup_sources(conn):
+            while True:
+                with conn:
+                    folded = catch_up_source(conn, kind, source, self.chunk_size)
+                if folded < self.chunk_size:
+                    break
+                if self._stopping.is_set():
+                    return
+                time.sleep(self.pause)
+
+    def _drop_partitions(self, conn, done, keep_from, archived):
+        """Drop the partitions older than `keep_from` in one write transaction; return their names.
+
+        Rows written to them since they were archived (ids past `archived[name]`) are archived
+        and folded into the rollups first, under the write lock, so that none is dropped
+        without being archived: only rows written since _catch_up() are left to fold.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            catch_up(conn)
+            if self.archive:
+                for table in reading_partitions.list(conn):
+                    if partition_bounds(table)[1] <= keep_from:
+                        done['rows_archived'] += self._archive_rows(
+                            conn, 'device', table, "r.device_id", f"r.id > {archived.get(table, 0)}")[0]
+            dropped = reading_partitions.drop_before(conn, keep_from)
+            conn.executemany("DELETE FROM rollup_state WHERE source = ?", [(name,) for name in dropped])
+            if dropped:
+                bump_all(conn, 'device')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            # The partitions dropped above are back
+            reading_partitions.forget()
+            raise
+        return dropped
+
+    def _archive_rows(self, conn, kind, table, key, condition, join=""):
+        """Write the rows of `table` matching `condition` to the archive, page by page.
+
+        Returns the number of rows archived and the highest id among them.
+        """
+        columns = ", ".join("r.timestamp" if name == 'ts' and kind == 'reading' else f"r.{name}"
+                            for name in COLUMNS[kind])
+        total, last_id = 0, None
+        while True:
+            rows = conn.execute(f'''
+                SELECT r.id, {key}, {columns} FROM {table} r {join}
+                WHERE {condition} AND r.id > ? ORDER BY r.id LIMIT ?
+            ''', (last_id or 0, ARCHIVE_PAGE)).fetchall()
+            if not rows:
+                return total, last_id
+            by_key = {}
+            for row in rows:
+                by_key.setdefault(row[1], []).append(tuple(row)[2:])
+            for series_key, series_rows in by_key.items():
+                self.archive.write(kind, series_key, to_arrays(kind, series_rows))
+            total += len(rows)
+            last_id = rows[-1][0]
+
+    def _delete_chunks(self, conn, sql):
+        """Run a DELETE ... LIMIT ? statement chunk by chunk, one transaction each; return the rows deleted"""
+        total = 0
+        while True:
+            with conn:
+                deleted = conn.execute(sql, (self.chunk_size,)).rowcount
+            total += deleted
+            if deleted < self.chunk_size or self._stopping.is_set():
+                return total
+            time.sleep(self.pause)
+
+    def _incremental_vacuum(self, conn):
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        total = 0
+        while True:
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                break
+            conn.execute(f"PRAGMA incremental_vacuum({min(free, VACUUM_PAGES)})").fetchall()
+            total += min(free, VACUUM_PAGES)
+            time.sleep(self.pause)
+        return total
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                return
+            try:
+                done = self.run_once()
+                logger.info("Retention pass: %s", done)
+            except sqlite3.Error:
+                logger.exception("Enforcing the retention policies failed")
+                with self._lock:
+                    self._stats['errors'] += 1
+
+
+def enable_incremental_vacuum(database):
+    """Switch a database to auto_vacuum = INCREMENTAL; rewrites the whole file"""
+    conn = sqlite3.connect(database, isolation_level=None)
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enforce the retention policies (RETENTION_POLICIES) once")
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--readings-database', help="weather_dashboard.db of app.py, to prune its `reading` table")
+    parser.add_argument('--archive-dir', help="archive the raw rows to this directory before deleting them")
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help="switch the database to incremental vacuum first (full VACUUM, stop the apps)")
+    args = parser.parse_args()
+
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum(args.database)
+    archive = ColumnArchive(args.archive_dir) if args.archive_dir else None
+    job = RetentionJob(args.database, policies_from_env(), readings_database=args.readings_database,
+                       archive=archive)
+    print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {job.run_once()}")
+
+
+if __name__ == "__main__":
+    main()
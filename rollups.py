@@ -0,0 +1,225 @@
+"""
+Rollups of the readings and climate rows of climate_data.db.
+
+Per device (and per climate city), count/min/max/sum/sum of squares of the
+temperature and humidity are kept at 1-minute, 1-hour and 1-day granularity
+in `device_rollups` and `city_rollups`. `catch_up()` folds the rows written
+since its last pass into them, tracking progress with a watermark per source
+table like the climate mirror does; `series()` then answers a chart from the
+coarsest rollup matching the requested resolution instead of the raw rows.
+
+New rows are added to the statistics a bucket already holds rather than the
+bucket being recomputed from the raw rows, which retention may have deleted:
+a late reading adds to its buckets without erasing what they summarise.
+
+Buckets are aligned on UTC epoch seconds, so day buckets are UTC days.
+
+Usage:
+    python rollups.py                        # catch up climate_data.db
+"""
+import argparse
+import math
+import sqlite3
+
+from partitions import LEGACY_TABLE, reading_partitions
+
+DATABASE = "climate_data.db"
+
+MINUTE, HOUR, DAY = 60, 3600, 86400
+GRANULARITIES = (MINUTE, HOUR, DAY)
+METRICS = ('temperature', 'humidity')
+
+# Rows folded per source table and pass, so a backfill does not hold the write lock for long
+CATCH_UP_BATCH = 20000
+
+STAT_COLUMNS = [f"{metric}_{stat}" for metric in METRICS for stat in ('count', 'min', 'max', 'sum', 'sumsq')]
+
+# kind -> (rollup table, key column of the rollup and of the source rows)
+ROLLUPS = {
+    'device': ('device_rollups', 'device_id'),
+    'city': ('city_rollups', 'city'),
+}
+
+
+def rollup_schema(table, key, key_type):
+    columns = ",\n".join(f"    {column} {'INTEGER NOT NULL' if column.endswith('_count') else 'REAL'}"
+                         for column in STAT_COLUMNS)
+    return (f"CREATE TABLE IF NOT EXISTS {table} (\n"
+            f"    {key} {key_type} NOT NULL,\n"
+            f"    granularity INTEGER NOT NULL,\n"
+            f"    bucket INTEGER NOT NULL,\n"
+            f"{columns},\n"
+            f"    PRIMARY KEY ({key}, granularity, bucket)\n"
+            f") WITHOUT ROWID")
+
+
+SCHEMA = [
+    rollup_schema('device_rollups', 'device_id', 'INTEGER'),
+    rollup_schema('city_rollups', 'city', 'TEXT'),
+    '''
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        source TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    )
+    ''',
+]
+
+# Aggregates of raw rows, and of finer rollups, into the stat columns
+RAW_AGGREGATES = ", ".join(
+    f"COUNT(r.{metric}), MIN(r.{metric}), MAX(r.{metric}), TOTAL(r.{metric}), TOTAL(r.{metric} * r.{metric})"
+    for metric in METRICS)
+ROLLUP_AGGREGATES = ", ".join(
+    f"SUM(r.{metric}_count), MIN(r.{metric}_min), MAX(r.{metric}_max), TOTAL(r.{metric}_sum), TOTAL(r.{metric}_sumsq)"
+    for metric in METRICS)
+
+
+def choose_granularity(resolution):
+    """Coarsest rollup granularity dividing `resolution` seconds, None below one minute"""
+    usable = [granularity for granularity in GRANULARITIES if resolution % granularity == 0]
+    return max(usable) if usable else None
+
+
+def create_tables(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def merge_stats(stats, other):
+    """Combine two tuples of (count, min, max, sum, sum of squares) per metric"""
+    if stats is None:
+        return other
+    merged = []
+    for i in range(0, len(stats), 5):
+        (count, low, high, total, squares), (count2, low2, high2, total2, squares2) = stats[i:i + 5], other[i:i + 5]
+        merged += [count + count2,
+                   low if low2 is None else low2 if low is None else min(low, low2),
+                   high if high2 is None else high2 if high is None else max(high, high2),
+                   total + total2, squares + squares2]
+    return tuple(merged)
+
+
+def _fold_rows(conn, kind, source, last_id, upper_id):
+    """Add the rows of `source` with last_id < id <= upper_id to the minute, hour and day buckets holding them"""
+    table, key = ROLLUPS[kind]
+    added = {}
+    for row in conn.execute(f'''
+        SELECT r.{key}, r.ts - r.ts % {MINUTE} AS minute, {RAW_AGGREGATES}
+        FROM {source} r
+        WHERE r.id > ? AND r.id <= ? AND r.{key} IS NOT NULL
+        GROUP BY r.{key}, minute
+    ''', (last_id, upper_id)):
+        for granularity in GRANULARITIES:
+            bucket = (row[0], granularity, row[1] - row[1] % granularity)
+            added[bucket] = merge_stats(added.get(bucket), tuple(row)[2:])
+
+    # Merged into what the buckets already hold: their raw rows may have expired since
+    merged = []
+    for bucket, stats in added.items():
+        current = conn.execute(
+            f"SELECT {', '.join(STAT_COLUMNS)} FROM {table} WHERE {key} = ? AND granularity = ? AND bucket = ?",
+            bucket).fetchone()
+        merged.append(bucket + merge_stats(tuple(current) if current else None, stats))
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {table} ({key}, granularity, bucket, {', '.join(STAT_COLUMNS)}) "
+        f"VALUES (?, ?, ?, {', '.join('?' * len(STAT_COLUMNS))})",
+        merged
+    )
+
+
+def sources(conn):
+    """(kind, table) of every table whose rows are folded into the rollups"""
+    return ([('city', 'climate_samples'), ('device', LEGACY_TABLE)]
+            + [('device', name) for name in reading_partitions.list(conn)])
+
+
+def catch_up_source(conn, kind, source, batch_size=CATCH_UP_BATCH):
+    """Fold up to `batch_size` rows of `source` past its watermark; return how many were folded"""
+    row = conn.execute("SELECT last_id FROM rollup_state WHERE source = ?", (source,)).fetchone()
+    last_id = row[0] if row else 0
+    upper_id, count = conn.execute(f'''
+        SELECT MAX(id), COUNT(*) FROM (SELECT id FROM {source} WHERE id > ? ORDER BY id LIMIT ?)
+    ''', (last_id, batch_size)).fetchone()
+    if not count:
+        return 0
+
+    _fold_rows(conn, kind, source, last_id, upper_id)
+    conn.execute("INSERT OR REPLACE INTO rollup_state (source, last_id) VALUES (?, ?)", (source, upper_id))
+    return count
+
+
+def catch_up(conn, batch_size=CATCH_UP_BATCH):
+    """Fold every row written since the last pass into the rollups; return the number of rows folded.
+
+    Runs in the caller's transaction (the ingestion path calls it right after its inserts);
+    the caller commits.
+    """
+    total = 0
+    for kind, source in sources(conn):
+        while True:
+            folded = catch_up_source(conn, kind, source, batch_size)
+            total += folded
+            if folded < batch_size:
+                break
+    return total
+
+
+def forget_device(conn, device_id):
+    conn.execute("DELETE FROM device_rollups WHERE device_id = ?", (device_id,))
+
+
+def series(conn, kind, key, start, end, resolution):
+    """Statistics of a device or city per `resolution` seconds over [start, end), oldest first.
+
+    Returns None when the resolution is finer than the finest rollup (one minute),
+    in which case the raw rows have to be read.
+    """
+    granularity = choose_granularity(resolution)
+    if granularity is None:
+        return None
+    table, key_column = ROLLUPS[kind]
+    rows = conn.execute(f'''
+        SELECT bucket - bucket % ? AS period, {ROLLUP_AGGREGATES}
+        FROM {table} r
+        WHERE {key_column} = ? AND granularity = ? AND bucket >= ? AND bucket < ?
+        GROUP BY period
+        ORDER BY period
+    ''', (resolution, key, granularity, start, end)).fetchall()
+
+    return to_points(rows)
+
+
+def to_points(rows, metrics=METRICS):
+    """Series points of (period, then count/min/max/sum/sum of squares per metric) rows"""
+    points = []
+    for row in rows:
+        point = {'ts': row[0]}
+        for i, metric in enumerate(metrics):
+            count, low, high, total, squares = row[1 + 5 * i:6 + 5 * i]
+            mean = total / count if count else None
+            point[metric] = {
+                'count': count,
+                'min': low,
+                'max': high,
+                'mean': mean,
+                'stddev': math.sqrt(max(0.0, squares / count - mean * mean)) if count else None,
+            }
+        points.append(point)
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fold the rows written since the last pass into the rollups")
+    parser.add_argument('--database', default=DATABASE)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        create_tables(conn)
+        print(f"Rows folded: {catch_up(conn)}")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,11 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, flash
-import sqlite3
-from datetime import datetime
+from flask import Flask, Response, render_template, request, jsonify, send_file, redirect, url_for, flash, stream_with_context
+from datetime import datetime, timedelta
 import pandas as pd
 import io
 import csv
 import os
 import json
+import textwrap
 from pathlib import Path
 import calendar
 import matplotlib
@@ -14,6 +14,27 @@ import matplotlib.pyplot as plt
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import random
 import hashlib
+from ingest import (MAX_BATCH_SIZE, TIMESTAMP_FORMAT, InvalidField, extract_batch, missing_fields, reading_seq,
+                    reading_values, lookup_devices_by_key, update_last_connection)
+from ingest_buffer import IngestBuffer, IngestError, DURABILITY_FLUSH
+from auth_cache import ApiKeyCache
+from db_pool import ConnectionPool, pragmas_from_env
+from payload_codec import BINARY_CONTENT_TYPE, PayloadError, decode_readings
+from heartbeat import HeartbeatTracker, ONLINE_WITHIN, OFFLINE_AFTER
+from latest_cache import LatestReadings
+from dedup import RecentKeyFilter, reading_key, server_stamp
+from versions import etag
+from downsample import downsample
+from migrations import migrate
+from epoch import check_reading_time, format_epoch, to_epoch, today_bounds
+from rate_limit import RateLimiter, rates_from_env, retry_after_header
+from request_decoding import DecompressRequestBody, MAX_DECOMPRESSED_SIZE
+from retention import RetentionJob, policies_from_env
+from archive import ARCHIVE_DIR, ColumnArchive
+from conditional import not_modified, with_validators
+from livestream import HEARTBEAT_INTERVAL, LiveFeed, event_response, event_stream
+from storage import ReadingStore, decode_since, encode_cursor
+from rollups import DAY, HOUR, MINUTE
 
 app = Flask(__name__)
 app.secret_key = 'weather-dashboard-secret-key'
@@ -23,6 +44,36 @@ STATIC_FOLDER = "static"
 DATABASE = "climate_data.db"
 
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+# Write-behind ingestion: 'flush' acknowledges devices after the group commit, 'enqueue' as soon as queued
+app.config["INGEST_DURABILITY"] = os.environ.get("INGEST_DURABILITY", DURABILITY_FLUSH)
+app.config["INGEST_FLUSH_ROWS"] = int(os.environ.get("INGEST_FLUSH_ROWS", 500))
+app.config["INGEST_FLUSH_INTERVAL_MS"] = int(os.environ.get("INGEST_FLUSH_INTERVAL_MS", 100))
+app.config["INGEST_MAX_QUEUE"] = int(os.environ.get("INGEST_MAX_QUEUE", 10000))
+app.config["API_KEY_CACHE_SIZE"] = int(os.environ.get("API_KEY_CACHE_SIZE", 4096))
+app.config["API_KEY_CACHE_TTL"] = int(os.environ.get("API_KEY_CACHE_TTL", 300))
+# Latest readings kept in memory per device, for up to LATEST_CACHE_DEVICES devices
+app.config["LATEST_CACHE_SIZE"] = int(os.environ.get("LATEST_CACHE_SIZE", 100))
+app.config["LATEST_CACHE_DEVICES"] = int(os.environ.get("LATEST_CACHE_DEVICES", 1000))
+app.config["LATEST_CACHE_TTL"] = int(os.environ.get("LATEST_CACHE_TTL", 300))
+# Live streams: rows queued per stream before it reads them back from the database, heartbeat in seconds
+app.config["LIVE_STREAM_QUEUE"] = int(os.environ.get("LIVE_STREAM_QUEUE", 1000))
+app.config["LIVE_STREAM_HEARTBEAT"] = int(os.environ.get("LIVE_STREAM_HEARTBEAT", HEARTBEAT_INTERVAL))
+app.config["SQLITE_POOL_SIZE"] = int(os.environ.get("SQLITE_POOL_SIZE", 8))
+app.config["SQLITE_PRAGMAS"] = pragmas_from_env()
+app.config["HEARTBEAT_FLUSH_INTERVAL"] = int(os.environ.get("HEARTBEAT_FLUSH_INTERVAL", 5))
+app.config["DEVICE_ONLINE_WITHIN"] = int(os.environ.get("DEVICE_ONLINE_WITHIN", ONLINE_WITHIN))
+app.config["DEVICE_OFFLINE_AFTER"] = int(os.environ.get("DEVICE_OFFLINE_AFTER", OFFLINE_AFTER))
+app.config["DEDUP_RECENT_KEYS"] = int(os.environ.get("DEDUP_RECENT_KEYS", 100000))
+# Requests per second and burst allowed per device, by device type
+app.config["INGEST_RATE_LIMITS"] = rates_from_env()
+# gzip/deflate request bodies of the API routes are inflated on the fly, up to this many bytes
+app.config["MAX_DECOMPRESSED_BODY"] = int(os.environ.get("MAX_DECOMPRESSED_BODY", MAX_DECOMPRESSED_SIZE))
+app.wsgi_app = DecompressRequestBody(app.wsgi_app, max_size=app.config["MAX_DECOMPRESSED_BODY"])
+# Data lifecycle (see retention.py), only enforced when RETENTION_POLICIES is set
+app.config["RETENTION_POLICIES"] = policies_from_env() if os.environ.get("RETENTION_POLICIES") else None
+app.config["RETENTION_INTERVAL"] = int(os.environ.get("RETENTION_INTERVAL", 3600))
+# Raw rows past retention are kept in this columnar archive (see archive.py); empty to disable
+app.config["ARCHIVE_DIR"] = os.environ.get("ARCHIVE_DIR", ARCHIVE_DIR)
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(DATA_FOLDER, exist_ok=True)
 os.makedirs(STATIC_FOLDER, exist_ok=True)
@@ -34,59 +85,14 @@ login_manager.login_view = 'login'
 
 # ------------------ DATABASE SETUP ------------------
 def init_db():
+    """Bring climate_data.db up to the latest schema version (see migrations.py)"""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS climate (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            time TEXT,
-            temperature REAL,
-            humidity REAL,
-            gdd REAL,
-            city TEXT
-        )
-    ''')
-    
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create devices table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS devices (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            location TEXT,
-            api_key TEXT NOT NULL,
-            device_type TEXT DEFAULT 'ESP8266',
-            last_connection TEXT,
-            user_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create readings table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS readings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            device_id INTEGER,
-            temperature REAL,
-            humidity REAL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (device_id) REFERENCES devices (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+    if app.config["RETENTION_POLICIES"]:
+        retention_job.start()
 
 # Simple User model for Flask-Login
 class User(UserMixin):
@@ -109,10 +115,187 @@ def load_user(user_id):
     return None
 
 # ------------------ UTILS ------------------
+db_pool = ConnectionPool(DATABASE, size=app.config["SQLITE_POOL_SIZE"], pragmas=app.config["SQLITE_PRAGMAS"])
+
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # Pooled connection: close() returns it to the pool
+    return db_pool.connect()
+
+column_archive = ColumnArchive(app.config["ARCHIVE_DIR"]) if app.config["ARCHIVE_DIR"] else None
+
+retention_job = RetentionJob(DATABASE, app.config["RETENTION_POLICIES"], archive=column_archive,
+                             interval=app.config["RETENTION_INTERVAL"], pragmas=app.config["SQLITE_PRAGMAS"])
+
+# Schema migrations run once per process, before the first request
+init_db()
+
+# Device readings: monthly partitions, rollups and archive behind one API (see storage.py)
+latest_readings = LatestReadings(capacity=app.config["LATEST_CACHE_SIZE"],
+                                 maxsize=app.config["LATEST_CACHE_DEVICES"],
+                                 ttl=app.config["LATEST_CACHE_TTL"])
+# New rows are pushed to the live streams of the dashboards (see livestream.py)
+live_feed = LiveFeed(queue_size=app.config["LIVE_STREAM_QUEUE"])
+reading_store = ReadingStore('device', get_db_connection, archive=column_archive,
+                             latest_cache=latest_readings, feed=live_feed)
+climate_store = ReadingStore('city', get_db_connection, archive=column_archive, feed=live_feed)
+READING_VALUES = ('temperature', 'humidity')
+# Points per chart series returned by /api/device_data, by default and at most
+CHART_POINTS = 300
+MAX_CHART_POINTS = 5000
+# Windows holding more rows than this many times the points are charted from the rollups
+ROLLUP_CHART_FACTOR = 10
+# Readings per page of /api/device_data and of the exports
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EXPORT_PAGE_SIZE = 5000
+
+CLIMATE_VALUES = ('temperature', 'humidity', 'gdd', 'city')
+# Rows at most of a ?since= delta; its cursor continues from there
+SINCE_ROWS = 1000
+
+def local_climate_rows(rows):
+    """(local time, temperature, humidity, gdd, city) tuples of (ts, *CLIMATE_VALUES) rows"""
+    return [(format_epoch(ts, '%H:%M:%S'),) + tuple(values) for ts, *values in rows]
+
+def today_climate_rows():
+    """(local time, temperature, humidity, gdd, city) of today's climate rows"""
+    return local_climate_rows(climate_store.range_query(None, *today_bounds(), columns=CLIMATE_VALUES))
+
+def climate_rows_since(since=None):
+    """Today's climate rows stored after the ?since= watermark (all of them without one, or with epoch
+    seconds of a previous day) as today_climate_rows(), and the cursor to send as the next watermark.
+
+    ValueError if `since` is neither a cursor nor epoch seconds.
+    """
+    start, end = today_bounds()
+    row_id, after = decode_since(since)
+    if row_id is None and (after is None or after <= start):
+        # Read before the rows: a row stored meanwhile comes again in the next delta, but is never missed
+        cursor = climate_store.watermark()
+        return today_climate_rows(), cursor
+    rows, cursor = climate_store.after(None, since, SINCE_ROWS, columns=CLIMATE_VALUES)
+    # Rows come in insertion order; those stored late for another day are not on today's chart
+    rows = sorted((row for row in rows if start <= row[0] < end), key=lambda row: row[0])
+    return local_climate_rows(rows), cursor
+
+def climate_event(values):
+    """A climate row of a live stream, in the format of /data"""
+    return {"time": format_epoch(values['ts'], '%H:%M:%S'), "temperature": values['temperature'],
+            "humidity": values['humidity'], "gdd": values['gdd'], "city": values['city']}
+
+def reading_event(values):
+    """A reading of a live stream, in the format of /api/device_data"""
+    return {'temperature': values['temperature'], 'humidity': values['humidity'],
+            'timestamp': format_epoch(values['ts'])}
+
+def epoch_arg(name, default=None):
+    """Epoch seconds of a query argument, `default` when absent; raises ValueError when it is invalid"""
+    value = request.args.get(name)
+    return default if value is None else to_epoch(int(value))
+
+def chart_resolution(start, end, periods):
+    """Seconds per period of at most `periods` periods over [start, end), a multiple of a rollup granularity"""
+    resolution = -(-(end - start) // periods)
+    for granularity in (DAY, HOUR, MINUTE):
+        if resolution >= granularity:
+            return -(-resolution // granularity) * granularity
+    return MINUTE
+
+def envelope_series(points, metrics):
+    """Chart series of the min and the max of each metric per period of ReadingStore.aggregate() points"""
+    series = {}
+    for metric in metrics:
+        timestamps, values = [], []
+        for point in points:
+            stats = point[metric]
+            if not stats['count']:
+                continue
+            for value in (stats['min'], stats['max']) if stats['min'] != stats['max'] else (stats['min'],):
+                timestamps.append(format_epoch(point['ts']))
+                values.append(value)
+        series[metric] = {'timestamps': timestamps, 'values': values}
+    return series
+
+def local_readings(rows):
+    """(temperature, humidity, local time text) tuples of (ts, temperature, humidity) rows"""
+    return [(temperature, humidity, format_epoch(ts)) for ts, temperature, humidity in rows]
+
+def write_readings(rows):
+    """Store a group of buffered readings, and fold them into the rollups, in a single transaction"""
+    reading_store.insert_batch(rows)
+
+ingest_buffer = IngestBuffer(
+    write_readings,
+    flush_rows=app.config["INGEST_FLUSH_ROWS"],
+    flush_interval_ms=app.config["INGEST_FLUSH_INTERVAL_MS"],
+    max_queue=app.config["INGEST_MAX_QUEUE"],
+    durability=app.config["INGEST_DURABILITY"]
+)
+
+def write_heartbeats(heartbeats):
+    """Store the coalesced device heartbeats in a single transaction"""
+    conn = get_db_connection()
+    try:
+        update_last_connection(conn.cursor(), heartbeats)
+        conn.commit()
+    finally:
+        conn.close()
+
+heartbeats = HeartbeatTracker(
+    write_heartbeats,
+    interval=app.config["HEARTBEAT_FLUSH_INTERVAL"],
+    online_within=app.config["DEVICE_ONLINE_WITHIN"],
+    offline_after=app.config["DEVICE_OFFLINE_AFTER"]
+)
+
+# Keys of the readings ingested recently, so device retries are rejected without a DB round trip
+recent_readings = RecentKeyFilter(app.config["DEDUP_RECENT_KEYS"])
+
+def store_readings(rows):
+    """Queue (device_id, temperature, humidity, epoch seconds, seq) rows and refresh their devices' heartbeat.
+
+    Returns one flag per row: False for a reading already ingested recently.
+    """
+    keys = [reading_key(row[0], row[3], row[4]) for row in rows]
+    flags = recent_readings.claim(keys)
+    fresh = [row for row, new in zip(rows, flags) if new]
+    if fresh:
+        claimed = [key for key, new in zip(keys, flags) if new]
+        try:
+            future = ingest_buffer.ingest(fresh)
+        except Exception:
+            recent_readings.release(claimed)
+            raise
+        future.add_done_callback(lambda f: f.exception() and recent_readings.release(claimed))
+    heartbeats.touch({row[0] for row in rows})
+    return flags
+
+# API key -> (device_id, user_id, device_name, device_type), invalidated whenever a device key changes
+api_key_cache = ApiKeyCache(maxsize=app.config["API_KEY_CACHE_SIZE"], ttl=app.config["API_KEY_CACHE_TTL"])
+
+def load_device_by_key(api_key):
+    conn = get_db_connection()
+    try:
+        return lookup_devices_by_key(conn.cursor(), [api_key]).get(api_key)
+    finally:
+        conn.close()
+
+def authenticate_device(api_key):
+    """Return (device_id, user_id, device_name, device_type) for an API key, or None if it is unknown"""
+    return api_key_cache.lookup(api_key, load_device_by_key)
+
+rate_limiter = RateLimiter(app.config["INGEST_RATE_LIMITS"])
+
+def too_many_requests(retry_after):
+    response = jsonify({"error": "Too many requests, slow down"})
+    response.headers["Retry-After"] = retry_after_header(retry_after)
+    return response, 429
+
+def server_busy(error):
+    """Backpressure response for a full ingest queue, or readings not written in time"""
+    response = jsonify({"error": "Server busy, retry later"})
+    response.headers["Retry-After"] = retry_after_header(error.retry_after)
+    return response, 503
 
 # ------------------ DASHBOARD ------------------
 @app.route('/')
@@ -238,26 +421,39 @@ def logout():
 
 @app.route('/data')
 def get_data():
-    today = datetime.now().strftime('%Y-%m-%d')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT time, temperature, humidity, gdd, city FROM climate WHERE date = ?", (today,))
-    rows = cursor.fetchall()
-    conn.close()
+    """Today's climate rows, or with ?since=<X-Cursor of the previous response> only those stored since.
+
+    The X-Cursor header of the response is the watermark to send next.
+    """
+    # Today's rows only change with a climate write or with the day
+    tag = etag('data', datetime.now().strftime('%Y-%m-%d'), climate_store.version(), request.args.get('since'))
+    unchanged = not_modified(tag)
+    if unchanged:
+        return unchanged
+    try:
+        rows, cursor = climate_rows_since(request.args.get('since'))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
     result = [
         {"time": row[0], "temperature": row[1], "humidity": row[2], "gdd": row[3], "city": row[4]}
         for row in rows
     ]
-    return jsonify(result)
+    response = with_validators(jsonify(result), tag)
+    response.headers['X-Cursor'] = cursor
+    return response
+
+@app.route('/api/stream/city', defaults={'city': None})
+@app.route('/api/stream/city/<city>')
+def stream_climate(city):
+    """Climate rows of a city (of every city by default) as they are stored, as Server-Sent Events"""
+    return event_response(event_stream(climate_store, live_feed, city, climate_event,
+                                       request.headers.get('Last-Event-ID') or request.args.get('since'),
+                                       app.config["LIVE_STREAM_HEARTBEAT"]))
 
 @app.route('/export-csv')
 def export_csv():
     today = datetime.now().strftime('%Y-%m-%d')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT time, temperature, humidity, gdd, city FROM climate WHERE date = ?", (today,))
-    rows = cursor.fetchall()
-    conn.close()
+    rows = today_climate_rows()
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(['Time', 'Temperature (°C)', 'Humidity (%)', 'GDD', 'City'])
@@ -330,7 +526,6 @@ def download():
 
 @app.route('/iot_dashboard')
 def iot_dashboard():
-    init_db()
     # Retrieve devices from database
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -346,7 +541,10 @@ def iot_dashboard():
     
     # Convert to list of dictionaries for template
     device_list = []
+    device_statuses = {}
     for device in devices:
+        # Heartbeats not flushed yet are more recent than the stored value
+        last_seen = heartbeats.last_seen(device[0], device[6])
         device_list.append({
             'id': device[0],
             'name': device[1],
@@ -354,10 +552,11 @@ def iot_dashboard():
             'api_key': device[3],
             'created_at': device[4],
             'device_type': device[5] or 'ESP8266',
-            'last_connection': device[6]
+            'last_connection': last_seen.strftime(TIMESTAMP_FORMAT) if last_seen else None
         })
+        device_statuses[device[0]] = heartbeats.status(device[0], device[6])
     
-    return render_template('iot.html', devices=device_list)
+    return render_template('iot.html', devices=device_list, device_statuses=device_statuses)
 
 @app.route('/add_device', methods=['POST'])
 @login_required
@@ -381,6 +580,7 @@ def add_device():
     )
     conn.commit()
     conn.close()
+    api_key_cache.invalidate(api_key)
     
     flash('Appareil ajouté avec succès', 'success')
     return redirect(url_for('iot_dashboard'))
@@ -398,12 +598,11 @@ def view_device(device_id):
         flash('Appareil non trouvé', 'danger')
         return redirect(url_for('iot_dashboard'))
     
-    # Get readings for this device
-    cursor.execute("SELECT temperature, humidity, timestamp FROM readings WHERE device_id = ? ORDER BY timestamp DESC LIMIT 100", 
-                  (device_id,))
-    readings = cursor.fetchall()
     conn.close()
     
+    # Get readings for this device
+    readings = local_readings(reading_store.latest(device_id, 100, columns=READING_VALUES))
+    
     # Convert to list of dictionaries for template
     reading_list = []
     for reading in readings:
@@ -446,11 +645,7 @@ def api_auth():
     api_key = data.get('api_key')
     
     # Check if API key is valid
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, name FROM devices WHERE api_key = ?", (api_key,))
-    device = cursor.fetchone()
-    conn.close()
+    device = authenticate_device(api_key)
     
     if not device:
         return jsonify({"error": "Invalid API key"}), 403
@@ -458,13 +653,51 @@ def api_auth():
     return jsonify({
         "success": True, 
         "device_id": device[0],
-        "device_name": device[1],
+        "device_name": device[2],
         "message": "Device authenticated successfully"
     }), 200
 
+def ingest_binary_payload():
+    """Store the readings of a compact binary payload (see payload_codec)"""
+    try:
+        api_key, _, readings = decode_readings(request.get_data())
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+    if len(readings) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Batch too large (max {MAX_BATCH_SIZE} readings)"}), 413
+    try:
+        for epoch, _, _ in readings:
+            check_reading_time(epoch)
+    except ValueError:
+        return jsonify({"error": "Invalid timestamp"}), 400
+    
+    device = authenticate_device(api_key or request.headers.get('X-API-Key'))
+    if not device:
+        return jsonify({"error": "Invalid API key"}), 403
+    
+    retry_after = rate_limiter.acquire(device[0], device[3])
+    if retry_after:
+        return too_many_requests(retry_after)
+    
+    device_id = device[0]
+    rows = [
+        (device_id, temperature, humidity, epoch, None)
+        for epoch, temperature, humidity in readings
+    ]
+    try:
+        flags = store_readings(rows)
+    except IngestError as e:
+        return server_busy(e)
+    
+    stored = sum(flags)
+    return jsonify({"success": True, "stored": stored, "duplicates": len(rows) - stored}), 200
+
 @app.route('/api/data', methods=['POST'])
 def api_data():
     """Receive data from an IoT device"""
+    if request.mimetype == BINARY_CONTENT_TYPE:
+        return ingest_binary_payload()
+    
     data = request.get_json()
     
     if not data:
@@ -476,39 +709,189 @@ def api_data():
             return jsonify({"error": f"Missing required field: {field}"}), 400
             
     api_key = data.get('api_key')
-    temperature = data.get('temperature')
-    humidity = data.get('humidity')
-    timestamp = data.get('timestamp', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    try:
+        temperature, humidity = reading_values(data, ('temperature', 'humidity'))
+        # Optional per-device sequence number, to tell apart readings taken within the same second
+        seq = reading_seq(data.get('seq'))
+    except InvalidField as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        timestamp = to_epoch(data.get('timestamp') or None)
+        if timestamp is not None:
+            check_reading_time(timestamp)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid timestamp"}), 400
+    if timestamp is None:
+        timestamp, seq = server_stamp() if seq is None else (to_epoch(datetime.now()), seq)
     
     # Check if API key is valid and get device ID
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM devices WHERE api_key = ?", (api_key,))
-    device = cursor.fetchone()
+    device = authenticate_device(api_key)
     
     if not device:
-        conn.close()
         return jsonify({"error": "Invalid API key"}), 403
+    
+    retry_after = rate_limiter.acquire(device[0], device[3])
+    if retry_after:
+        return too_many_requests(retry_after)
         
     device_id = device[0]
     
-    # Store the data in the database
-    cursor.execute(
-        "INSERT INTO readings (device_id, temperature, humidity, timestamp) VALUES (?, ?, ?, ?)",
-        (device_id, temperature, humidity, timestamp)
-    )
-    conn.commit()
-    conn.close()
+    # Hand the reading to the write-behind buffer for the next group commit
+    try:
+        stored, = store_readings([(device_id, temperature, humidity, timestamp, seq)])
+    except IngestError as e:
+        return server_busy(e)
+    
+    if not stored:
+        # Acknowledge a retry so the device stops sending it, without storing it twice
+        return jsonify({
+            "success": True,
+            "duplicate": True,
+            "message": "Reading already received"
+        }), 200
     
     return jsonify({
         "success": True,
         "message": "Data received and stored successfully"
     }), 200
 
+@app.route('/api/data/batch', methods=['POST'])
+def api_data_batch():
+    """Receive several readings, possibly from several devices, in a single transaction"""
+    if request.mimetype == BINARY_CONTENT_TYPE:
+        return ingest_binary_payload()
+    
+    data = request.get_json(silent=True)
+    items = extract_batch(data)
+    
+    if not items:
+        return jsonify({"error": "No readings provided"}), 400
+    
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Batch too large (max {MAX_BATCH_SIZE} readings)"}), 413
+    
+    # A top-level api_key applies to every reading that does not carry its own
+    default_api_key = data.get('api_key') if isinstance(data, dict) else None
+    
+    accepted_status = "stored" if ingest_buffer.durability == DURABILITY_FLUSH else "queued"
+    results = []
+    accepted = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({"index": index, "status": "error", "error": "Reading must be an object"})
+            continue
+        
+        reading = dict(item)
+        reading.setdefault('api_key', default_api_key)
+        missing = missing_fields(reading, ['api_key', 'temperature', 'humidity'])
+        if missing:
+            results.append({"index": index, "status": "error", "error": f"Missing required field: {missing[0]}"})
+            continue
+        try:
+            reading['temperature'], reading['humidity'] = reading_values(reading, ('temperature', 'humidity'))
+            reading['seq'] = reading_seq(reading.get('seq'))
+        except InvalidField as e:
+            results.append({"index": index, "status": "error", "error": str(e)})
+            continue
+        try:
+            reading['ts'] = to_epoch(reading.get('timestamp') or None)
+            if reading['ts'] is not None:
+                check_reading_time(reading['ts'])
+        except (TypeError, ValueError):
+            results.append({"index": index, "status": "error", "error": "Invalid timestamp"})
+            continue
+        
+        result = {"index": index, "status": accepted_status}
+        results.append(result)
+        accepted.append((result, reading))
+    
+    # Only the keys missing from the cache cost a query
+    devices = {}
+    unknown_keys = set()
+    for _, reading in accepted:
+        api_key = reading['api_key']
+        if api_key not in devices and api_key not in unknown_keys:
+            device = api_key_cache.get(api_key)
+            if device:
+                devices[api_key] = device
+            else:
+                unknown_keys.add(api_key)
+    if unknown_keys:
+        conn = get_db_connection()
+        found = lookup_devices_by_key(conn.cursor(), unknown_keys)
+        conn.close()
+        for api_key, device in found.items():
+            api_key_cache.put(api_key, device)
+        devices.update(found)
+    
+    # The batch counts as one request for every device it carries readings from
+    throttled = {}
+    for device in devices.values():
+        retry_after = rate_limiter.acquire(device[0], device[3])
+        if retry_after:
+            throttled[device[0]] = retry_after
+    
+    now = to_epoch(datetime.now())
+    rows = []
+    row_results = []
+    for result, reading in accepted:
+        device = devices.get(reading['api_key'])
+        if device is None:
+            result.update(status="error", error="Invalid API key")
+            continue
+        if device[0] in throttled:
+            result.update(status="rate_limited", error="Too many requests, slow down")
+            continue
+        timestamp, seq = reading['ts'], reading.get('seq')
+        if timestamp is None:
+            timestamp, seq = server_stamp() if seq is None else (now, seq)
+        rows.append((device[0], reading['temperature'], reading['humidity'], timestamp, seq))
+        row_results.append(result)
+    
+    # The whole batch goes into the same group commit
+    duplicates = 0
+    if rows:
+        try:
+            flags = store_readings(rows)
+        except IngestError as e:
+            return server_busy(e)
+        for result, new in zip(row_results, flags):
+            if not new:
+                result["status"] = "duplicate"
+                duplicates += 1
+    
+    if throttled and not rows:
+        return too_many_requests(max(throttled.values()))
+    
+    return jsonify({
+        "success": True,
+        "stored": len(rows) - duplicates,
+        "duplicates": duplicates,
+        "rejected": len(results) - len(rows),
+        "results": results
+    }), 200
+
 @app.route('/api/device_data/<int:device_id>')
 @login_required
 def api_device_data(device_id):
-    """Get the latest data for a specific device"""
+    """Get the latest data for a specific device.
+
+    With ?resolution=<seconds> (and optionally ?start= and ?end= in epoch seconds,
+    the last 30 days by default), return per-period statistics, read from the rollups
+    when the resolution is a multiple of a minute.
+
+    With ?from=, ?to= (epoch seconds, the last day by default) or ?max_points=, return
+    the series of each metric over that window, downsampled to at most max_points
+    points (LTTB), or made of the min and max per period from the rollups when the
+    window holds more than ROLLUP_CHART_FACTOR times max_points readings.
+
+    Otherwise return the latest readings, or with ?cursor= (and ?limit=) the page of
+    older readings following that cursor, and the next_cursor of the next page. With
+    ?since=<cursor or epoch seconds>, return only the readings stored after it, even
+    those with an older timestamp. The latest readings and the delta come with the
+    `cursor` to send as the next ?since=. These carry an ETag, and a request with a
+    current If-None-Match gets a 304.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -521,17 +904,83 @@ def api_device_data(device_id):
         conn.close()
         return jsonify({"error": "Device not found or unauthorized"}), 404
     
-    # Get the latest 100 readings
-    cursor.execute("""
-        SELECT temperature, humidity, timestamp 
-        FROM readings 
-        WHERE device_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT 100
-    """, (device_id,))
-    readings = cursor.fetchall()
+    if 'resolution' in request.args:
+        conn.close()
+        try:
+            resolution = int(request.args['resolution'])
+            end = epoch_arg('end', to_epoch(datetime.now()))
+            start = epoch_arg('start', end - 30 * 86400)
+        except (TypeError, ValueError):
+            return jsonify({"error": "resolution, start and end must be integers"}), 400
+        if resolution <= 0:
+            return jsonify({"error": "resolution must be a positive number of seconds"}), 400
+        points = reading_store.aggregate(device_id, start, end, resolution)
+        return jsonify({"success": True, "resolution": resolution, "series": points}), 200
+    
     conn.close()
     
+    if any(name in request.args for name in ('from', 'to', 'max_points')):
+        try:
+            end = epoch_arg('to', to_epoch(datetime.now()))
+            start = epoch_arg('from', end - 86400)
+            max_points = int(request.args.get('max_points', CHART_POINTS))
+        except (TypeError, ValueError):
+            return jsonify({"error": "from, to and max_points must be integers"}), 400
+        if start >= end:
+            return jsonify({"error": "from must be before to"}), 400
+        if not 3 <= max_points <= MAX_CHART_POINTS:
+            return jsonify({"error": f"max_points must be between 3 and {MAX_CHART_POINTS}"}), 400
+        # Large windows: the min and max of each period, from the rollups
+        resolution = chart_resolution(start, end, max_points // 2)
+        points = reading_store.aggregate(device_id, start, end, resolution)
+        count = sum(max(point[metric]['count'] for metric in READING_VALUES) for point in points)
+        if count > ROLLUP_CHART_FACTOR * max_points:
+            return jsonify({"success": True, "from": start, "to": end, "count": count, "resolution": resolution,
+                            "series": envelope_series(points, READING_VALUES)}), 200
+        rows = reading_store.range_query(device_id, start, end, columns=READING_VALUES)
+        series = {}
+        for i, metric in enumerate(READING_VALUES):
+            timestamps, values = downsample([row[0] for row in rows], [row[1 + i] for row in rows], max_points)
+            series[metric] = {'timestamps': [format_epoch(ts) for ts in timestamps], 'values': values}
+        return jsonify({"success": True, "from": start, "to": end, "count": len(rows), "series": series}), 200
+    
+    # The readings only change with a write to the device's series
+    version, updated_at = reading_store.version(device_id)
+    tag = etag('device_data', device_id, version, request.full_path)
+    unchanged = not_modified(tag, updated_at)
+    if unchanged:
+        return unchanged
+    
+    cursor = None
+    if 'since' in request.args:
+        # The readings stored after the client's watermark, whatever their timestamp, at most SINCE_ROWS
+        try:
+            rows, cursor = reading_store.after(device_id, request.args['since'], SINCE_ROWS, columns=READING_VALUES)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        rows.sort(key=lambda row: row[0], reverse=True)
+        next_cursor = None
+    elif 'cursor' in request.args or 'limit' in request.args:
+        # The page of readings following ?cursor=, the next_cursor of the previous page
+        try:
+            limit = int(request.args.get('limit', PAGE_SIZE))
+        except (TypeError, ValueError):
+            return jsonify({"error": "limit must be an integer"}), 400
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+        try:
+            rows, next_cursor = reading_store.page(device_id, request.args.get('cursor'), limit, columns=READING_VALUES)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+    else:
+        # Get the latest readings; the watermark is read first, so a reading stored meanwhile
+        # may come again with the next ?since=, but is never missed
+        cursor = reading_store.watermark()
+        rows = reading_store.latest(device_id, PAGE_SIZE, columns=READING_VALUES + ('seq',), version=version)
+        next_cursor = encode_cursor(rows[-1][0], rows[-1][3]) if len(rows) == PAGE_SIZE else None
+        rows = [row[:3] for row in rows]
+    readings = local_readings(rows)
+    
     reading_list = []
     for reading in readings:
         reading_list.append({
@@ -540,7 +989,42 @@ def api_device_data(device_id):
             'timestamp': reading[2]
         })
     
-    return jsonify({"success": True, "readings": reading_list}), 200
+    response = jsonify({"success": True, "readings": reading_list, "next_cursor": next_cursor, "cursor": cursor})
+    return with_validators(response, tag, updated_at), 200
+
+@app.route('/api/stream/device/<int:device_id>')
+@login_required
+def stream_device_data(device_id):
+    """Readings of a device as they are stored, as Server-Sent Events.
+
+    Each event is a reading in the format of /api/device_data, with its watermark as
+    id: a reconnecting browser sends it as Last-Event-ID and gets the readings it missed.
+    """
+    conn = get_db_connection()
+    device = conn.execute("SELECT id FROM devices WHERE id = ? AND user_id = ?",
+                          (device_id, current_user.id)).fetchone()
+    conn.close()
+    if not device:
+        return jsonify({"error": "Device not found or unauthorized"}), 404
+    return event_response(event_stream(reading_store, live_feed, device_id, reading_event,
+                                       request.headers.get('Last-Event-ID') or request.args.get('since'),
+                                       app.config["LIVE_STREAM_HEARTBEAT"]))
+
+@app.route('/api/ingest_stats')
+@login_required
+def api_ingest_stats():
+    """Counters of the ingestion path (write-behind buffer, API key cache, connection pool)"""
+    return jsonify({
+        "ingest_buffer": ingest_buffer.stats(),
+        "api_key_cache": api_key_cache.stats(),
+        "latest_readings": latest_readings.stats(),
+        "live_feed": live_feed.stats(),
+        "db_pool": db_pool.stats(),
+        "heartbeats": heartbeats.stats(),
+        "recent_readings": recent_readings.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "retention": retention_job.stats()
+    }), 200
 
 @app.route('/export_device_data/<int:device_id>')
 @login_required
@@ -564,61 +1048,63 @@ def export_device_data(device_id):
     
     device_name = device[0]
     
-    # Determine date filter based on range
-    date_filter = ""
+    # Determine date filter based on range: an integer bound the index can seek to
+    since = 0
     if date_range != 'all':
         days = int(date_range)
-        date_filter = f"AND datetime(timestamp) >= datetime('now', '-{days} days')"
-    
-    # Get readings
-    cursor.execute(f"""
-        SELECT temperature, humidity, timestamp 
-        FROM readings 
-        WHERE device_id = ? {date_filter}
-        ORDER BY timestamp DESC
-    """, (device_id,))
-    readings = cursor.fetchall()
+        since = to_epoch(datetime.now() - timedelta(days=days))
+    
     conn.close()
     
-    if not readings:
+    if file_format not in ('csv', 'json'):
+        flash('Format d\'exportation non valide', 'danger')
+        return redirect(url_for('view_device', device_id=device_id))
+    
+    # Readings are streamed page by page, older ones from the archive
+    rows, cursor = reading_store.page(device_id, limit=EXPORT_PAGE_SIZE, columns=READING_VALUES, start=since)
+    if not rows:
         flash('Aucune donnée disponible pour l\'exportation', 'warning')
         return redirect(url_for('view_device', device_id=device_id))
     
+    def pages():
+        nonlocal rows, cursor
+        yield local_readings(rows)
+        while cursor:
+            rows, cursor = reading_store.page(device_id, cursor, EXPORT_PAGE_SIZE, columns=READING_VALUES, start=since)
+            yield local_readings(rows)
+    
+    download_name = f'{device_name}_data_{datetime.now().strftime("%Y%m%d")}.{file_format}'
+    headers = {'Content-Disposition': f'attachment; filename="{download_name}"'}
+    
     # Export as CSV
     if file_format == 'csv':
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['Timestamp', 'Temperature (°C)', 'Humidity (%)'])
-        writer.writerows(readings)
-        output.seek(0)
+        def generate_csv():
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(['Timestamp', 'Temperature (°C)', 'Humidity (%)'])
+            for readings in pages():
+                writer.writerows(readings)
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
         
-        return send_file(
-            io.BytesIO(output.getvalue().encode('utf-8')),
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'{device_name}_data_{datetime.now().strftime("%Y%m%d")}.csv'
-        )
+        return Response(stream_with_context(generate_csv()), mimetype='text/csv', headers=headers)
     
     # Export as JSON
-    elif file_format == 'json':
-        json_data = []
-        for reading in readings:
-            json_data.append({
-                'timestamp': reading[2],
-                'temperature': reading[0],
-                'humidity': reading[1]
-            })
-        
-        return send_file(
-            io.BytesIO(json.dumps(json_data, indent=2).encode('utf-8')),
-            mimetype='application/json',
-            as_attachment=True,
-            download_name=f'{device_name}_data_{datetime.now().strftime("%Y%m%d")}.json'
-        )
+    def generate_json():
+        separator = '[\n'
+        for readings in pages():
+            for reading in readings:
+                item = json.dumps({
+                    'timestamp': reading[2],
+                    'temperature': reading[0],
+                    'humidity': reading[1]
+                }, indent=2)
+                yield separator + textwrap.indent(item, '  ')
+                separator = ',\n'
+        yield '\n]'
     
-    # Invalid format
-    flash('Format d\'exportation non valide', 'danger')
-    return redirect(url_for('view_device', device_id=device_id))
+    return Response(stream_with_context(generate_json()), mimetype='application/json', headers=headers)
 
 @app.route('/delete_device/<int:device_id>', methods=['POST'])
 @login_required
@@ -628,7 +1114,7 @@ def delete_device(device_id):
     cursor = conn.cursor()
     
     # Verify device belongs to current user
-    cursor.execute("SELECT id FROM devices WHERE id = ? AND user_id = ?", 
+    cursor.execute("SELECT id, api_key FROM devices WHERE id = ? AND user_id = ?", 
                   (device_id, current_user.id))
     device = cursor.fetchone()
     
@@ -638,19 +1124,20 @@ def delete_device(device_id):
         return redirect(url_for('iot_dashboard'))
     
     # Delete all readings for this device
-    cursor.execute("DELETE FROM readings WHERE device_id = ?", (device_id,))
+    reading_store.delete(device_id, conn=conn)
     
     # Delete the device
     cursor.execute("DELETE FROM devices WHERE id = ?", (device_id,))
     
     conn.commit()
     conn.close()
+    reading_store.purge_archive(device_id)
+    api_key_cache.invalidate(device[1])
     
     flash('Appareil supprimé avec succès', 'success')
     return redirect(url_for('iot_dashboard'))
 
 # ------------------ LANCEMENT ------------------
 if __name__ == "__main__":
-    init_db()
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, port=port)
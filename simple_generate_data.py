@@ -1,9 +1,11 @@
 """
 Script simplifié de génération de données météorologiques simulées
 """
-import sqlite3
 import numpy as np
 from datetime import datetime, timedelta
+from epoch import to_epoch
+from migrations import CLIMATE_MIGRATIONS
+from storage import ReadingStore, connector
 import random
 import os
 
@@ -101,38 +103,14 @@ def generate_weather_data():
 
 def save_to_db(data):
     """Sauvegarde les données dans la base de données SQLite"""
-    conn = sqlite3.connect('climate_data.db')
-    cursor = conn.cursor()
-    
-    # Créer la table si elle n'existe pas
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS climate (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            time TEXT,
-            temperature REAL,
-            humidity REAL,
-            gdd REAL,
-            city TEXT
-        )
-    ''')
+    climate_store = ReadingStore('city', connector('climate_data.db', migrations=CLIMATE_MIGRATIONS))
     
     # Insertion des données
-    for item in data:
-        cursor.execute('''
-            INSERT INTO climate (date, time, temperature, humidity, gdd, city)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            item['date'], 
-            item['time'], 
-            item['temperature'], 
-            item['humidity'], 
-            item['gdd'], 
-            item['city']
-        ))
+    climate_store.insert_batch([
+        (to_epoch(f"{item['date']} {item['time']}"), item['temperature'], item['humidity'], item['gdd'], item['city'])
+        for item in data
+    ])
     
-    conn.commit()
-    conn.close()
     print(f"Données sauvegardées dans la table 'climate' ({len(data)} entrées)")
 
 if __name__ == "__main__":
@@ -59,36 +59,89 @@ const humidityChart = new Chart(
     }
 );
 
-// Fonction de mise à jour des données
-function updateData() {
-    fetch('/data')
-        .then(response => response.json())
-        .then(data => {
-            // Mise à jour des valeurs actuelles
-            if (data.length > 0) {
-                document.getElementById('current-temp').textContent = data[0].temperature.toFixed(1);
-                document.getElementById('current-humidity').textContent = data[0].humidity.toFixed(1);
-                document.getElementById('current-gdd').textContent = data[0].gdd.toFixed(2);
-                document.getElementById('last-update').textContent = new Date().toLocaleString();
-            }
+// ETag des dernières données reçues : le serveur répond 304 si rien n'a changé
+let dataEtag = null;
+// Curseur du dernier relevé reçu : seuls les relevés suivants sont demandés (?since=)
+let dataCursor = null;
+// Jour des relevés affichés : un nouveau jour recharge les graphiques
+let dataDay = null;
 
-            // Préparation des données pour les graphiques
-            const times = data.map(item => item.time).reverse();
-            const temps = data.map(item => item.temperature).reverse();
-            const humidity = data.map(item => item.humidity).reverse();
+// Affichage des valeurs actuelles : le relevé le plus récent
+function showCurrentValues(item) {
+    document.getElementById('current-temp').textContent = item.temperature.toFixed(1);
+    document.getElementById('current-humidity').textContent = item.humidity.toFixed(1);
+    document.getElementById('current-gdd').textContent = item.gdd.toFixed(2);
+    document.getElementById('last-update').textContent = new Date().toLocaleString();
+}
 
-            // Mise à jour des graphiques
-            tempChart.data.labels = times;
-            tempChart.data.datasets[0].data = temps;
-            tempChart.update();
+// Ajout de relevés, dans l'ordre chronologique, à la fin des graphiques
+function appendData(data) {
+    if (data.length === 0) {
+        return;
+    }
+    showCurrentValues(data[data.length - 1]);
 
-            humidityChart.data.labels = times;
-            humidityChart.data.datasets[0].data = humidity;
-            humidityChart.update();
+    data.forEach(item => {
+        tempChart.data.labels.push(item.time);
+        tempChart.data.datasets[0].data.push(item.temperature);
+        humidityChart.data.labels.push(item.time);
+        humidityChart.data.datasets[0].data.push(item.humidity);
+    });
+    tempChart.update();
+    humidityChart.update();
+}
+
+// Fonction de mise à jour des données : le jour entier au premier appel, puis les nouveaux relevés
+function updateData() {
+    const today = new Date().toDateString();
+    if (today !== dataDay) {
+        dataCursor = null;
+        dataEtag = null;
+    }
+    const url = dataCursor ? `/data?since=${encodeURIComponent(dataCursor)}` : '/data';
+    return fetch(url, { headers: dataEtag ? { 'If-None-Match': dataEtag } : {} })
+        .then(response => {
+            if (response.status === 304) {
+                return null;
+            }
+            dataEtag = response.headers.get('ETag');
+            return response.json().then(data => {
+                if (!dataCursor) {
+                    // Nouveau jour : les graphiques repartent de zéro
+                    [tempChart, humidityChart].forEach(chart => {
+                        chart.data.labels = [];
+                        chart.data.datasets[0].data = [];
+                    });
+                    dataDay = today;
+                }
+                dataCursor = response.headers.get('X-Cursor');
+                appendData(data);
+            });
         })
         .catch(error => console.error('Erreur lors de la récupération des données:', error));
 }
 
-// Mise à jour initiale et rafraîchissement toutes les 5 minutes
-updateData();
-setInterval(updateData, 300000);
+// Flux en direct : le serveur pousse chaque nouveau relevé (Server-Sent Events), à partir du
+// dernier relevé chargé. Après une coupure, le navigateur se reconnecte et reçoit les relevés manqués.
+function openLiveStream() {
+    const stream = new EventSource(`/api/stream/city?since=${encodeURIComponent(dataCursor || '')}`);
+    stream.onmessage = event => {
+        if (new Date().toDateString() !== dataDay) {
+            // Premier relevé d'un nouveau jour : rechargement complet
+            updateData();
+            return;
+        }
+        dataCursor = event.lastEventId;
+        appendData([JSON.parse(event.data)]);
+    };
+    stream.onerror = () => console.error('Flux en direct interrompu, reconnexion...');
+}
+
+// Chargement initial, puis mises à jour en direct (ou des nouveaux relevés toutes les 5 minutes sans EventSource)
+updateData().then(() => {
+    if (window.EventSource) {
+        openLiveStream();
+    } else {
+        setInterval(updateData, 300000);
+    }
+});
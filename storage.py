@@ -0,0 +1,413 @@
+"""
+Storage repository of the time series: device readings and climate rows.
+
+Both apps, the ingestion server, the generators and the CLI scripts read and
+write the series through `ReadingStore`, a single implementation over SQLite
+whose layouts only describe where each kind of series lives:
+
+    device   readings of simple_app.py, monthly partitions of climate_data.db
+    reading  readings of app.py, `reading` table of weather_dashboard.db
+    city     climate rows, `climate_samples` of climate_data.db, by city
+
+so that batching, pooling, partition pruning, rollups and the archive apply
+to every caller at once. Timestamps are epoch seconds throughout; row ids
+grow in insertion order (see watermarks.py).
+"""
+import sqlite3
+
+from archive import COLUMNS as ARCHIVE_COLUMNS
+from db_pool import apply_pragmas, pragmas_from_env
+from ingest import insert_climate, insert_readings
+from migrations import migrate
+from partitions import reading_partitions
+from rollups import METRICS as ROLLUP_METRICS, catch_up, choose_granularity, forget_device, merge_stats, series, to_points
+import versions
+import watermarks
+
+
+class StoreLayout:
+    """Where a kind of series is stored.
+
+    `columns` is the order of the rows given to insert_batch(); `key` and `ts`
+    name the series and timestamp columns among them.
+    """
+
+    def __init__(self, kind, table, key, ts, columns, metrics, partitioned=False, rollups=False):
+        self.kind = kind
+        self.table = table
+        self.key = key
+        self.ts = ts
+        self.columns = columns
+        self.metrics = metrics
+        self.partitioned = partitioned
+        self.rollups = rollups
+
+    @property
+    def values(self):
+        """Columns other than the key and the timestamp"""
+        return tuple(column for column in self.columns if column not in (self.key, self.ts))
+
+    def tables(self, conn, start=None, end=None):
+        """Tables that may hold rows of [start, end), newest first"""
+        if self.partitioned:
+            return reading_partitions.tables_for_range(conn, start, end)
+        return [self.table]
+
+    def insert(self, conn, rows):
+        """(after, ids) of the inserted rows, see ReadingPartitions.insert"""
+        if self.kind == 'device':
+            return insert_readings(conn.cursor(), rows)
+        if self.kind == 'city':
+            return insert_climate(conn.cursor(), rows)
+        first = watermarks.allocate(conn, self.kind, len(rows))
+        conn.executemany(
+            f"INSERT OR IGNORE INTO {self.table} (id, {', '.join(self.columns)}) "
+            f"VALUES (?, {', '.join('?' * len(self.columns))})",
+            [(first + i,) + tuple(row) for i, row in enumerate(rows)]
+        )
+        kept = watermarks.inserted(conn, self.table, first, first + len(rows) - 1)
+        return first - 1, [first + i if first + i in kept else None for i in range(len(rows))]
+
+    def last_id(self, conn):
+        """Greatest row id handed out so far: rows stored later get greater ones"""
+        if self.kind == 'city':
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (self.table,)).fetchone()
+            return row[0] if row else 0
+        return watermarks.last_id(conn, self.kind)
+
+
+LAYOUTS = {
+    'device': StoreLayout('device', 'reading_samples', 'device_id', 'ts',
+                          ('device_id', 'temperature', 'humidity', 'ts', 'seq'),
+                          ROLLUP_METRICS, partitioned=True, rollups=True),
+    'reading': StoreLayout('reading', 'reading', 'device_id', 'timestamp',
+                           ('timestamp', 'temperature', 'humidity', 'pressure', 'rainfall',
+                            'wind_speed', 'wind_direction', 'device_id', 'seq'),
+                           ('temperature', 'humidity', 'pressure', 'rainfall', 'wind_speed')),
+    'city': StoreLayout('city', 'climate_samples', 'city', 'ts',
+                        ('ts', 'temperature', 'humidity', 'gdd', 'city'),
+                        ROLLUP_METRICS, rollups=True),
+}
+
+
+def connector(database, pragmas=None, migrations=None):
+    """Connection factory for scripts without a pool; `migrations` are applied on the first connection"""
+    pragmas = pragmas if pragmas is not None else pragmas_from_env()
+    pending = [migrations]
+
+    def connect():
+        conn = sqlite3.connect(database)
+        apply_pragmas(conn, pragmas)
+        if pending[0] is not None:
+            migrate(conn, pending[0])
+            pending[0] = None
+        return conn
+    return connect
+
+
+def encode_cursor(ts, seq):
+    """Opaque cursor of the position of a row, given by its timestamp and seq"""
+    return f"{ts}_{-1 if seq is None else seq}"
+
+
+def decode_cursor(cursor):
+    """(ts, seq) of a cursor; ValueError if it is not one"""
+    ts, seq = str(cursor).split('_')
+    return int(ts), int(seq)
+
+
+def encode_watermark(row_id):
+    """Opaque ?since= cursor of the rows stored after the row `row_id`"""
+    return f"w{row_id}"
+
+
+def decode_since(since):
+    """(row id, first epoch second) of a client's ?since= watermark for after().
+
+    The watermark is a cursor of encode_watermark(), or epoch seconds for the rows
+    of later seconds. (None, None) if there is none; ValueError if it is neither.
+    """
+    if not since:
+        return None, None
+    since = str(since)
+    if since.isdigit():
+        return None, int(since) + 1
+    if since[:1] == 'w' and since[1:].isdigit():
+        return int(since[1:]), None
+    raise ValueError(f"Invalid watermark: {since}")
+
+
+class ReadingStore:
+    """insert_batch / range_query / latest / aggregate over one kind of series.
+
+    `connect` returns a connection, e.g. ConnectionPool.connect. Every method also
+    takes an open connection, to run inside the caller's transaction; it then
+    leaves committing to the caller.
+    """
+
+    def __init__(self, kind, connect, archive=None, latest_cache=None, feed=None):
+        self.layout = LAYOUTS[kind]
+        self.connect = connect
+        # ColumnArchive holding the rows past retention, merged into range queries
+        self.archive = archive
+        # LatestReadings answering latest() from memory
+        self.latest_cache = latest_cache
+        # LiveFeed receiving the rows once committed, for the live streams
+        self.feed = feed
+
+    def _run(self, conn, work):
+        if conn is not None:
+            return work(conn)
+        conn = self.connect()
+        try:
+            result = work(conn)
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    def _cache_item(self, row):
+        """(ts, tag, row) item of the latest cache for a (ts, *layout.values) row"""
+        values = self.layout.values
+        return row[0], row[1 + values.index('seq')] if 'seq' in values else row, row
+
+    def insert_batch(self, rows, conn=None):
+        """Insert rows (tuples in layout.columns order) in one transaction, updating the rollups.
+
+        Rows already stored (same series, timestamp and seq) are skipped.
+        """
+        def work(conn):
+            stored = self.layout.insert(conn, rows)
+            if self.layout.rollups:
+                catch_up(conn)
+            key = self.layout.columns.index(self.layout.key)
+            keys = {row[key] for row in rows}
+            versions.bump(conn, self.layout.kind, keys)
+            if self.latest_cache is not None:
+                return stored, {key: versions.version(conn, self.layout.kind, key)[0] for key in keys}
+            return stored, None
+        if not rows:
+            return 0
+        (after, ids), written = self._run(conn, work)
+        if self.latest_cache is not None:
+            columns = self.layout.columns
+            key, ts = columns.index(self.layout.key), columns.index(self.layout.ts)
+            values = [columns.index(column) for column in self.layout.values]
+            by_key = {}
+            for row in rows:
+                by_key.setdefault(row[key], []).append((row[ts],) + tuple(row[i] for i in values))
+            for series_key, series_rows in by_key.items():
+                if conn is None:
+                    self.latest_cache.add(series_key, [self._cache_item(row) for row in series_rows],
+                                          written[series_key])
+                else:
+                    # The caller's transaction may still be rolled back
+                    self.latest_cache.invalidate(series_key)
+        if self.feed is not None and conn is None:
+            self._publish(rows, after, ids)
+        return len(rows)
+
+    def _publish(self, rows, after, ids):
+        """Hand committed rows to the live feed as {column: value} events, with their id, in insertion order"""
+        layout = self.layout
+        events = []
+        for row, row_id in zip(rows, ids):
+            if row_id is not None:
+                values = dict(zip(layout.columns, row), id=row_id)
+                events.append((values[layout.key], values))
+        self.feed.publish(layout.kind, events, after, after + len(rows))
+
+    def range_query(self, key, start=None, end=None, columns=None, limit=None, newest_first=False, conn=None):
+        """Rows (ts, *columns) of a series over [start, end), oldest first unless `newest_first`.
+
+        `key` None reads every series; `columns` defaults to layout.values. Without a
+        limit, rows already moved to the archive are included.
+        """
+        layout = self.layout
+        columns = tuple(columns or layout.values)
+        conditions, params = [], []
+        if key is not None:
+            conditions.append(f"{layout.key} = ?")
+            params.append(key)
+        if start is not None:
+            conditions.append(f"{layout.ts} >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append(f"{layout.ts} < ?")
+            params.append(end)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = f" ORDER BY {layout.ts} {'DESC' if newest_first else 'ASC'}"
+        if limit is not None:
+            order += f" LIMIT {int(limit)}"
+
+        def work(conn):
+            found = []
+            for table in layout.tables(conn, start, end):
+                # Partitions come newest first and never overlap: stop once the limit is reached
+                if newest_first and limit is not None and len(found) >= limit and table != layout.table:
+                    continue
+                found.extend(tuple(row) for row in conn.execute(
+                    f"SELECT {layout.ts}, {', '.join(columns)} FROM {table}{where}{order}", params))
+            if (self.archive and limit is None and key is not None
+                    and set(columns) <= set(ARCHIVE_COLUMNS.get(layout.kind, ()))):
+                found = self.archive.history(layout.kind, key, found, start, end, columns)
+            found.sort(key=lambda row: row[0], reverse=newest_first)
+            return found[:limit] if limit is not None else found
+        return self._run(conn, work)
+
+    def latest(self, key, limit=100, columns=None, conn=None, version=None):
+        """The `limit` most recent rows (ts, *columns) of a series, newest first.
+
+        Served from the latest cache when there is one, provided it holds `version`
+        of the series if given (see version()).
+        """
+        if self.latest_cache is not None and conn is None and key is not None:
+            rows = self.latest_cache.latest(key, limit, lambda capacity: [
+                self._cache_item(row) for row in self.range_query(key, limit=capacity, newest_first=True)
+            ], version)
+            if rows is not None:
+                values = self.layout.values
+                selected = [1 + values.index(column) for column in columns or values]
+                return [(row[0],) + tuple(row[i] for i in selected) for row in rows]
+        return self.range_query(key, columns=columns, limit=limit, newest_first=True, conn=conn)
+
+    def page(self, key, cursor=None, limit=100, columns=None, start=None, conn=None):
+        """A page of `limit` rows (ts, *columns) of a series, newest first, and the cursor of the next one.
+
+        Rows are ordered by (ts, seq), the key of the unique index, and a page starts
+        right after its cursor: each page is a single index seek whatever its depth, and
+        cursors stay valid while readings are inserted. The next cursor is None after the
+        last page. Rows already moved to the archive are included.
+        """
+        layout = self.layout
+        if 'seq' not in layout.columns:
+            raise ValueError(f"No seq to order {layout.kind} rows by")
+        columns = tuple(columns or layout.values)
+        before = decode_cursor(cursor) if cursor else None
+        conditions, params = [f"{layout.key} = ?"], [key]
+        if before is not None:
+            conditions.append(f"({layout.ts}, IFNULL(seq, -1)) < (?, ?)")
+            params.extend(before)
+        if start is not None:
+            conditions.append(f"{layout.ts} >= ?")
+            params.append(start)
+        query = (f"SELECT {layout.ts}, IFNULL(seq, -1), {', '.join(columns)} FROM {{table}} "
+                 f"WHERE {' AND '.join(conditions)} ORDER BY {layout.ts} DESC, IFNULL(seq, -1) DESC LIMIT {int(limit)}")
+
+        def work(conn):
+            # A reading may be both in a partition and in the unpartitioned table, or in the archive
+            found = {}
+            for table in layout.tables(conn, start, before[0] + 1 if before else None):
+                if len(found) >= limit and table != layout.table:
+                    continue
+                for row in conn.execute(query.format(table=table), params):
+                    found.setdefault(tuple(row[:2]), tuple(row))
+            if self.archive and set(columns) <= set(ARCHIVE_COLUMNS.get(layout.kind, ())):
+                # Only archived rows newer than the last row of a full page can be part of it
+                oldest = sorted(found)[-limit][0] if len(found) >= limit else None
+                bounds = [bound for bound in (start, oldest) if bound is not None]
+                after = max(bounds) if bounds else None
+                for row in self.archive.page(layout.kind, key, before, limit, columns, after):
+                    found.setdefault(tuple(row[:2]), row)
+            rows = [found[position] for position in sorted(found, reverse=True)[:limit]]
+            next_cursor = encode_cursor(*rows[-1][:2]) if len(rows) == limit else None
+            return [(row[0],) + tuple(row[2:]) for row in rows], next_cursor
+        return self._run(conn, work)
+
+    def watermark(self, conn=None):
+        """?since= cursor for after() of the rows stored from now on"""
+        return self._run(conn, lambda conn: encode_watermark(self.layout.last_id(conn)))
+
+    def after(self, key, since=None, limit=100, columns=None, conn=None):
+        """Rows (ts, *columns) of a series stored after a ?since= watermark, in insertion order, and the next watermark.
+
+        `since` is a cursor from watermark() or from a previous call, or epoch seconds
+        (see decode_since); None reads from the first row. Rows come in the order they
+        were stored, so that a row backfilled with an old timestamp is still after the
+        watermark. At most `limit` rows; the next call with the returned cursor reads
+        the following ones. `key` None reads every series. Archived rows are not read.
+        ValueError if `since` is not a watermark.
+        """
+        layout = self.layout
+        columns = tuple(columns or layout.values)
+        row_id, start = decode_since(since)
+        conditions, params = [], []
+        if key is not None:
+            # After a watermark, scan the few ids above it rather than the series' index
+            conditions.append(f"{'+' if row_id is not None else ''}{layout.key} = ?")
+            params.append(key)
+        if row_id is not None:
+            conditions.append("id > ?")
+            params.append(row_id)
+        if start is not None:
+            conditions.append(f"{layout.ts} >= ?")
+            params.append(start)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"SELECT id, {layout.ts}, {', '.join(columns)} FROM {{table}}{where} ORDER BY id LIMIT {int(limit)}"
+
+        def work(conn):
+            # Read first: every row up to it is either committed, so selected below, or never will be
+            newest = layout.last_id(conn)
+            found = []
+            for table in layout.tables(conn, start, None):
+                found.extend(tuple(row) for row in conn.execute(query.format(table=table), params))
+            rows = sorted(found)[:limit]
+            if len(rows) == limit:
+                cursor = rows[-1][0]
+            else:
+                cursor = max([newest, row_id or 0] + [row[0] for row in rows[-1:]])
+            return [row[1:] for row in rows], encode_watermark(cursor)
+        return self._run(conn, work)
+
+    def aggregate(self, key, start, end, resolution, conn=None):
+        """Count/min/max/mean/stddev of each metric per `resolution` seconds over [start, end).
+
+        Read from the rollups when the layout has them and the resolution is a
+        multiple of a minute, otherwise computed from the raw rows.
+        """
+        layout = self.layout
+
+        def work(conn):
+            if layout.rollups and choose_granularity(resolution):
+                return series(conn, layout.kind, key, start, end, resolution)
+            aggregates = ", ".join(f"COUNT({m}), MIN({m}), MAX({m}), TOTAL({m}), TOTAL({m} * {m})"
+                                   for m in layout.metrics)
+            stats = {}
+            for table in layout.tables(conn, start, end):
+                for row in conn.execute(f'''
+                    SELECT {layout.ts} - {layout.ts} % ? AS period, {aggregates} FROM {table}
+                    WHERE {layout.key} = ? AND {layout.ts} >= ? AND {layout.ts} < ?
+                    GROUP BY period
+                ''', (resolution, key, start, end)):
+                    stats[row[0]] = merge_stats(stats.get(row[0]), tuple(row)[1:])
+            return to_points(sorted((period,) + values for period, values in stats.items()), layout.metrics)
+        return self._run(conn, work)
+
+    def version(self, key=None, conn=None):
+        """(version, epoch seconds of the last change) of a series, or of every series if key is None"""
+        return self._run(conn, lambda conn: versions.version(conn, self.layout.kind, key))
+
+    def delete(self, key, conn=None):
+        """Delete every row of a series, its rollups and its archived rows.
+
+        With an open connection, the archive is left to the caller, to purge with
+        purge_archive() once committed: removed files cannot be rolled back.
+        """
+        layout = self.layout
+
+        def work(conn):
+            for table in layout.tables(conn):
+                conn.execute(f"DELETE FROM {table} WHERE {layout.key} = ?", (key,))
+            if layout.kind == 'device':
+                forget_device(conn, key)
+            versions.bump(conn, layout.kind, [key])
+        self._run(conn, work)
+        if self.latest_cache is not None:
+            self.latest_cache.invalidate(key)
+        if conn is None:
+            self.purge_archive(key)
+
+    def purge_archive(self, key):
+        """Remove the archived rows of a series, e.g. once its deletion is committed"""
+        if self.archive is not None:
+            self.archive.delete(self.layout.kind, key)
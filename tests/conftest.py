@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from partitions import reading_partitions  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_partitions():
+    """The partition cache is shared by the process: start each test with an empty one"""
+    reading_partitions.forget()
+    yield
+    reading_partitions.forget()
@@ -0,0 +1,58 @@
+import time
+
+import numpy as np
+
+from archive import ColumnArchive, to_arrays
+from migrations import CLIMATE_MIGRATIONS
+from storage import ReadingStore, connector
+
+NOW = int(time.time())
+ROWS = [(NOW - 3600 * i, 20.0 + i / 10, None if i == 2 else 50.0, i) for i in range(5)]
+
+
+def test_write_read_round_trip(tmp_path):
+    archive = ColumnArchive(str(tmp_path))
+    assert archive.write('device', 1, to_arrays('device', ROWS)) == 5
+    # Writing the same rows again replaces them
+    archive.write('device', 1, to_arrays('device', ROWS[:2]))
+    columns = archive.read('device', 1)
+    assert columns['ts'].tolist() == sorted(row[0] for row in ROWS)
+    assert np.isnan(columns['humidity']).sum() == 1
+    assert archive.history('device', 1, [], columns=('temperature', 'seq')) == sorted(
+        (ts, temperature, seq) for ts, temperature, _, seq in ROWS)
+
+
+def test_history_merges_rows_still_in_sqlite(tmp_path):
+    archive = ColumnArchive(str(tmp_path))
+    archive.write('device', 1, to_arrays('device', ROWS[2:]))
+    live = [(ts, temperature, humidity, seq) for ts, temperature, humidity, seq in ROWS[:3]]
+    merged = archive.history('device', 1, live)
+    assert [row[0] for row in merged] == sorted(row[0] for row in ROWS)
+
+
+def test_deleting_a_series_purges_its_archive(tmp_path):
+    archive = ColumnArchive(str(tmp_path / 'archive'))
+    archive.write('device', 1, to_arrays('device', ROWS))
+    archive.write('device', 2, to_arrays('device', ROWS))
+    store = ReadingStore('device', connector(str(tmp_path / 'climate_data.db'), migrations=CLIMATE_MIGRATIONS),
+                         archive=archive)
+    store.insert_batch([(1, 1.0, 2.0, NOW, 99)])
+
+    store.delete(1)
+    assert archive.months('device', 1) == []
+    assert archive.months('device', 2) != []
+    # A device reusing the id starts with no history
+    assert store.range_query(1) == []
+
+
+def test_delete_in_the_callers_transaction_keeps_the_archive_until_purged(tmp_path):
+    archive = ColumnArchive(str(tmp_path / 'archive'))
+    archive.write('device', 1, to_arrays('device', ROWS))
+    store = ReadingStore('device', connector(str(tmp_path / 'climate_data.db'), migrations=CLIMATE_MIGRATIONS),
+                         archive=archive)
+    conn = store.connect()
+    store.delete(1, conn=conn)
+    conn.rollback()
+    assert archive.months('device', 1) != []
+    store.purge_archive(1)
+    assert archive.months('device', 1) == []
@@ -0,0 +1,97 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from epoch import READING_MAX_AGE, READING_MAX_AHEAD, check_reading_time, to_epoch
+from ingest import InvalidField, extract_batch, parse_timestamp, reading_seq, reading_values
+from ingest_server import LineError, parse_line
+
+NOW = int(time.time())
+
+
+def test_extract_batch():
+    readings = [{'temperature': 20}]
+    assert extract_batch(readings) is readings
+    assert extract_batch({'api_key': 'k', 'readings': readings}) is readings
+    assert extract_batch({'readings': 'nope'}) is None
+    assert extract_batch(None) is None
+
+
+def test_reading_values():
+    item = {'temperature': '21.5', 'humidity': 40}
+    assert reading_values(item, ('temperature', 'humidity', 'pressure')) == [21.5, 40.0, None]
+
+
+@pytest.mark.parametrize('value', ['abc', 'nan', 'inf', float('nan'), True, [20], {'v': 1}, '1e400'])
+def test_reading_values_rejects(value):
+    with pytest.raises(InvalidField) as info:
+        reading_values({'humidity': 40, 'temperature': value}, ('humidity', 'temperature'))
+    assert info.value.field == 'temperature'
+
+
+def test_reading_seq():
+    assert reading_seq(None) is None
+    assert reading_seq('12') == 12
+    assert reading_seq(2 ** 63 - 1) == 2 ** 63 - 1
+
+
+@pytest.mark.parametrize('value', [2 ** 63, -2 ** 63 - 1, 1.5, False, 'x'])
+def test_reading_seq_rejects(value):
+    with pytest.raises(InvalidField):
+        reading_seq(value)
+
+
+def test_parse_timestamp():
+    default = datetime(2024, 1, 1)
+    assert parse_timestamp('', default) is default
+    recent = datetime.fromtimestamp(NOW - 3600).replace(microsecond=0)
+    assert parse_timestamp(recent.strftime('%Y-%m-%d %H:%M:%S')) == recent
+    with pytest.raises(ValueError):
+        parse_timestamp('1999-01-01 00:00:00')
+    with pytest.raises(ValueError):
+        parse_timestamp('yesterday')
+
+
+def test_to_epoch():
+    assert to_epoch(None) is None
+    assert to_epoch(NOW + 0.7) == NOW
+    assert to_epoch(datetime.fromtimestamp(NOW)) == NOW
+    for value in (float('nan'), float('inf'), 10 ** 20):
+        with pytest.raises(ValueError):
+            to_epoch(value)
+    with pytest.raises(TypeError):
+        to_epoch(True)
+
+
+def test_check_reading_time():
+    assert check_reading_time(NOW - READING_MAX_AGE, now=NOW) == NOW - READING_MAX_AGE
+    assert check_reading_time(NOW + READING_MAX_AHEAD, now=NOW) == NOW + READING_MAX_AHEAD
+    for ts in (NOW - READING_MAX_AGE - 1, NOW + READING_MAX_AHEAD + 1, 4000000000, 0):
+        with pytest.raises(ValueError):
+            check_reading_time(ts, now=NOW)
+
+
+def test_parse_line():
+    assert parse_line(f"key {NOW} temperature=21.5,humidity=40,seq=3") == ('key', NOW, 21.5, 40.0, 3)
+
+
+def test_parse_line_without_epoch_is_stamped_on_arrival():
+    api_key, epoch, _, _, seq = parse_line("key - temperature=21.5,humidity=40")
+    assert api_key == 'key' and abs(epoch - time.time()) < 5 and seq is not None
+    assert parse_line("key - temperature=21.5,humidity=40,seq=9")[4] == 9
+
+
+@pytest.mark.parametrize('line, message', [
+    ("key temperature=21.5,humidity=40", "expected"),
+    ("key 4000000000 temperature=21.5,humidity=40", "invalid epoch"),
+    ("key soon temperature=21.5,humidity=40", "invalid epoch"),
+    (f"key {NOW} temperature=21.5,humidity", "malformed field"),
+    (f"key {NOW} temperature=21.5", "missing field humidity"),
+    (f"key {NOW} temperature=nan,humidity=40", "invalid value for temperature"),
+    (f"key {NOW} temperature=21.5,humidity=inf", "invalid value for humidity"),
+    (f"key {NOW} temperature=21.5,humidity=40,seq=x", "invalid value for seq"),
+])
+def test_parse_line_rejects(line, message):
+    with pytest.raises(LineError, match=message):
+        parse_line(line)
@@ -0,0 +1,86 @@
+import sqlite3
+import time
+
+import pytest
+
+from migrations import CLIMATE_MIGRATIONS, migrate
+from partitions import month_key, reading_partitions
+
+NOW = int(time.time())
+DAY = 86400
+# Two readings in each of four months, ids 1 to 8 in the unpartitioned table
+LEGACY_READINGS = [(1, 20.0 + i, 50.0, NOW - (i // 2) * 40 * DAY - i, i) for i in range(8)]
+
+
+def migrations_up_to(version):
+    return [migration for migration in CLIMATE_MIGRATIONS if migration[0] <= version]
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    """climate_data.db before the monthly partitions, holding LEGACY_READINGS"""
+    conn = sqlite3.connect(tmp_path / 'climate_data.db')
+    migrate(conn, migrations_up_to(5))
+    conn.executemany("INSERT INTO reading_samples (device_id, temperature, humidity, ts, seq) VALUES (?, ?, ?, ?, ?)",
+                     LEGACY_READINGS)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def reading_ids(conn):
+    return sorted(row[0] for row in conn.execute("SELECT id FROM readings"))
+
+
+def test_migration_keeps_reading_ids(legacy_db):
+    migrate(legacy_db)
+    assert len(reading_partitions.list(legacy_db)) == 4
+    assert legacy_db.execute("SELECT COUNT(*) FROM reading_samples").fetchone()[0] == 0
+    assert reading_ids(legacy_db) == list(range(1, 9))
+    assert legacy_db.execute("SELECT last_id FROM row_ids WHERE kind = 'device'").fetchone()[0] == 8
+
+
+def test_renumber_repairs_partitions_numbered_from_one(legacy_db):
+    migrate(legacy_db, migrations_up_to(9))
+    # As left by the migration that did not copy ids: each partition from 1, the counter at 2
+    for name in reading_partitions.list(legacy_db):
+        legacy_db.execute(f"UPDATE {name} SET id = -id")
+        legacy_db.execute(f"UPDATE {name} SET id = -id - (SELECT -MAX(id) FROM {name}) + 1")
+        legacy_db.execute("UPDATE rollup_state SET last_id = 2 WHERE source = ?", (name,))
+    legacy_db.execute("UPDATE row_ids SET last_id = 2 WHERE kind = 'device'")
+    legacy_db.commit()
+    assert len(set(reading_ids(legacy_db))) == 2
+
+    assert migrate(legacy_db) == [10]
+    ids = reading_ids(legacy_db)
+    assert len(set(ids)) == 8
+    assert legacy_db.execute("SELECT last_id FROM row_ids WHERE kind = 'device'").fetchone()[0] == max(ids)
+    # Rollup watermarks moved with the rows: nothing is folded twice
+    for name in reading_partitions.list(legacy_db):
+        state = legacy_db.execute("SELECT last_id FROM rollup_state WHERE source = ?", (name,)).fetchone()[0]
+        assert state == legacy_db.execute(f"SELECT MAX(id) FROM {name}").fetchone()[0]
+
+
+def test_insert_skips_duplicates_and_reports_ids(legacy_db):
+    migrate(legacy_db)
+    rows = [(1, 21.0, 51.0, NOW, 100), (1, 21.0, 51.0, NOW, 100), (2, 22.0, 52.0, NOW - 40 * DAY, 1)]
+    after, ids = reading_partitions.insert(legacy_db, rows)
+    legacy_db.commit()
+    assert after == 8
+    assert ids == [9, None, 11]
+    assert reading_ids(legacy_db) == list(range(1, 10)) + [11]
+
+
+def test_insert_rejects_implausible_timestamps(legacy_db):
+    migrate(legacy_db)
+    with pytest.raises(ValueError):
+        reading_partitions.insert(legacy_db, [(1, 21.0, 51.0, NOW + 400 * DAY, 1)])
+
+
+def test_legacy_view_insert_uses_the_counter(legacy_db):
+    migrate(legacy_db)
+    legacy_db.execute("INSERT INTO readings (device_id, temperature, humidity, timestamp, seq) "
+                      "VALUES (1, 1.0, 2.0, '2026-01-01 12:00:00', 7)")
+    legacy_db.commit()
+    assert legacy_db.execute("SELECT id FROM reading_samples").fetchall() == [(9,)]
+    assert month_key(NOW) in {name[-6:] for name in reading_partitions.list(legacy_db)}
@@ -0,0 +1,45 @@
+import struct
+
+import pytest
+
+from payload_codec import (HEADER, HUMIDITY_MISSING, MAGIC, RECORD, TEMPERATURE_MISSING, PayloadError,
+                           decode_readings, encode_readings)
+
+READINGS = [(1700000000, 21.5, 48.25), (1700000060, -12.34, 100.0), (1700000120, 0.0, 0.0)]
+
+
+def test_round_trip():
+    body = encode_readings(READINGS, api_key='abc123', device_id=7)
+    assert len(body) == HEADER.size + len('abc123') + RECORD.size * len(READINGS)
+    assert decode_readings(body) == ('abc123', 7, READINGS)
+
+
+def test_missing_values():
+    body = encode_readings([(1700000000, None, 55.0), (1700000060, 20.0, None)])
+    _, temperature, humidity = RECORD.unpack_from(body, HEADER.size)
+    assert (temperature, humidity) == (TEMPERATURE_MISSING, 5500)
+    assert RECORD.unpack_from(body, HEADER.size + RECORD.size)[2] == HUMIDITY_MISSING
+    assert decode_readings(body) == ('', 0, [(1700000000, None, 55.0), (1700000060, 20.0, None)])
+
+
+def test_api_key_may_come_from_the_header():
+    assert decode_readings(bytearray(encode_readings(READINGS[:1])))[:2] == ('', 0)
+
+
+@pytest.mark.parametrize('body, message', [
+    (b'WD', "Payload shorter than its header"),
+    (HEADER.pack(b'XX', 1, 0, 0) + RECORD.pack(1700000000, 0, 0), "Unknown payload format"),
+    (HEADER.pack(MAGIC, 2, 0, 0) + RECORD.pack(1700000000, 0, 0), "Unknown payload format"),
+    (HEADER.pack(MAGIC, 1, 0, 0), "Truncated payload"),
+    (HEADER.pack(MAGIC, 1, 10, 0) + b'abc', "Truncated payload"),
+    (HEADER.pack(MAGIC, 1, 0, 0) + RECORD.pack(1700000000, 0, 0)[:-1], "Truncated payload"),
+    (HEADER.pack(MAGIC, 1, 2, 0) + 'é'.encode('latin-1') * 2 + RECORD.pack(1700000000, 0, 0), "API key must be ASCII"),
+])
+def test_invalid_payloads(body, message):
+    with pytest.raises(PayloadError, match=message):
+        decode_readings(body)
+
+
+def test_values_out_of_the_record_range_are_not_encoded():
+    with pytest.raises(struct.error):
+        encode_readings([(1700000000, 400.0, 50.0)])
@@ -0,0 +1,38 @@
+import sqlite3
+import time
+
+import retention
+from migrations import CLIMATE_MIGRATIONS, migrate
+from partitions import reading_partitions
+from retention import RetentionJob
+
+NOW = int(time.time())
+
+
+def test_rollup_backlog_is_folded_in_short_transactions(tmp_path, monkeypatch):
+    path = str(tmp_path / 'climate_data.db')
+    conn = sqlite3.connect(path)
+    migrate(conn, CLIMATE_MIGRATIONS)
+    reading_partitions.insert(conn, [(1, 20.0, 50.0, NOW - i, i) for i in range(25)])
+    # A backlog: nothing folded yet
+    conn.execute("DELETE FROM rollup_state")
+    conn.execute("DELETE FROM device_rollups")
+    conn.commit()
+    conn.close()
+
+    writer = sqlite3.connect(path, timeout=0)
+    writes = []
+
+    def write_between_chunks(seconds):
+        # Raises "database is locked" if the job still held the write lock
+        with writer:
+            writer.execute("UPDATE row_ids SET last_id = last_id WHERE kind = 'device'")
+        writes.append(seconds)
+    monkeypatch.setattr(retention.time, 'sleep', write_between_chunks)
+
+    job = RetentionJob(path, policies={'default': {'raw': None, 'minute': None, 'hour': None, 'day': None}},
+                       chunk_size=10, pause=0.01)
+    job.run_once()
+    assert writes
+    check = sqlite3.connect(path)
+    assert check.execute("SELECT SUM(temperature_count) FROM device_rollups WHERE granularity = 86400").fetchone()[0] == 25
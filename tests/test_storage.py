@@ -0,0 +1,85 @@
+import sqlite3
+import time
+
+import pytest
+
+from migrations import CLIMATE_MIGRATIONS, migrate
+from storage import ReadingStore, connector, decode_since, encode_watermark
+
+NOW = int(time.time())
+DAY = 86400
+# Two readings in each of four months, left in the unpartitioned table by older versions
+LEGACY_READINGS = [(1, 20.0 + i, 50.0, NOW - (i // 2) * 40 * DAY - i, i) for i in range(8)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Device readings store over a database migrated with LEGACY_READINGS in it"""
+    path = tmp_path / 'climate_data.db'
+    conn = sqlite3.connect(path)
+    migrate(conn, [migration for migration in CLIMATE_MIGRATIONS if migration[0] <= 5])
+    conn.executemany("INSERT INTO reading_samples (device_id, temperature, humidity, ts, seq) VALUES (?, ?, ?, ?, ?)",
+                     LEGACY_READINGS)
+    conn.commit()
+    conn.close()
+    return ReadingStore('device', connector(str(path), migrations=CLIMATE_MIGRATIONS))
+
+
+def read_all_after(store, key, since, limit):
+    rows = []
+    while True:
+        batch, since = store.after(key, since, limit, columns=('seq',))
+        rows.extend(batch)
+        if len(batch) < limit:
+            return rows, since
+
+
+def test_after_reads_every_row_across_partitions(store):
+    rows, since = read_all_after(store, 1, None, 3)
+    assert sorted(seq for _, seq in rows) == list(range(8))
+
+    # A reading stored late, with an old timestamp, still comes after the watermark
+    store.insert_batch([(1, 10.0, 40.0, NOW - 100 * DAY, 50), (1, 11.0, 41.0, NOW, 51)])
+    rows, since = read_all_after(store, 1, since, 1)
+    assert [seq for _, seq in rows] == [50, 51]
+    assert store.after(1, since)[0] == []
+
+
+def test_after_moves_the_watermark_past_other_series(store):
+    since = store.watermark()
+    store.insert_batch([(2, 1.0, 1.0, NOW, 1)])
+    rows, cursor = store.after(1, since)
+    assert rows == []
+    assert decode_since(cursor)[0] > decode_since(since)[0]
+
+
+def test_after_with_epoch_seconds(store):
+    rows, _ = store.after(1, str(NOW - 2), columns=('seq',))
+    # LEGACY_READINGS[0] and [1] are at NOW and NOW - 1
+    assert [seq for _, seq in rows] == [0, 1]
+
+
+@pytest.mark.parametrize('since', ['abc', 'w', 'w-1', '12_3', '-5'])
+def test_after_rejects_invalid_watermarks(store, since):
+    with pytest.raises(ValueError):
+        store.after(1, since)
+
+
+def test_watermark_cursor_round_trip():
+    assert decode_since(encode_watermark(42)) == (42, None)
+    assert decode_since('100') == (None, 101)
+    assert decode_since(None) == (None, None)
+
+
+def test_page_reads_every_row_newest_first(store):
+    store.insert_batch([(1, 10.0, 40.0, NOW - 100 * DAY, 50)])
+    rows, cursor = store.page(1, limit=3, columns=('seq',))
+    pages = [rows]
+    while cursor:
+        rows, cursor = store.page(1, cursor, 3, columns=('seq',))
+        pages.append(rows)
+    timestamps = [ts for page in pages for ts, _ in page]
+    assert timestamps == sorted(timestamps, reverse=True)
+    assert sorted(seq for page in pages for _, seq in page) == list(range(8)) + [50]
+    # A full last page still has a next cursor, to an empty page
+    assert [len(page) for page in pages] == [3, 3, 3, 0]
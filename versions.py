@@ -0,0 +1,66 @@
+"""
+Change counters of the time series, for conditional GETs.
+
+`series_versions` holds a version per series (a device's readings, a city's
+climate rows), bumped in the transaction of every write: ReadingStore, the
+climate mirror and the retention job. Polling endpoints derive their ETag from
+it with a primary key lookup and answer 304 without reading the series.
+"""
+import hashlib
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS series_versions (
+        kind TEXT NOT NULL,
+        key NOT NULL,
+        version INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL,
+        PRIMARY KEY (kind, key)
+    ) WITHOUT ROWID
+'''
+
+
+def create_table(conn):
+    conn.execute(SCHEMA)
+
+
+def seed(conn, kind, keys_sql):
+    """Start tracking the existing series of a kind, the keys selected by `keys_sql`"""
+    conn.execute(f'''
+        INSERT OR IGNORE INTO series_versions (kind, key, version, updated_at)
+        SELECT ?, key, 1, CAST(strftime('%s', 'now') AS INTEGER) FROM ({keys_sql}) WHERE key IS NOT NULL
+    ''', (kind,))
+
+
+def bump(conn, kind, keys):
+    """Record a change of the given series of a kind"""
+    conn.executemany('''
+        INSERT INTO series_versions (kind, key, version, updated_at) VALUES (?, ?, 1, CAST(strftime('%s', 'now') AS INTEGER))
+        ON CONFLICT (kind, key) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at
+    ''', [(kind, key) for key in set(keys)])
+
+
+def bump_all(conn, kind, schema='main'):
+    """Record a change of every series of a kind, e.g. after rows were expired"""
+    conn.execute(f'''
+        UPDATE {schema}.series_versions SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE kind = ?
+    ''', (kind,))
+
+
+def version(conn, kind, key=None):
+    """(version, epoch seconds of the last change) of a series, or of all the series of a kind if key is None.
+
+    (0, None) for a series never written since versions are tracked.
+    """
+    if key is None:
+        total, updated_at = conn.execute(
+            "SELECT TOTAL(version), MAX(updated_at) FROM series_versions WHERE kind = ?", (kind,)).fetchone()
+        return int(total), updated_at
+    row = conn.execute("SELECT version, updated_at FROM series_versions WHERE kind = ? AND key = ?",
+                       (kind, key)).fetchone()
+    return (row[0], row[1]) if row else (0, None)
+
+
+def etag(*parts):
+    """Strong ETag value of a response determined by `parts`"""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:20]
@@ -1,19 +1,22 @@
 """
 Script de visualisation des données météorologiques
 """
-import sqlite3
 import pandas as pd
 import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
 import os
+from epoch import format_epoch
+from storage import ReadingStore, connector
+
+climate_store = ReadingStore('city', connector('climate_data.db'))
 
 def get_data_from_db():
     """Récupère les données de la base SQLite"""
-    conn = sqlite3.connect('climate_data.db')
-    query = "SELECT * FROM climate ORDER BY date, time"
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    return df
+    rows = climate_store.range_query(None, columns=('temperature', 'humidity', 'gdd', 'city'))
+    return pd.DataFrame(
+        [(format_epoch(ts, '%Y-%m-%d'), format_epoch(ts, '%H:%M:%S')) + tuple(values) for ts, *values in rows],
+        columns=['date', 'time', 'temperature', 'humidity', 'gdd', 'city']
+    )
 
 def show_data_summary(df):
     """Affiche un résumé des données"""
@@ -0,0 +1,57 @@
+"""
+Insertion order of the time series, for ?since= deltas and the live streams.
+
+A client polling for new rows keeps the id of the last row it got and asks for
+the rows with a greater id (ReadingStore.after). That only works if ids grow in
+the order rows are committed, whatever their timestamp, so `row_ids` holds one
+counter per kind of series, advanced in the write transaction: the device
+partitions share the 'device' counter, app.py's `reading` table the 'reading'
+one. Ids are never reused, even after a delete. climate_samples needs no
+counter, its AUTOINCREMENT ids already behave this way.
+"""
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS row_ids (
+        kind TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    ) WITHOUT ROWID
+'''
+
+
+def create_table(conn):
+    conn.execute(SCHEMA)
+
+
+def seed(conn, kind, tables):
+    """Start the counter of a kind after the greatest id of its existing tables"""
+    last = max([conn.execute(f"SELECT IFNULL(MAX(id), 0) FROM {table}").fetchone()[0] for table in tables] + [0])
+    conn.execute("INSERT OR IGNORE INTO row_ids (kind, last_id) VALUES (?, ?)", (kind, last))
+
+
+def raise_to(conn, kind, last):
+    """Make the counter of a kind hand out ids greater than `last`"""
+    conn.execute("UPDATE row_ids SET last_id = MAX(last_id, ?) WHERE kind = ?", (last, kind))
+
+
+def allocate(conn, kind, count):
+    """First of `count` consecutive new ids of a kind.
+
+    The update takes the write lock, so no other transaction gets ids until this
+    one ends: ids below the first one are committed, or will never be.
+    """
+    conn.execute("UPDATE row_ids SET last_id = last_id + ? WHERE kind = ?", (count, kind))
+    row = conn.execute("SELECT last_id FROM row_ids WHERE kind = ?", (kind,)).fetchone()
+    if row is None:
+        raise LookupError(f"No row id counter for {kind} rows: migrate the database")
+    return row[0] - count + 1
+
+
+def last_id(conn, kind):
+    """Greatest id handed out for a kind, 0 if none"""
+    row = conn.execute("SELECT last_id FROM row_ids WHERE kind = ?", (kind,)).fetchone()
+    return row[0] if row else 0
+
+
+def inserted(conn, table, first, last):
+    """Ids of [first, last] present in a table: those of the rows an INSERT OR IGNORE kept"""
+    return {row[0] for row in conn.execute(f"SELECT id FROM {table} WHERE id BETWEEN ? AND ?", (first, last))}
@@ -1,46 +1,36 @@
 import requests
 from datetime import datetime, timedelta
-import sqlite3
+from epoch import day_bounds, format_epoch, to_epoch
+from migrations import CLIMATE_MIGRATIONS
+from storage import ReadingStore, connector
+
+climate_store = ReadingStore('city', connector('climate_data.db', migrations=CLIMATE_MIGRATIONS))
 
 def get_weather_data(station, date):
     """
     Récupère les données météorologiques journalières pour une station donnée
     """
-    conn = sqlite3.connect('climate_data.db')
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("""
-            SELECT time, temperature, humidity, gdd, city
-            FROM climate
-            WHERE date = ? AND city = ?
-            ORDER BY time ASC
-        """, (date, station))
+        rows = climate_store.range_query(station, *day_bounds(date), columns=('temperature', 'humidity', 'gdd'))
         
         data = [{
-            'time': row[0],
-            'temperature': row[1],
-            'humidity': row[2],
-            'gdd': row[3],
-            'city': row[4]
-        } for row in cursor.fetchall()]
+            'time': format_epoch(ts, '%H:%M:%S'),
+            'temperature': temperature,
+            'humidity': humidity,
+            'gdd': gdd,
+            'city': station
+        } for ts, temperature, humidity, gdd in rows]
         
         return data
     
     except Exception as e:
         print(f"Erreur lors de la récupération des données: {e}")
         return None
-    
-    finally:
-        conn.close()
 
 def get_monthly_weather_data(station, year, month):
     """
     Récupère les données météorologiques mensuelles pour une station donnée
     """
-    conn = sqlite3.connect('climate_data.db')
-    cursor = conn.cursor()
-    
     start_date = f"{year}-{month:02d}-01"
     if month == 12:
         end_date = f"{year + 1}-01-01"
@@ -48,60 +38,38 @@ def get_monthly_weather_data(station, year, month):
         end_date = f"{year}-{month + 1:02d}-01"
     
     try:
-        cursor.execute("""
-            SELECT date, time, temperature, humidity, gdd, city
-            FROM climate
-            WHERE city = ? 
-            AND date >= ? 
-            AND date < ?
-            ORDER BY date ASC, time ASC
-        """, (station, start_date, end_date))
+        rows = climate_store.range_query(station, to_epoch(start_date), to_epoch(end_date),
+                                         columns=('temperature', 'humidity', 'gdd'))
         
         data = [{
-            'date': row[0],
-            'time': row[1],
-            'temperature': row[2],
-            'humidity': row[3],
-            'gdd': row[4],
-            'city': row[5]
-        } for row in cursor.fetchall()]
+            'date': format_epoch(ts, '%Y-%m-%d'),
+            'time': format_epoch(ts, '%H:%M:%S'),
+            'temperature': temperature,
+            'humidity': humidity,
+            'gdd': gdd,
+            'city': station
+        } for ts, temperature, humidity, gdd in rows]
         
         return data
     
     except Exception as e:
         print(f"Erreur lors de la récupération des données mensuelles: {e}")
         return None
-    
-    finally:
-        conn.close()
 
 def save_weather_data(data, station):
     """
     Sauvegarde les données météorologiques dans la base de données
     """
-    conn = sqlite3.connect('climate_data.db')
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("""
-            INSERT INTO climate (date, time, temperature, humidity, gdd, city)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            data['date'],
-            data['time'],
+        climate_store.insert_batch([(
+            to_epoch(f"{data['date']} {data['time']}"),
             data['temperature'],
             data['humidity'],
             data.get('gdd', 0),
             station
-        ))
-        
-        conn.commit()
+        )])
         return True
         
     except Exception as e:
         print(f"Erreur lors de la sauvegarde des données: {e}")
-        conn.rollback()
         return False
-        
-    finally:
-        conn.close()